@@ -0,0 +1,81 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+from torch.utils.data.sampler import Sampler
+from torchvision.transforms import Compose, transforms
+
+
+def get_image_sizes(dataset, num_workers=8):
+    # (height, width) of all images from file headers, PIL does not decode pixels on open.
+    def read_size(file):
+        with Image.open(os.path.join(dataset.path, file)) as image:
+            return image.size[1], image.size[0]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        sizes = list(executor.map(read_size, dataset.all_images))
+    return np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+
+
+def get_bucket_sizes(sizes, step=32, min_height=64, max_height=256, max_width=256):
+    # Native sizes rounded to multiples of step: small crops stay small instead of being upsampled,
+    # large crops are scaled down to max_height, and the aspect ratio is kept.
+    sizes = np.asarray(sizes, dtype=np.float64)
+    heights = np.clip(np.round(sizes[:, 0] / step) * step, min_height, max_height)
+    widths = np.clip(np.round(sizes[:, 1] * heights / sizes[:, 0] / step) * step, step, max_width)
+    return np.stack([heights, widths], axis=1).astype(np.int64)
+
+
+class BucketDataset(Dataset):
+    def __init__(self, origin_dataset, bucket_sizes):
+        # origin_dataset images resized to their bucket size, bucket_sizes is indexed by all samples.
+        super(BucketDataset, self).__init__()
+        self.origin_dataset = origin_dataset
+        self.bucket_sizes = np.asarray(bucket_sizes, dtype=np.int64)
+        self.transforms = {}
+
+    def __len__(self):
+        return self.origin_dataset.length
+
+    def get_sizes(self):
+        # Bucket size of each available sample.
+        return self.bucket_sizes[self.origin_dataset.available_index]
+
+    def get_transform(self, size):
+        if size not in self.transforms:
+            self.transforms[size] = Compose([transforms.Resize(size), transforms.ToTensor(),
+                                             transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                                                  std=[0.229, 0.224, 0.225])])
+        return self.transforms[size]
+
+    def __getitem__(self, index):
+        index = self.origin_dataset.available_index[index]
+        image = Image.open(os.path.join(self.origin_dataset.path, self.origin_dataset.all_images[index]))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = self.get_transform(tuple(int(x) for x in self.bucket_sizes[index]))(image)
+        return image, self.origin_dataset.all_labels[index], self.origin_dataset.all_pids[index], \
+            self.origin_dataset.all_camids[index]
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, sizes, batch_size):
+        # Batches of samples with the same size, for DataLoader(batch_sampler=...).
+        super(BucketBatchSampler, self).__init__(None)
+        self.batch_size = batch_size
+        sizes = np.asarray(sizes, dtype=np.int64)
+        _, bucket_index = np.unique(sizes, axis=0, return_inverse=True)
+        bucket_index = bucket_index.reshape(-1)
+        order = np.argsort(bucket_index, kind='stable')
+        _, starts = np.unique(bucket_index[order], return_index=True)
+        self.buckets = np.split(order, starts[1:])
+        self.length = sum((len(bucket) + batch_size - 1) // batch_size for bucket in self.buckets)
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            for start in range(0, len(bucket), self.batch_size):
+                yield bucket[start:start + self.batch_size].tolist()
+
+    def __len__(self):
+        return self.length
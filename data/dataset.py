@@ -1,7 +1,9 @@
 import copy
+import csv
 import os
 import re
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from PIL import Image
@@ -10,15 +12,198 @@ from torch.utils.data import Dataset, DataLoader
 import numpy as np
 from torch.utils.data.dataset import T
 
+MANIFEST_VERSION = 2
+# Folder styles are parsed from file names: <pid>_c<camid>... with pid -1/0 as junk images.
+NAME_PATTERN = re.compile(r'^([^\n]*?([-\d]+)_c(\d+)[^\n]*\.(?:jpg|png))$', re.M)
+# MSMT17 list files: <folder>/<pid>_<index>_<camid>_<time>_<frame>_<box>.jpg <label>
+LIST_PATTERN = re.compile(r'^(\S+)[ \t]+(\d+)[ \t]*$', re.M)
+MSMT_CAMID_PATTERN = re.compile(r'^(?:[^\n]*/)?\d+_\d+_(\d+)_[^\n]*$', re.M)
+MSMT_SPLITS = {
+    'bounding_box_train': ('train', 'list_train.txt'),
+    'train': ('train', 'list_train.txt'),
+    'query': ('test', 'list_query.txt'),
+    'bounding_box_test': ('test', 'list_gallery.txt'),
+    'gallery': ('test', 'list_gallery.txt'),
+}
+
+
+def parse_names(names, drop_junk=True):
+    # One regex pass over all names joined by new lines.
+    matches = NAME_PATTERN.findall('\n'.join(names))
+    if len(matches) == 0:
+        return [], [], []
+    images, pids, camids = map(np.asarray, zip(*matches))
+    pids = pids.astype(np.int64)
+    camids = camids.astype(np.int64)
+    if drop_junk:
+        keep = (pids != -1) & (pids != 0)
+        images, pids, camids = images[keep], pids[keep], camids[keep]
+    return images.tolist(), pids.tolist(), camids.tolist()
+
+
+def get_folder_source(path):
+    return path
+
+
+def parse_folder(path):
+    # Load folder and parse every file name.
+    with os.scandir(path) as entries:
+        files = sorted(entry.name for entry in entries)
+    return parse_names(files)
+
+
+def get_msmt_source(path):
+    # <root>/bounding_box_train -> <root>/list_train.txt
+    folder = os.path.abspath(path).rstrip(os.sep)
+    _, list_file = MSMT_SPLITS[os.path.basename(folder)]
+    return os.path.join(os.path.dirname(folder), list_file)
+
+
+def parse_msmt(path):
+    # Labels come from the list file, so label 0 is a valid identity.
+    folder = os.path.abspath(path).rstrip(os.sep)
+    image_folder, _ = MSMT_SPLITS[os.path.basename(folder)]
+    with open(get_msmt_source(path)) as f:
+        matches = LIST_PATTERN.findall(f.read())
+    if len(matches) == 0:
+        return [], [], []
+    files, pids = zip(*matches)
+    camids = MSMT_CAMID_PATTERN.findall('\n'.join(files))
+    assert len(camids) == len(files), 'Every MSMT17 file name should contain a camera id.'
+    root = os.path.join(os.path.dirname(folder), image_folder)
+    images = [os.path.join(root, file) for file in files]
+    return images, np.asarray(pids, dtype=np.int64).tolist(), np.asarray(camids, dtype=np.int64).tolist()
+
+
+def get_csv_source(path):
+    # <root>/bounding_box_train -> <root>/bounding_box_train.csv
+    return os.path.abspath(path).rstrip(os.sep) + '.csv'
+
+
+def parse_csv(path):
+    # Custom manifest with an 'image,pid,camid' header, images relative to the csv folder.
+    csv_file = get_csv_source(path)
+    with open(csv_file, newline='') as f:
+        rows = list(csv.reader(f))
+    if len(rows) <= 1:
+        return [], [], []
+    header = [x.strip() for x in rows[0]]
+    columns = list(zip(*rows[1:]))
+    root = os.path.dirname(csv_file)
+    images = [os.path.join(root, file) for file in columns[header.index('image')]]
+    pids = np.asarray(columns[header.index('pid')], dtype=np.int64)
+    camids = np.asarray(columns[header.index('camid')], dtype=np.int64)
+    return images, pids.tolist(), camids.tolist()
+
+
+# style -> (get_source, parse), get_source gives the file or folder a manifest is checked against.
+STYLES = {
+    'market': (get_folder_source, parse_folder),
+    'duke': (get_folder_source, parse_folder),
+    'cuhk03': (get_folder_source, parse_folder),
+    'msmt': (get_msmt_source, parse_msmt),
+    'csv': (get_csv_source, parse_csv),
+}
+
+
+def register_style(style, get_source, parse):
+    STYLES[style] = (get_source, parse)
+
+
+def get_style(style):
+    if style not in STYLES:
+        raise ValueError('Unknown dataset style: {}, available: {}'.format(style, ', '.join(sorted(STYLES))))
+    return STYLES[style]
+
+
+def scan_folder(path, style):
+    _, parse = get_style(style)
+    return parse(path)
+
+
+def get_manifest_file(path, style):
+    # Manifests live next to the split folders: <root>/.manifest/<split>[<style>].npz
+    folder = os.path.abspath(path).rstrip(os.sep)
+    return os.path.join(os.path.dirname(folder), '.manifest',
+                        '{}[{}].npz'.format(os.path.basename(folder), style))
+
+
+def load_manifest(path, style):
+    # Return parsed lists if the manifest matches the source's mtime and size, else None.
+    manifest_file = get_manifest_file(path, style)
+    if not os.path.isfile(manifest_file):
+        return None
+    stat = os.stat(get_style(style)[0](path))
+    try:
+        manifest = np.load(manifest_file)
+        if int(manifest['version']) != MANIFEST_VERSION or int(manifest['mtime']) != stat.st_mtime_ns \
+                or int(manifest['size']) != stat.st_size:
+            return None
+        return manifest['images'].tolist(), manifest['pids'].tolist(), manifest['camids'].tolist()
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_manifest(path, style, images, pids, camids):
+    manifest_file = get_manifest_file(path, style)
+    stat = os.stat(get_style(style)[0](path))
+    try:
+        if not os.path.isdir(os.path.dirname(manifest_file)):
+            os.makedirs(os.path.dirname(manifest_file))
+        np.savez(manifest_file, images=np.asarray(images, dtype=str), pids=np.asarray(pids, dtype=np.int64),
+                 camids=np.asarray(camids, dtype=np.int64), mtime=stat.st_mtime_ns, size=stat.st_size,
+                 version=MANIFEST_VERSION)
+    except OSError:
+        # Read-only dataset folders just skip the manifest.
+        pass
+
+
+def get_manifest(path, style, manifest=True):
+    results = load_manifest(path, style) if manifest else None
+    if results is None:
+        results = scan_folder(path, style)
+        if manifest:
+            save_manifest(path, style, *results)
+    return results
+
+
+def prepare_manifests(style, paths, num_workers=4):
+    # Scan several folders in parallel on cold start, folder listing is IO bound.
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(lambda path: get_manifest(path, style), paths))
+
+
+def to_shared(array):
+    # Copy a numpy array into shared memory, returns the tensor that owns it and the numpy dtype.
+    array = np.ascontiguousarray(array)
+    if array.dtype.kind == 'U':
+        return torch.from_numpy(array.view(np.uint8)).share_memory_(), array.dtype
+    return torch.from_numpy(array).share_memory_(), array.dtype
+
+
+def from_shared(tensor, dtype):
+    # Numpy view of a shared tensor, no copy.
+    return tensor.numpy().view(dtype)
+
 
 class ImageDataset(Dataset):
-    def __init__(self, style, path, transform, name):
+    # Metadata placed in shared memory, see share_metadata.
+    shared_keys = ['all_images', 'all_pids', 'all_camids', 'all_labels', 'all_true_labels']
+
+    def __init__(self, style, path, transform, name, verbose=False, manifest=True):
         super(ImageDataset, self).__init__()
         # dataset parameters
         self.style = style
         self.path = path
         self.transform = transform
         self.name = name
+        self.verbose = verbose
+        self.manifest = manifest
+        # image decoder, see set_decoder
+        self.decoder = None
+        # tensor cache, see set_cache
+        self.cache = None
+        self.post_transform = None
         # dataset variables
         self.length = 0
         self.available_index = []
@@ -34,6 +219,8 @@ class ImageDataset(Dataset):
         self.all_camids = []
         self.all_labels = []
         self.all_true_labels = []
+        # shared memory of all variables
+        self.shared = {}
         # Initialize dataset.
         self.initialize_dataset()
 
@@ -41,36 +228,53 @@ class ImageDataset(Dataset):
         return self.length
 
     def load_item(self, item, style):
-        if style == 'market':
-            pattern = re.compile(r'([-\d]+)_c(\d)')
-        # Check item is a file.
-        allow_type = ['jpg', 'png']
-        if not item[-3:] in allow_type:
-            return None
-        pid, camid = map(int, pattern.search(item).groups())
-        if pid == -1 or pid == 0:
+        # Parse a single file name of a folder style.
+        images, pids, camids = parse_names([item])
+        if len(images) == 0:
             return None
-        return pid, camid
+        return pids[0], camids[0]
 
     def initialize_dataset(self):
-        # Load folder.
-        files = os.listdir(self.path)
-        files.sort()
-        for file in files:
-            results = self.load_item(file, self.style)
-            # Add item into dataset.
-            if results is not None:
-                self.all_images.append(file)
-                self.all_pids.append(results[0])
-                self.all_camids.append(results[1])
+        # Load folder from manifest, or scan it.
+        images, pids, camids = get_manifest(self.path, self.style, manifest=self.manifest)
+        self.all_images = np.asarray(images, dtype=str)
+        self.all_pids = np.asarray(pids, dtype=np.int64)
+        self.all_camids = np.asarray(camids, dtype=np.int64)
         self.all_length = len(self.all_images)
         _, labels = np.unique(self.all_pids, return_inverse=True)
-        self.all_labels = copy.deepcopy(labels)
-        self.all_true_labels = copy.deepcopy(labels)
+        self.all_labels = labels.astype(np.int64)
+        self.all_true_labels = labels.astype(np.int64)
+        self.share_metadata()
         # Create variables for calling.
         self.length = self.all_length
-        self.available_index = [i for i in range(self.all_length)]
+        self.available_index = np.arange(self.all_length)
         self.set_available()
+        if self.verbose:
+            self.summary_dataset()
+
+    def share_metadata(self):
+        # Numpy arrays in shared memory instead of Python lists: forked workers do not touch
+        # per-item refcounts (no copy-on-write), spawned workers attach to the same memory,
+        # and set_labels writes in place so running workers see new labels.
+        self.shared = {}
+        for key in self.shared_keys:
+            self.shared[key] = to_shared(getattr(self, key))
+        self.attach_metadata()
+
+    def attach_metadata(self):
+        for key, (tensor, dtype) in self.shared.items():
+            setattr(self, key, from_shared(tensor, dtype))
+
+    def __getstate__(self):
+        # Pickle only the shared tensors, torch sends their memory handles to workers.
+        state = self.__dict__.copy()
+        for key in self.shared:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach_metadata()
 
     def summary_dataset(self):
         print('=' * 25)
@@ -84,50 +288,124 @@ class ImageDataset(Dataset):
         print('=' * 25)
 
     def set_available(self, available_index=None):
+        # Workers keep the available index they started with, make a new loader after changing it.
         if available_index is not None:
-            self.available_index = available_index
+            self.available_index = np.asarray(available_index, dtype=np.int64)
             self.length = len(available_index)
-        self.images = [self.all_images[index]
-                       for index in self.available_index]
-        self.pids = [self.all_pids[index]
-                     for index in self.available_index]
-        self.camids = [self.all_camids[index]
-                       for index in self.available_index]
-        self.labels = [self.all_labels[index]
-                       for index in self.available_index]
-        self.true_labels = [self.all_true_labels[index]
-                            for index in self.available_index]
+        self.images = self.all_images[self.available_index]
+        self.pids = self.all_pids[self.available_index]
+        self.camids = self.all_camids[self.available_index]
+        self.labels = self.all_labels[self.available_index]
+        self.true_labels = self.all_true_labels[self.available_index]
 
     def set_labels(self, new_labels):
-        self.all_labels = new_labels
-        self.labels = [self.all_labels[index]
-                       for index in self.available_index]
-        
+        new_labels = np.asarray(new_labels, dtype=np.int64)
+        if new_labels.shape == self.all_labels.shape:
+            # In place, so workers attached to the shared memory see new labels.
+            self.all_labels[:] = new_labels
+        else:
+            self.all_labels = new_labels
+            self.shared['all_labels'] = to_shared(new_labels)
+            self.attach_metadata()
+        self.labels = self.all_labels[self.available_index]
+
     def get_labels(self):
         return self.labels
 
+    def set_decoder(self, decoder):
+        # Decode images with decoder (a data.decoder.Decoder) instead of a full PIL decode.
+        self.decoder = decoder
+
+    def set_cache(self, cache, transform, post_transform=None):
+        # Serve transform outputs from cache (indexed by all samples), post_transform runs on every read.
+        self.cache = cache
+        self.transform = transform
+        self.post_transform = post_transform
+
     def __getitem__(self, index):
-        file = self.images[index]
-        pid = self.pids[index]
-        camid = self.camids[index]
-        label = self.labels[index]
-        # Load image.
-        file_path = os.path.join(self.path, file)
-        image = Image.open(file_path)
-        # Convert image to tenser.
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        if self.transform is not None:
-            image = self.transform(image)
+        # Read through the shared arrays, labels set after workers started are seen here.
+        index = self.available_index[index]
+        file = self.all_images[index]
+        pid = self.all_pids[index]
+        camid = self.all_camids[index]
+        label = self.all_labels[index]
+        # Load image, decoded images are kept in the tensor cache if any.
+        image = None if self.cache is None else self.cache.get(index)
+        if image is None:
+            file_path = os.path.join(self.path, file)
+            image = Image.open(file_path) if self.decoder is None else self.decoder(file_path)
+            # Convert image to tenser.
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            if self.transform is not None:
+                image = self.transform(image)
+            if self.cache is not None:
+                self.cache.put(index, image)
+        if self.post_transform is not None:
+            image = self.post_transform(image)
         return image, label, pid, camid
 
 
+class ConcatReIDDataset(ImageDataset):
+    shared_keys = ImageDataset.shared_keys + ['all_domains']
+
+    def __init__(self, datasets, transform=None, name='Image Concat', verbose=False):
+        # Several ImageDatasets as one, each dataset is one domain.
+        self.datasets = datasets
+        # dataset variables
+        self.domains = []
+        # dataset all variables
+        self.all_domains = []
+        super(ConcatReIDDataset, self).__init__(
+            style=None, path=datasets[0].path, transform=datasets[0].transform if transform is None else transform,
+            name=name, verbose=verbose, manifest=False)
+
+    def initialize_dataset(self):
+        # Images keep their absolute folder, so one dataset reads every domain whatever its root.
+        self.all_images = np.asarray([os.path.abspath(os.path.join(dataset.path, image))
+                                      for dataset in self.datasets for image in dataset.all_images], dtype=str)
+        self.all_pids = np.concatenate([np.asarray(dataset.all_pids, dtype=np.int64) for dataset in self.datasets])
+        self.all_camids = np.concatenate([np.asarray(dataset.all_camids, dtype=np.int64)
+                                          for dataset in self.datasets])
+        self.all_domains = np.repeat(np.arange(len(self.datasets)), [dataset.all_length for dataset in self.datasets])
+        self.all_length = len(self.all_images)
+        # Global labels: one unique pass over (domain, pid) pairs, so equal pids of two domains stay apart.
+        pids = self.all_pids - self.all_pids.min()
+        _, labels = np.unique(self.all_domains * (pids.max() + 1) + pids, return_inverse=True)
+        self.all_labels = labels.astype(np.int64)
+        self.all_true_labels = labels.astype(np.int64)
+        self.share_metadata()
+        # Create variables for calling.
+        self.length = self.all_length
+        self.available_index = np.arange(self.all_length)
+        self.set_available()
+        if self.verbose:
+            self.summary_dataset()
+
+    def summary_dataset(self):
+        super(ConcatReIDDataset, self).summary_dataset()
+        for domain, dataset in enumerate(self.datasets):
+            print('Domain {}: {}, #image: {:7d}, #label: {:7d}'.format(
+                domain, dataset.name, int(np.sum(self.all_domains == domain)),
+                len(np.unique(self.all_labels[self.all_domains == domain]))))
+        print('=' * 25)
+
+    def set_available(self, available_index=None):
+        super(ConcatReIDDataset, self).set_available(available_index)
+        self.domains = self.all_domains[self.available_index]
+
+    def get_domains(self):
+        return self.domains
+
+
 class FeatureDataset(Dataset):
-    def __init__(self, origin_dataset, model, device, batch_size, norm, num_workers, pin_memory):
+    def __init__(self, origin_dataset, model, device, batch_size, norm, num_workers, pin_memory, reduction=None):
         super(FeatureDataset, self).__init__()
         # dataset parameters
         self.origin_dataset = origin_dataset
         self.model = model
+        # model.reduction.Reduction applied to features before norm, None to keep them
+        self.reduction = reduction
         self.device = device
         self.batch_size = batch_size
         self.norm = norm
@@ -156,6 +434,8 @@ class FeatureDataset(Dataset):
                     print('Batch: {}'.format(batch))
                 images = images.to(self.device)
                 features = self.model(images)
+                if self.reduction is not None:
+                    features = self.reduction(features)
                 if self.norm:
                     features = torch.nn.functional.normalize(
                         features, p=2, dim=1)
@@ -188,10 +468,41 @@ class FeatureDataset(Dataset):
         return feature, label, pid, camid
 
 
+class DistillDataset(Dataset):
+    def __init__(self, origin_dataset, teacher_features):
+        # Images of origin_dataset with the teacher features of all its samples (numpy, in all_* order).
+        super(DistillDataset, self).__init__()
+        assert len(teacher_features) == origin_dataset.all_length, 'Teacher features do not match the dataset.'
+        self.origin_dataset = origin_dataset
+        self.teacher_features = torch.from_numpy(np.ascontiguousarray(teacher_features)).share_memory_()
+
+    def __len__(self):
+        return self.origin_dataset.length
+
+    def summary_dataset(self):
+        self.origin_dataset.summary_dataset()
+
+    def set_available(self, available_index=None):
+        self.origin_dataset.set_available(available_index)
+
+    def set_labels(self, new_labels):
+        self.origin_dataset.set_labels(new_labels)
+
+    def get_labels(self):
+        return self.origin_dataset.labels
+
+    def __getitem__(self, index):
+        image, label, pid, camid = self.origin_dataset[index]
+        teacher_feature = self.teacher_features[self.origin_dataset.available_index[index]]
+        return image, teacher_feature, label, pid, camid
+
+
 if __name__ == '__main__':
     style = 'market'
     path = '../dataset/market/bounding_box_train'
     dateset = ImageDataset(style, path, None, 'Train')
     dateset.summary_dataset()
+    concat_dateset = ConcatReIDDataset([dateset, ImageDataset(style, '../dataset/duke/bounding_box_train', None,
+                                                                'Duke Train')], verbose=True)
     # for i in range(100, 120):
     #     print(dateset[i])
@@ -0,0 +1,89 @@
+import numpy as np
+from PIL import Image
+
+BACKENDS = ['pil', 'draft', 'turbojpeg', 'simplejpeg']
+JPEG_TYPES = ('.jpg', '.jpeg')
+
+
+def get_available_backends():
+    # Backends that can run here, SIMD decoders are optional packages.
+    available = ['pil', 'draft']
+    try:
+        from turbojpeg import TurboJPEG
+        TurboJPEG()
+        available.append('turbojpeg')
+    except (ImportError, RuntimeError, OSError):
+        pass
+    try:
+        import simplejpeg
+        available.append('simplejpeg')
+    except ImportError:
+        pass
+    return available
+
+
+class Decoder(object):
+    def __init__(self, backend='pil', size=None):
+        # backend in {pil, draft, turbojpeg, simplejpeg, auto}, size is the (height, width) images are resized to.
+        # Except pil, JPEGs are decoded at the smallest DCT scale (1/2, 1/4, 1/8) that is still
+        # at least size, so large crops are never decoded at full resolution.
+        # Other image types, or no size, fall back to a full PIL decode.
+        if backend == 'auto':
+            available = get_available_backends()
+            backend = 'simplejpeg' if 'simplejpeg' in available else 'turbojpeg' if 'turbojpeg' in available \
+                else 'draft'
+        if backend not in BACKENDS:
+            raise ValueError('Unknown decoder backend: {}'.format(backend))
+        self.backend = backend
+        self.size = size
+        self.turbo = None
+        if backend == 'turbojpeg':
+            self.get_turbo()
+        elif backend == 'simplejpeg':
+            try:
+                import simplejpeg
+            except ImportError:
+                raise ImportError('simplejpeg is needed for simplejpeg decoder: pip install simplejpeg')
+
+    def get_turbo(self):
+        # Each worker loads libjpeg-turbo itself.
+        if self.turbo is None:
+            try:
+                from turbojpeg import TurboJPEG
+            except ImportError:
+                raise ImportError('PyTurboJPEG is needed for turbojpeg decoder: pip install PyTurboJPEG')
+            self.turbo = TurboJPEG()
+        return self.turbo
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['turbo'] = None
+        return state
+
+    def __call__(self, path):
+        if self.backend == 'pil' or self.size is None or not path.lower().endswith(JPEG_TYPES):
+            return Image.open(path)
+        if self.backend == 'draft':
+            image = Image.open(path)
+            image.draft('RGB', (self.size[1], self.size[0]))
+            return image
+        with open(path, 'rb') as f:
+            data = f.read()
+        if self.backend == 'turbojpeg':
+            return Image.fromarray(self.decode_turbo(data))
+        import simplejpeg
+        return Image.fromarray(simplejpeg.decode_jpeg(
+            data, colorspace='RGB', min_height=self.size[0], min_width=self.size[1]))
+
+    def decode_turbo(self, data):
+        from turbojpeg import TJPF_RGB
+        turbo = self.get_turbo()
+        width, height, _, _ = turbo.decode_header(data)
+        # Largest reduction that keeps both sides at least size.
+        scale = (1, 1)
+        for factor in sorted(turbo.scaling_factors, key=lambda x: x[0] / x[1]):
+            if factor[0] / factor[1] <= 1 and height * factor[0] / factor[1] >= self.size[0] \
+                    and width * factor[0] / factor[1] >= self.size[1]:
+                scale = factor
+                break
+        return np.ascontiguousarray(turbo.decode(data, pixel_format=TJPF_RGB, scaling_factor=scale))
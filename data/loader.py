@@ -0,0 +1,38 @@
+from torch.utils.data import DataLoader
+
+
+class LoaderManager(object):
+    def __init__(self, num_workers, pin_memory, persistent=True):
+        # manager parameters
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.persistent = persistent and num_workers > 0
+        # manager variables
+        self.loaders = {}
+        self.iterators = {}
+
+    def get_loader(self, name, dataset, batch_size, sampler=None):
+        # Loaders are created once and keep their workers alive between epochs and steps.
+        # Samplers are iterated in the main process, so updating them in place (set_labels)
+        # takes effect at the next pass, and dataset labels reach workers through shared memory.
+        if name not in self.loaders:
+            self.loaders[name] = DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler,
+                                            num_workers=self.num_workers, pin_memory=self.pin_memory,
+                                            persistent_workers=self.persistent)
+        return self.loaders[name]
+
+    def prefetch(self, name):
+        # Start the next pass now, workers fill their queues while the main process is busy.
+        if name in self.loaders and name not in self.iterators:
+            self.iterators[name] = iter(self.loaders[name])
+
+    def discard(self, name):
+        # Prefetched batches are stale after the sampler or labels change.
+        self.iterators.pop(name, None)
+
+    def iterate(self, name):
+        # Iterator of the next pass, the prefetched one if any.
+        iterator = self.iterators.pop(name, None)
+        if iterator is None:
+            iterator = iter(self.loaders[name])
+        return iterator
@@ -7,56 +7,152 @@ from torch.utils.data.sampler import Sampler
 
 
 class TripletSampler(Sampler):
-    def __init__(self, labels, batch_size, p, k):
+    def __init__(self, labels, batch_size, p, k, seed=0):
         super(TripletSampler, self).__init__(None)
         self.labels = labels
         self.batch_size = batch_size
         self.p = p
         self.k = k
-        # print(len(self.labels))
-        # print(self.labels)
-        # Create label dict.
+        # Batches of an epoch only depend on seed, epoch and labels, not on the global random state.
+        self.seed = seed
+        self.epoch = 1
+        # Indexes of the next epoch to skip when resuming.
+        self.position = 0
+        self.final_idxs = []
+        self.set_labels(labels)
+
+    def set_labels(self, labels):
+        # Labels <= 0 (e.g. outliers of clustering) are skipped.
+        self.labels = labels
+        labels = np.asarray(labels)
+        # Create label dict by grouping sorted indexes.
+        index = np.argsort(labels, kind='stable')
+        label_list, starts, counts = np.unique(
+            labels[index], return_index=True, return_counts=True)
+        keep = label_list > 0
+        label_list, starts, counts = label_list[keep], starts[keep], counts[keep]
         self.label_dict = defaultdict(list)
-        for index in range(len(self.labels)):
-            if self.labels[index] > 0:
-                self.label_dict[self.labels[index]].append(index)
+        for label, start, count in zip(label_list, starts, counts):
+            self.label_dict[label] = index[start:start + count].tolist()
+        self.label_list = list(label_list)
         # Estimate number of examples in an epoch.
-        length = 0
-        self.label_list = list(np.unique(self.labels))
-        self.label_list = [label for label in self.label_list if label > 0]
-        for label in self.label_list:
-            num = len(self.label_dict[label])
-            if num < self.k:
-                num = self.k
-            length += num - num % self.k
-        self.length = length
+        counts = np.maximum(counts, self.k)
+        self.length = int(np.sum(counts - counts % self.k))
 
-    def __iter__(self):
+    def set_epoch(self, epoch):
+        # Epoch of the next pass, passes without set_epoch go on to the following epoch.
+        self.epoch = epoch
+
+    def state_dict(self, epoch=None, iteration=0):
+        # Resume point: epoch to generate next and its batches already trained. Workers prefetch
+        # indexes ahead of training, so the caller counts the trained batches.
+        return {'seed': self.seed, 'epoch': self.epoch if epoch is None else epoch,
+                'position': iteration * self.batch_size}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.position = state['position']
+
+    def get_generator(self):
+        return random.Random(self.seed * 1000003 + self.epoch)
+
+    def get_batch_idxs_dict(self, generator):
         # Make up mini batchs.
         batch_idxs_dict = defaultdict(list)
         for label in self.label_list:
             idxs = copy.deepcopy(self.label_dict[label])
             if len(idxs) < self.k:
-                idxs = np.random.choice(idxs, size=self.k, replace=True)
-            random.shuffle(idxs)
+                idxs = generator.choices(idxs, k=self.k)
+            generator.shuffle(idxs)
             batch_idxs = []
             for idx in idxs:
                 batch_idxs.append(idx)
                 if len(batch_idxs) == self.k:
                     batch_idxs_dict[label].append(batch_idxs)
                     batch_idxs = []
+        return batch_idxs_dict
+
+    def get_final_idxs(self, generator):
+        batch_idxs_dict = self.get_batch_idxs_dict(generator)
         # Make up available batchs.
         avai_labels = copy.deepcopy(self.label_list)
         final_idxs = []
         while len(avai_labels) >= self.p:
-            selected_labels = random.sample(avai_labels, self.p)
+            selected_labels = generator.sample(avai_labels, self.p)
             for label in selected_labels:
                 batch_idxs = batch_idxs_dict[label].pop(0)
                 final_idxs.extend(batch_idxs)
                 if len(batch_idxs_dict[label]) == 0:
                     avai_labels.remove(label)
+        return final_idxs
+
+    def __iter__(self):
+        final_idxs = self.get_final_idxs(self.get_generator())
         self.length = len(final_idxs)
-        return iter(final_idxs)
+        self.final_idxs = final_idxs
+        self.epoch += 1
+        # Skip batches trained before resuming, their images are never loaded.
+        position, self.position = self.position, 0
+        return iter(final_idxs[position:])
 
     def __len__(self):
         return self.length
+
+    def get_batch_indexes(self, iteration):
+        # Dataset indexes of the iteration-th (from 1) batch in the current epoch.
+        start = (iteration - 1) * self.batch_size
+        return self.final_idxs[start:start + self.batch_size]
+
+
+class DomainSampler(TripletSampler):
+    def __init__(self, labels, domains, batch_size, p, k, seed=0):
+        # P x K batches whose p labels are split evenly across domains.
+        self.domains = domains
+        super(DomainSampler, self).__init__(labels, batch_size, p, k, seed=seed)
+
+    def set_labels(self, labels):
+        super(DomainSampler, self).set_labels(labels)
+        # Domain of each label from its first sample.
+        domains = np.asarray(self.domains)
+        self.label_domain = {label: int(domains[self.label_dict[label][0]]) for label in self.label_list}
+        self.domain_list = sorted(set(self.label_domain.values()))
+
+    def get_final_idxs(self, generator):
+        batch_idxs_dict = self.get_batch_idxs_dict(generator)
+        # Make up available batchs, the epoch ends when a domain runs out of labels.
+        avai_labels = {domain: [] for domain in self.domain_list}
+        for label in self.label_list:
+            avai_labels[self.label_domain[label]].append(label)
+        num_domain = len(self.domain_list)
+        final_idxs = []
+        while num_domain > 0:
+            shares = {domain: self.p // num_domain for domain in self.domain_list}
+            for domain in generator.sample(self.domain_list, self.p % num_domain):
+                shares[domain] += 1
+            if any(len(avai_labels[domain]) < shares[domain] for domain in self.domain_list):
+                break
+            for domain in self.domain_list:
+                for label in generator.sample(avai_labels[domain], shares[domain]):
+                    batch_idxs = batch_idxs_dict[label].pop(0)
+                    final_idxs.extend(batch_idxs)
+                    if len(batch_idxs_dict[label]) == 0:
+                        avai_labels[domain].remove(label)
+        return final_idxs
+
+
+class IndexSampler(Sampler):
+    def __init__(self, indexes=()):
+        # Given dataset indexes in order, e.g. samples to extract again.
+        super(IndexSampler, self).__init__(None)
+        self.set_indexes(indexes)
+
+    def set_indexes(self, indexes):
+        # In place, so a loader made once reads the new indexes at its next pass.
+        self.indexes = [int(x) for x in indexes]
+
+    def __iter__(self):
+        return iter(self.indexes)
+
+    def __len__(self):
+        return len(self.indexes)
@@ -0,0 +1,99 @@
+import atexit
+import os
+
+import numpy as np
+import torch
+
+from data import transform
+
+
+class TensorCache(object):
+    def __init__(self, num_sample, shape, max_bytes, dtype='uint8', spill_path=''):
+        # Cache of deterministic eval tensors shared by all loader workers.
+        # dtype in {uint8, float16}: uint8 keeps resized images (normalized after reading),
+        # float16 keeps normalized tensors.
+        # Eval loaders read every sample in the same order each pass, where LRU eviction would miss on
+        # every read once the cache is full. So the first samples that fit in max_bytes stay in RAM,
+        # the others go to a memory-mapped spill file if spill_path is set, and are not cached otherwise.
+        self.num_sample = num_sample
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.spill_path = spill_path
+        self.torch_dtype = torch.uint8 if dtype == 'uint8' else torch.float16
+        self.numpy_dtype = np.uint8 if dtype == 'uint8' else np.float16
+        item_bytes = int(np.prod(self.shape)) * np.dtype(self.numpy_dtype).itemsize
+        self.num_ram = int(min(num_sample, max_bytes // item_bytes))
+        self.num_spill = num_sample - self.num_ram if spill_path != '' else 0
+        # Shared memory, written by whichever worker decodes a sample first.
+        self.ram = torch.empty((self.num_ram,) + self.shape, dtype=self.torch_dtype).share_memory_()
+        self.filled = torch.zeros(num_sample, dtype=torch.bool).share_memory_()
+        self.spill = None
+        # Only the cache that made the spill file removes it, workers hold pickled copies.
+        self.owner = os.getpid()
+        if self.num_spill > 0:
+            folder = os.path.dirname(spill_path)
+            if folder != '' and not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.spill = np.memmap(spill_path, dtype=self.numpy_dtype, mode='w+',
+                                   shape=(self.num_spill,) + self.shape)
+            atexit.register(self.close)
+
+    def close(self):
+        # Remove the spill file, the cache only serves this run. Called at exit on the cache that made it.
+        self.spill = None
+        if self.num_spill > 0 and self.owner == os.getpid() and os.path.isfile(self.spill_path):
+            os.remove(self.spill_path)
+
+    def get_spill(self):
+        # Workers open the spill file themselves, a pickled memmap would be a copy.
+        if self.spill is None and self.num_spill > 0:
+            self.spill = np.memmap(self.spill_path, dtype=self.numpy_dtype, mode='r+',
+                                   shape=(self.num_spill,) + self.shape)
+        return self.spill
+
+    def __getstate__(self):
+        # Copies (pickled or deep-copied) never own the spill file.
+        state = self.__dict__.copy()
+        state['spill'] = None
+        state['owner'] = None
+        return state
+
+    def get(self, index):
+        if not self.filled[index]:
+            return None
+        if index < self.num_ram:
+            image = self.ram[index].clone()
+        else:
+            image = torch.from_numpy(np.array(self.get_spill()[index - self.num_ram]))
+        return image if self.dtype == 'uint8' else image.float()
+
+    def put(self, index, image):
+        if index < self.num_ram:
+            self.ram[index].copy_(image)
+        elif index - self.num_ram < self.num_spill:
+            self.get_spill()[index - self.num_ram] = image.to(self.torch_dtype).numpy()
+        else:
+            return
+        self.filled[index] = True
+
+    def get_bytes(self):
+        return self.ram.numel() * self.ram.element_size()
+
+
+def attach_caches(datasets, size, max_bytes, dtype='uint8', spill_path=''):
+    # Give each dataset a cache, max_bytes is split by dataset sizes.
+    # Datasets with random transforms are left as they are.
+    total = max(1, sum(dataset.all_length for dataset in datasets))
+    caches = []
+    for dataset in datasets:
+        if not transform.is_deterministic(dataset.transform):
+            print('Skip tensor cache of {}: transform is not deterministic.'.format(dataset.name))
+            continue
+        cache_transform, post_transform = transform.get_cache_transform(size, dtype)
+        spill_file = '' if spill_path == '' else os.path.join(spill_path, '[cache]{}[{}].dat'.format(
+            dataset.name, os.getpid()))
+        cache = TensorCache(dataset.all_length, (3,) + tuple(size), max_bytes * dataset.all_length // total,
+                            dtype=dtype, spill_path=spill_file)
+        dataset.set_cache(cache, cache_transform, post_transform)
+        caches.append(cache)
+    return caches
@@ -1,6 +1,7 @@
 import math
 import random
 
+import torch
 from torchvision.transforms import Normalize, Compose, transforms
 
 
@@ -40,12 +41,114 @@ class RandomErasing(object):
         return img
 
 
-def get_transform(size, is_train, random_erasing=False):
+class BatchAugment(object):
+    """Train augmentation on a collated uint8 batch (b, c, h, w) with whole-tensor ops.
+        Key: same steps as get_transform(is_train=True), i.e. pad + random crop, horizontal flip,
+        normalize and random erasing, but without per-image Python work.
+        """
+
+    def __init__(self, padding=10, flip_probability=0.5, random_erasing=False, erasing_probability=0.5,
+                 sl=0.02, sh=0.4, r1=0.3, attempts=10, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.padding = padding
+        self.flip_probability = flip_probability
+        self.random_erasing = random_erasing
+        self.erasing_probability = erasing_probability
+        self.sl = sl
+        self.sh = sh
+        self.r1 = r1
+        self.attempts = attempts
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, images):
+        b, c, h, w = images.shape
+        device = images.device
+        batch_index = torch.arange(b, device=device)
+        # Pad + random crop + flip as one gather with per-image offsets.
+        padded = torch.nn.functional.pad(images, (self.padding,) * 4)
+        offset_y = torch.randint(0, 2 * self.padding + 1, (b, 1), device=device)
+        offset_x = torch.randint(0, 2 * self.padding + 1, (b, 1), device=device)
+        rows = offset_y + torch.arange(h, device=device)
+        cols = offset_x + torch.arange(w, device=device)
+        flip = torch.rand(b, device=device) < self.flip_probability
+        cols = torch.where(flip.unsqueeze(1), cols.flip(1), cols)
+        images = padded[batch_index.view(b, 1, 1, 1), torch.arange(c, device=device).view(1, c, 1, 1),
+                        rows.view(b, 1, h, 1), cols.view(b, 1, 1, w)]
+        # Fused ToTensor and normalize.
+        std = torch.tensor(self.std[:c], device=device).view(1, c, 1, 1)
+        mean = torch.tensor(self.mean[:c], device=device).view(1, c, 1, 1)
+        images = images.float() * (1. / 255. / std) - mean / std
+        if self.random_erasing:
+            images = self.erase(images)
+        return images
+
+    def erase(self, images):
+        # Sample several boxes per image at once and keep the first one that fits.
+        b, c, h, w = images.shape
+        device = images.device
+        area = h * w
+        target_area = torch.empty((b, self.attempts), device=device).uniform_(self.sl, self.sh) * area
+        aspect_ratio = torch.empty((b, self.attempts), device=device).uniform_(self.r1, 1 / self.r1)
+        erase_h = torch.sqrt(target_area * aspect_ratio).round().long()
+        erase_w = torch.sqrt(target_area / aspect_ratio).round().long()
+        valid = (erase_w < w) & (erase_h < h)
+        first = torch.argmax(valid.int(), dim=1, keepdim=True)
+        erase_h = erase_h.gather(1, first).squeeze(1)
+        erase_w = erase_w.gather(1, first).squeeze(1)
+        apply = valid.any(dim=1) & (torch.rand(b, device=device) < self.erasing_probability)
+        x1 = (torch.rand(b, device=device) * (h - erase_h + 1)).long()
+        y1 = (torch.rand(b, device=device) * (w - erase_w + 1)).long()
+        rows = torch.arange(h, device=device).view(1, h)
+        cols = torch.arange(w, device=device).view(1, w)
+        row_mask = (rows >= x1.view(b, 1)) & (rows < (x1 + erase_h).view(b, 1))
+        col_mask = (cols >= y1.view(b, 1)) & (cols < (y1 + erase_w).view(b, 1))
+        mask = row_mask.view(b, 1, h, 1) & col_mask.view(b, 1, 1, w) & apply.view(b, 1, 1, 1)
+        # Fill with mean values as RandomErasing does.
+        value = torch.tensor(self.mean[:c], device=device).view(1, c, 1, 1)
+        return torch.where(mask, value, images)
+
+
+class Normalize255(object):
+    """Normalize a uint8 image tensor (c, h, w), same result as ToTensor + Normalize."""
+
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+
+    def __call__(self, image):
+        c = image.shape[0]
+        return (image.float() / 255. - self.mean[:c]) / self.std[:c]
+
+
+RANDOM_TRANSFORMS = (transforms.RandomCrop, transforms.RandomHorizontalFlip, transforms.RandomResizedCrop,
+                     transforms.RandomApply, transforms.ColorJitter, RandomErasing)
+
+
+def is_deterministic(transform):
+    # Same image gives the same tensor, so its output can be cached.
+    if transform is None:
+        return True
+    items = transform.transforms if isinstance(transform, Compose) else [transform]
+    return not any(isinstance(item, RANDOM_TRANSFORMS) for item in items)
+
+
+def get_cache_transform(size, dtype='uint8'):
+    # (transform before the cache, transform after the cache) of eval images.
+    if dtype == 'uint8':
+        return Compose([transforms.Resize(size), transforms.PILToTensor()]), Normalize255()
+    return get_transform(size, is_train=False), None
+
+
+def get_transform(size, is_train, random_erasing=False, batch_augment=False):
     normalize = Normalize(mean=[0.485, 0.456, 0.406],
                           std=[0.229, 0.224, 0.225])
     # List transform items.
     transform_list = []
     transform_list.append(transforms.Resize(size))
+    if is_train and batch_augment:
+        # Keep uint8 images, the rest is done by BatchAugment on the batch.
+        transform_list.append(transforms.PILToTensor())
+        return Compose(transform_list)
     if is_train:
         transform_list.append(transforms.Pad(10))
         transform_list.append(transforms.RandomCrop(size))
@@ -0,0 +1,26 @@
+import torch
+from torch import nn
+
+
+class DistillLoss(nn.Module):
+    # Match student features to teacher features.
+    # feature: mean squared distance of the L2-normalized features, which is 2 - 2 * cosine.
+    # relation: mean squared difference of the batch cosine similarity matrices, so the student
+    # keeps the teacher's neighborhood structure even where single features are hard to match.
+    def __init__(self, feature_weight=1., relation_weight=1.):
+        super(DistillLoss, self).__init__()
+        self.feature_weight = feature_weight
+        self.relation_weight = relation_weight
+
+    def forward(self, student_features, teacher_features):
+        student_features = nn.functional.normalize(student_features, p=2, dim=1)
+        teacher_features = nn.functional.normalize(teacher_features, p=2, dim=1)
+        feature_loss = (student_features - teacher_features).pow(2).sum(dim=1).mean()
+        relation_loss = (student_features @ student_features.t()
+                         - teacher_features @ teacher_features.t()).pow(2).mean()
+        return feature_loss * self.feature_weight, relation_loss * self.relation_weight
+
+
+if __name__ == '__main__':
+    loss_function = DistillLoss()
+    print(loss_function(torch.randn((8, 16)), torch.randn((8, 16))))
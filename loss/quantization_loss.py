@@ -0,0 +1,16 @@
+import torch
+from torch import nn
+
+
+class QuantizationLoss(nn.Module):
+    # Pull relaxed codes in (-1, 1) to +-1, so training distances match the Hamming distances of the signs.
+    def __init__(self):
+        super(QuantizationLoss, self).__init__()
+
+    def forward(self, codes):
+        return (codes.abs() - 1).pow(2).mean()
+
+
+if __name__ == '__main__':
+    quantization_loss_function = QuantizationLoss()
+    print(quantization_loss_function(torch.tanh(torch.randn((4, 8)))))
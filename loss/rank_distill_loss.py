@@ -0,0 +1,30 @@
+import torch
+from torch import nn
+
+
+class RankDistillLoss(nn.Module):
+    # Match student batch distances to teacher batch distances.
+    # distance: mean squared difference of the distance matrices.
+    # rank: KL divergence of the per-anchor softmax over negative distances divided by temperature,
+    # so the student keeps the teacher's neighbor order where absolute distances differ.
+    def __init__(self, distance_weight=1., rank_weight=1., temperature=0.1):
+        super(RankDistillLoss, self).__init__()
+        self.distance_weight = distance_weight
+        self.rank_weight = rank_weight
+        self.temperature = temperature
+
+    def forward(self, student_distance, teacher_distance):
+        distance_loss = (student_distance - teacher_distance).pow(2).mean()
+        # Leave each anchor out of its own ranking, a large finite distance keeps gradients finite.
+        mask = torch.eye(student_distance.shape[0], dtype=torch.bool, device=student_distance.device)
+        student_log_prob = nn.functional.log_softmax(
+            -student_distance.masked_fill(mask, 1e4) / self.temperature, dim=1)
+        teacher_prob = nn.functional.softmax(
+            -teacher_distance.masked_fill(mask, 1e4) / self.temperature, dim=1)
+        rank_loss = (teacher_prob * (torch.log(teacher_prob.clamp(min=1e-12)) - student_log_prob)).sum(dim=1).mean()
+        return distance_loss * self.distance_weight, rank_loss * self.rank_weight
+
+
+if __name__ == '__main__':
+    loss_function = RankDistillLoss()
+    print(loss_function(torch.rand((8, 8)), torch.rand((8, 8))))
@@ -0,0 +1,24 @@
+import numpy as np
+from sklearn import metrics
+
+
+def cluster_score(true_labels, pred_labels):
+    """Score pseudo labels against true labels.
+        Key: outliers (label -1) count as one cluster for ARI and NMI, and are excluded from purity.
+        """
+    true_labels = np.asarray(true_labels)
+    pred_labels = np.asarray(pred_labels)
+    clustered = pred_labels >= 0
+    # Purity: fraction of clustered samples belonging to the majority identity of their cluster.
+    if np.any(clustered):
+        contingency = metrics.cluster.contingency_matrix(true_labels[clustered], pred_labels[clustered])
+        purity = contingency.max(axis=0).sum() / contingency.sum()
+    else:
+        purity = 0.
+    return {
+        'ari': metrics.adjusted_rand_score(true_labels, pred_labels),
+        'nmi': metrics.normalized_mutual_info_score(true_labels, pred_labels),
+        'purity': purity,
+        'num_cluster': len(np.unique(pred_labels[clustered])),
+        'num_outlier': int(np.sum(~clustered)),
+    }
@@ -0,0 +1,95 @@
+import numpy as np
+
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+
+def pack_codes(bits):
+    # Pack (N, B) binary codes into (N, ceil(B / 64)) uint64 words, padding bits are 0.
+    bits = np.asarray(bits, dtype=bool)
+    num_word = (bits.shape[1] + 63) // 64
+    padded = np.zeros((bits.shape[0], num_word * 64), dtype=bool)
+    padded[:, :bits.shape[1]] = bits
+    return np.ascontiguousarray(np.packbits(padded, axis=1)).view(np.uint64)
+
+
+def popcount(x):
+    # Set bits of each uint64, numpy >= 2.0 has a native popcount.
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    x = x - ((x >> np.uint64(1)) & M1)
+    x = (x & M2) + ((x >> np.uint64(2)) & M2)
+    x = (x + (x >> np.uint64(4))) & M4
+    return (x * H01) >> np.uint64(56)
+
+
+def hamming_distance(query_codes, gallery_codes, chunk_size=16384):
+    # (Q, N) Hamming distances between packed codes. XOR temporaries are Q x chunk_size words.
+    distance = np.empty((query_codes.shape[0], gallery_codes.shape[0]), dtype=np.uint16)
+    for start in range(0, gallery_codes.shape[0], chunk_size):
+        chunk = gallery_codes[start:start + chunk_size]
+        chunk_distance = np.zeros((query_codes.shape[0], chunk.shape[0]), dtype=np.uint16)
+        for word in range(query_codes.shape[1]):
+            chunk_distance += popcount(query_codes[:, word:word + 1] ^ chunk[:, word]).astype(np.uint16)
+        distance[:, start:start + chunk_size] = chunk_distance
+    return distance
+
+
+def hamming_search(query_codes, gallery_codes, num_candidate, chunk_size=16384):
+    # Indexes of the num_candidate nearest gallery codes of each query, nearest first.
+    # Gallery chunks are merged into the running candidates, peak memory is Q x (num_candidate + chunk_size).
+    num_candidate = min(num_candidate, gallery_codes.shape[0])
+    candidates = np.empty((query_codes.shape[0], 0), dtype=np.int64)
+    candidate_distance = np.empty((query_codes.shape[0], 0), dtype=np.uint16)
+    for start in range(0, gallery_codes.shape[0], chunk_size):
+        distance = hamming_distance(query_codes, gallery_codes[start:start + chunk_size], chunk_size=chunk_size)
+        index = np.broadcast_to(np.arange(start, start + distance.shape[1], dtype=np.int64), distance.shape)
+        candidates = np.concatenate([candidates, index], axis=1)
+        candidate_distance = np.concatenate([candidate_distance, distance], axis=1)
+        if candidates.shape[1] > num_candidate:
+            keep = np.argpartition(candidate_distance, num_candidate - 1, axis=1)[:, :num_candidate]
+            candidates = np.take_along_axis(candidates, keep, axis=1)
+            candidate_distance = np.take_along_axis(candidate_distance, keep, axis=1)
+    order = np.argsort(candidate_distance, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def rerank(query_features, gallery_features, candidates, top_k, gallery_square=None, chunk_size=4):
+    # Sort the candidates of each query by squared euclidean distance of the float features,
+    # only Q x C distances are computed. Returns the top_k indexes and distances.
+    # Candidate features are gathered chunk_size queries at a time, peak memory is chunk_size x C x D.
+    if gallery_square is None:
+        gallery_square = (gallery_features * gallery_features).sum(axis=1)
+    dot = np.empty(candidates.shape, dtype=np.result_type(query_features, gallery_features))
+    for start in range(0, candidates.shape[0], chunk_size):
+        dot[start:start + chunk_size] = np.einsum('qcd,qd->qc', gallery_features[candidates[start:start + chunk_size]],
+                                                  query_features[start:start + chunk_size])
+    distance = gallery_square[candidates] - 2 * dot + (query_features * query_features).sum(axis=1, keepdims=True)
+    top_k = min(top_k, candidates.shape[1])
+    order = np.argsort(distance, axis=1)[:, :top_k]
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(distance, order, axis=1)
+
+
+def search(query_codes, gallery_codes, query_features, gallery_features, num_candidate, top_k, batch_size=256):
+    # Two-stage search: Hamming filter to num_candidate, then float rerank to top_k, in query batches.
+    gallery_square = (gallery_features * gallery_features).sum(axis=1)
+    indexes = []
+    distances = []
+    for start in range(0, query_codes.shape[0], batch_size):
+        candidates = hamming_search(query_codes[start:start + batch_size], gallery_codes, num_candidate)
+        index, distance = rerank(query_features[start:start + batch_size], gallery_features, candidates, top_k,
+                                 gallery_square=gallery_square)
+        indexes.append(index)
+        distances.append(distance)
+    return np.concatenate(indexes, axis=0), np.concatenate(distances, axis=0)
+
+
+if __name__ == '__main__':
+    bits = np.random.rand(6, 100) > 0.5
+    codes = pack_codes(bits)
+    print(hamming_distance(codes, codes))
+    print((bits[:, None, :] != bits[None, :, :]).sum(axis=2))
+    features = np.random.randn(6, 8).astype(np.float32)
+    print(search(codes, codes, features, features, num_candidate=4, top_k=2))
@@ -42,8 +42,22 @@ def re_ranking(probFea, galFea, k1=20, k2=6, lambda_value=0.3, local_distmat=Non
         del feat
         if not local_distmat is None:
             original_dist = original_dist + local_distmat
-    gallery_num = original_dist.shape[0]
     original_dist = np.transpose(original_dist / np.max(original_dist, axis=0))
+    V = k_reciprocal_encoding(original_dist, k1=k1, k2=k2)
+    original_dist = original_dist[:query_num, ]
+    jaccard_dist = jaccard_distance(V, query_num)
+
+    final_dist = jaccard_dist * (1 - lambda_value) + original_dist * lambda_value
+    del original_dist
+    del V
+    del jaccard_dist
+    final_dist = final_dist[:query_num, query_num:]
+    return final_dist
+
+
+def k_reciprocal_encoding(original_dist, k1=20, k2=6):
+    # original_dist: normalized distance matrix among all samples (numpy)
+    all_num = original_dist.shape[0]
     V = np.zeros_like(original_dist).astype(np.float16)
     initial_rank = np.argsort(original_dist).astype(np.int32)
 
@@ -69,7 +83,6 @@ def re_ranking(probFea, galFea, k1=20, k2=6, lambda_value=0.3, local_distmat=Non
         k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
         weight = np.exp(-original_dist[i, k_reciprocal_expansion_index])
         V[i, k_reciprocal_expansion_index] = weight / np.sum(weight)
-    original_dist = original_dist[:query_num, ]
     if k2 != 1:
         V_qe = np.zeros_like(V, dtype=np.float16)
         for i in range(all_num):
@@ -77,11 +90,17 @@ def re_ranking(probFea, galFea, k1=20, k2=6, lambda_value=0.3, local_distmat=Non
         V = V_qe
         del V_qe
     del initial_rank
+    return V
+
+
+def jaccard_distance(V, query_num):
+    # Jaccard distance between the first query_num samples and all samples.
+    gallery_num = V.shape[0]
     invIndex = []
     for i in range(gallery_num):
         invIndex.append(np.where(V[:, i] != 0)[0])
 
-    jaccard_dist = np.zeros_like(original_dist, dtype=np.float16)
+    jaccard_dist = np.zeros((query_num, gallery_num), dtype=np.float16)
 
     for i in range(query_num):
         temp_min = np.zeros(shape=[1, gallery_num], dtype=np.float16)
@@ -91,11 +110,19 @@ def re_ranking(probFea, galFea, k1=20, k2=6, lambda_value=0.3, local_distmat=Non
             temp_min[0, indImages[j]] = temp_min[0, indImages[j]] + np.minimum(V[i, indNonZero[j]],
                                                                                V[indImages[j], indNonZero[j]])
         jaccard_dist[i] = 1 - temp_min / (2 - temp_min)
+    return jaccard_dist
 
-    final_dist = jaccard_dist * (1 - lambda_value) + original_dist * lambda_value
+
+def compute_jaccard_distance(features, k1=20, k2=6):
+    # Jaccard distance among one set of features (torch tensor), mainly for clustering.
+    all_num = features.size(0)
+    distmat = torch.pow(features, 2).sum(dim=1, keepdim=True).expand(all_num, all_num) + \
+              torch.pow(features, 2).sum(dim=1, keepdim=True).expand(all_num, all_num).t()
+    distmat.addmm_(features, features.t(), beta=1, alpha=-2)
+    original_dist = distmat.cpu().numpy()
+    del distmat
+    original_dist = np.transpose(original_dist / np.max(original_dist, axis=0))
+    V = k_reciprocal_encoding(original_dist, k1=k1, k2=k2)
     del original_dist
-    del V
-    del jaccard_dist
-    final_dist = final_dist[:query_num, query_num:]
-    return final_dist
+    return jaccard_distance(V, all_num)
 
@@ -3,6 +3,8 @@ import math
 import torch
 from torch import nn
 
+from model import recompute
+
 
 def weights_init_kaiming(m):
     classname = m.__class__.__name__
@@ -119,6 +121,8 @@ class ResNet(nn.Module):
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
         self.layer4 = self._make_layer(
             block, 512, layers[3], stride=last_stride)
+        # Stages recomputed in backward, see model.recompute.
+        self.recompute_stages = set()
 
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
@@ -143,10 +147,10 @@ class ResNet(nn.Module):
         # x = self.relu(x)    # add missed relu
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = recompute.run_stage(self.layer1, x, 'layer1' in self.recompute_stages)
+        x = recompute.run_stage(self.layer2, x, 'layer2' in self.recompute_stages)
+        x = recompute.run_stage(self.layer3, x, 'layer3' in self.recompute_stages)
+        x = recompute.run_stage(self.layer4, x, 'layer4' in self.recompute_stages)
 
         return x
 
@@ -168,11 +172,14 @@ class ResNet(nn.Module):
 
 
 class Non_local(nn.Module):
-    def __init__(self, in_channels, reduc_ratio=2):
+    def __init__(self, in_channels, reduc_ratio=2, inter_channels=None, efficient=True):
         super(Non_local, self).__init__()
 
         self.in_channels = in_channels
-        self.inter_channels = reduc_ratio//reduc_ratio
+        # inter_channels is 1 by default, as in the released AGW checkpoints.
+        self.inter_channels = reduc_ratio//reduc_ratio if inter_channels is None else inter_channels
+        # Efficient: theta @ (phi @ g) / N, never forms the (HW, HW) affinity.
+        self.efficient = efficient
 
         self.g = nn.Conv2d(in_channels=self.in_channels, out_channels=self.inter_channels,
                       kernel_size=1, stride=1, padding=0)
@@ -203,11 +210,16 @@ class Non_local(nn.Module):
         theta_x = self.theta(x).view(batch_size, self.inter_channels, -1)
         theta_x = theta_x.permute(0, 2, 1)
         phi_x = self.phi(x).view(batch_size, self.inter_channels, -1)
-        f = torch.matmul(theta_x, phi_x)
-        N = f.size(-1)
-        f_div_C = f / N
+        N = phi_x.size(-1)
+        if self.efficient:
+            # The dot-product affinity f / N is linear, so (theta @ phi) @ g == theta @ (phi @ g):
+            # (c, c) intermediate instead of (HW, HW).
+            y = torch.matmul(theta_x, torch.matmul(phi_x, g_x) / N)
+        else:
+            f = torch.matmul(theta_x, phi_x)
+            f_div_C = f / N
 
-        y = torch.matmul(f_div_C, g_x)
+            y = torch.matmul(f_div_C, g_x)
         y = y.permute(0, 2, 1).contiguous()
         y = y.view(batch_size, self.inter_channels, *x.size()[2:])
         W_y = self.W(y)
@@ -216,7 +228,8 @@ class Non_local(nn.Module):
 
 
 class ResNetNL(nn.Module):
-    def __init__(self, last_stride=2, block=Bottleneck, layers=[3, 4, 6, 3], non_layers=[0, 2, 3, 0]):
+    def __init__(self, last_stride=2, block=Bottleneck, layers=[3, 4, 6, 3], non_layers=[0, 2, 3, 0],
+                 non_local_channels=None):
         self.inplanes = 64
         super().__init__()
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
@@ -231,21 +244,23 @@ class ResNetNL(nn.Module):
             block, 512, layers[3], stride=last_stride)
 
         self.NL_1 = nn.ModuleList(
-            [Non_local(256) for i in range(non_layers[0])])
+            [Non_local(256, inter_channels=non_local_channels) for i in range(non_layers[0])])
         self.NL_1_idx = sorted([layers[0] - (i + 1)
                                 for i in range(non_layers[0])])
         self.NL_2 = nn.ModuleList(
-            [Non_local(512) for i in range(non_layers[1])])
+            [Non_local(512, inter_channels=non_local_channels) for i in range(non_layers[1])])
         self.NL_2_idx = sorted([layers[1] - (i + 1)
                                 for i in range(non_layers[1])])
         self.NL_3 = nn.ModuleList(
-            [Non_local(1024) for i in range(non_layers[2])])
+            [Non_local(1024, inter_channels=non_local_channels) for i in range(non_layers[2])])
         self.NL_3_idx = sorted([layers[2] - (i + 1)
                                 for i in range(non_layers[2])])
         self.NL_4 = nn.ModuleList(
-            [Non_local(2048) for i in range(non_layers[3])])
+            [Non_local(2048, inter_channels=non_local_channels) for i in range(non_layers[3])])
         self.NL_4_idx = sorted([layers[3] - (i + 1)
                                 for i in range(non_layers[3])])
+        # Stages whose blocks and non-local blocks are recomputed in backward, see model.recompute.
+        self.recompute_stages = set()
 
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
@@ -264,51 +279,29 @@ class ResNetNL(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def forward_stage(self, x, stage):
+        # Blocks of stage (layer1 to layer4), each followed by its non-local block if it has one.
+        layer = getattr(self, stage)
+        non_local = getattr(self, 'NL_' + stage[-1])
+        non_local_idx = getattr(self, 'NL_' + stage[-1] + '_idx')
+        counter = 0
+        for i in range(len(layer)):
+            x = layer[i](x)
+            if counter < len(non_local_idx) and i == non_local_idx[counter]:
+                x = non_local[counter](x)
+                counter += 1
+        return x
+
     def forward(self, x):
         x = self.conv1(x)
         x = self.bn1(x)
         # x = self.relu(x)    # add missed relu
         x = self.maxpool(x)
 
-        NL1_counter = 0
-        if len(self.NL_1_idx) == 0:
-            self.NL_1_idx = [-1]
-        for i in range(len(self.layer1)):
-            x = self.layer1[i](x)
-            if i == self.NL_1_idx[NL1_counter]:
-                _, C, H, W = x.shape
-                x = self.NL_1[NL1_counter](x)
-                NL1_counter += 1
-        # Layer 2
-        NL2_counter = 0
-        if len(self.NL_2_idx) == 0:
-            self.NL_2_idx = [-1]
-        for i in range(len(self.layer2)):
-            x = self.layer2[i](x)
-            if i == self.NL_2_idx[NL2_counter]:
-                _, C, H, W = x.shape
-                x = self.NL_2[NL2_counter](x)
-                NL2_counter += 1
-        # Layer 3
-        NL3_counter = 0
-        if len(self.NL_3_idx) == 0:
-            self.NL_3_idx = [-1]
-        for i in range(len(self.layer3)):
-            x = self.layer3[i](x)
-            if i == self.NL_3_idx[NL3_counter]:
-                _, C, H, W = x.shape
-                x = self.NL_3[NL3_counter](x)
-                NL3_counter += 1
-        # Layer 4
-        NL4_counter = 0
-        if len(self.NL_4_idx) == 0:
-            self.NL_4_idx = [-1]
-        for i in range(len(self.layer4)):
-            x = self.layer4[i](x)
-            if i == self.NL_4_idx[NL4_counter]:
-                _, C, H, W = x.shape
-                x = self.NL_4[NL4_counter](x)
-                NL4_counter += 1
+        for stage in recompute.STAGES:
+            # A stage and its non-local blocks run as one segment, recomputed together in backward.
+            x = recompute.run_stage(recompute.get_stage_modules(self, stage), x, stage in self.recompute_stages,
+                                    forward=lambda x, stage=stage: self.forward_stage(x, stage))
 
         return x
 
@@ -372,7 +365,8 @@ class GeneralizedMeanPoolingP(GeneralizedMeanPooling):
 class Baseline(nn.Module):
     in_planes = 2048
 
-    def __init__(self, last_stride=1, model_path='../resnet50-0676ba61.pth', model_name='resnet50_nl', gem_pool='on', pretrain_choice='imagenet'):
+    def __init__(self, last_stride=1, model_path='../resnet50-0676ba61.pth', model_name='resnet50_nl', gem_pool='on', pretrain_choice='imagenet',
+                 non_local_channels=None):
         super(Baseline, self).__init__()
         if model_name == 'resnet50':
             self.base = ResNet(last_stride=last_stride,
@@ -382,7 +376,8 @@ class Baseline(nn.Module):
             self.base = ResNetNL(last_stride=last_stride,
                                  block=Bottleneck,
                                  layers=[3, 4, 6, 3],
-                                 non_layers=[0, 2, 3, 0])
+                                 non_layers=[0, 2, 3, 0],
+                                 non_local_channels=non_local_channels)
         # elif model_name == 'resnet101':
         #     self.base = ResNet(last_stride=last_stride,
         #                        block=Bottleneck,
@@ -3,6 +3,8 @@ import math
 import torch
 from torch import nn
 
+from model import recompute
+
 
 def weights_init_kaiming(m):
     classname = m.__class__.__name__
@@ -118,6 +120,8 @@ class ResNet(nn.Module):
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
         self.layer4 = self._make_layer(
             block, 512, layers[3], stride=last_stride)
+        # Stages recomputed in backward, see model.recompute.
+        self.recompute_stages = set()
 
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
@@ -142,10 +146,10 @@ class ResNet(nn.Module):
         # x = self.relu(x)    # add missed relu
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = recompute.run_stage(self.layer1, x, 'layer1' in self.recompute_stages)
+        x = recompute.run_stage(self.layer2, x, 'layer2' in self.recompute_stages)
+        x = recompute.run_stage(self.layer3, x, 'layer3' in self.recompute_stages)
+        x = recompute.run_stage(self.layer4, x, 'layer4' in self.recompute_stages)
 
         return x
 
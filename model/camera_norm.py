@@ -0,0 +1,100 @@
+import torch
+from torch import nn
+
+
+MODES = ['mean', 'std']
+
+
+class CameraNorm(nn.Module):
+    def __init__(self, num_feature, num_camera=16, mode='mean', eps=1e-6):
+        super(CameraNorm, self).__init__()
+        self.num_feature = num_feature
+        # mode in {mean, std}: remove per-camera mean, or also whiten each dimension per camera.
+        # Saved with the statistics, a loaded checkpoint keeps the mode it was fitted for.
+        self.mode = mode
+        self.eps = eps
+        self.register_buffer('mode_index', torch.tensor(MODES.index(mode)))
+        # Buffers are sized by num_camera, grown by fit to the largest camid and set by checkpoints.
+        self.set_num_camera(num_camera)
+
+    def set_num_camera(self, num_camera, device=None):
+        self.num_camera = num_camera
+        # Streaming statistics.
+        self.register_buffer('count', torch.zeros(num_camera, dtype=torch.float64, device=device))
+        self.register_buffer('sum', torch.zeros((num_camera, self.num_feature), dtype=torch.float64, device=device))
+        self.register_buffer('square_sum', torch.zeros((num_camera, self.num_feature), dtype=torch.float64,
+                                                       device=device))
+        # Fitted transform.
+        self.register_buffer('mean', torch.zeros((num_camera, self.num_feature), device=device))
+        self.register_buffer('std', torch.ones((num_camera, self.num_feature), device=device))
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # Take camera count and mode of the checkpoint, checkpoints without a mode keep the current one.
+        if prefix + 'count' in state_dict:
+            self.set_num_camera(state_dict[prefix + 'count'].shape[0], device=self.count.device)
+        if prefix + 'mode_index' in state_dict:
+            self.mode = MODES[int(state_dict[prefix + 'mode_index'])]
+        super(CameraNorm, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        if prefix + 'mode_index' in missing_keys:
+            missing_keys.remove(prefix + 'mode_index')
+
+    def reset(self):
+        self.count.zero_()
+        self.sum.zero_()
+        self.square_sum.zero_()
+
+    def update(self, features, camids):
+        # Accumulate statistics of one batch.
+        with torch.no_grad():
+            features = features.detach().to(self.sum.device, dtype=torch.float64)
+            camids = torch.as_tensor(camids, dtype=torch.long, device=self.sum.device)
+            self.count.index_add_(0, camids, torch.ones_like(camids, dtype=torch.float64))
+            self.sum.index_add_(0, camids, features)
+            self.square_sum.index_add_(0, camids, features * features)
+
+    def finalize(self):
+        # Cameras without enough samples use the statistics of all cameras.
+        with torch.no_grad():
+            all_count = self.count.sum().clamp(min=1)
+            all_mean = self.sum.sum(dim=0) / all_count
+            all_var = self.square_sum.sum(dim=0) / all_count - all_mean * all_mean
+            count = self.count.clamp(min=1).unsqueeze(1)
+            mean = self.sum / count
+            var = self.square_sum / count - mean * mean
+            valid = (self.count > 1).unsqueeze(1)
+            mean = torch.where(valid, mean, all_mean.expand_as(mean))
+            var = torch.where(valid, var, all_var.expand_as(var))
+            self.mean.copy_(mean)
+            self.std.copy_(var.clamp(min=0).sqrt() + self.eps)
+
+    def fit(self, features, camids, batch_size=4096):
+        # One streaming pass over features (tensor) and camids.
+        camids = torch.as_tensor(camids, dtype=torch.long)
+        if int(camids.max()) + 1 > self.num_camera:
+            self.set_num_camera(int(camids.max()) + 1, device=self.count.device)
+        self.reset()
+        for start in range(0, features.shape[0], batch_size):
+            self.update(features[start:start + batch_size], camids[start:start + batch_size])
+        self.finalize()
+
+    def forward(self, features, camids):
+        camids = torch.as_tensor(camids, dtype=torch.long, device=features.device)
+        features = features - self.mean[camids]
+        if self.mode == 'std':
+            features = features / self.std[camids]
+        return features
+
+
+if __name__ == '__main__':
+    features = torch.Tensor([[1, 2], [3, 4], [5, 6], [7, 9]])
+    camids = [1, 1, 2, 2]
+    camera_norm = CameraNorm(num_feature=2, num_camera=4, mode='std')
+    camera_norm.fit(features, camids, batch_size=3)
+    print(camera_norm(features, camids))
+    camids = [1, 1, 20, 20]
+    camera_norm.fit(features, camids)
+    loaded = CameraNorm(num_feature=2, mode='mean')
+    loaded.load_state_dict(camera_norm.state_dict())
+    print(loaded.num_camera, loaded.mode, loaded(features, camids))
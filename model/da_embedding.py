@@ -0,0 +1,29 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+class DAEmbedding(nn.Module):
+    # Per-image embedding trained to reproduce Diff Attention distances. The attention of
+    # DiffAttentionModule is computed from the image alone, so embeddings compare with a plain
+    # distance and can be indexed. dim != num_feature adds a linear projection.
+    def __init__(self, num_feature, dim, diff_ratio=4):
+        super(DAEmbedding, self).__init__()
+        self.num_feature = num_feature
+        self.dim = dim
+        self.fc1 = nn.Linear(num_feature, num_feature // diff_ratio, bias=False)
+        self.fc2 = nn.Linear(num_feature // diff_ratio, num_feature, bias=False)
+        self.projection = None
+        if dim != num_feature:
+            self.projection = nn.Linear(num_feature, dim, bias=False)
+
+    def forward(self, features):
+        embeddings = features * torch.sigmoid(self.fc2(F.relu(self.fc1(features))))
+        if self.projection is not None:
+            embeddings = self.projection(embeddings)
+        return embeddings
+
+
+if __name__ == '__main__':
+    model = DAEmbedding(num_feature=2048, dim=512)
+    print(model(torch.randn((8, 2048))).shape)
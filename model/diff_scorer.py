@@ -0,0 +1,98 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+
+class DiffAttentionScorer(nn.Module):
+    # Feature model and Diff Attention Module as one inference module. The conv1/fc1 terms of
+    # DiffAttentionModule that depend on a single image are projected once per image, so scoring a
+    # pair only adds them and runs fc2 (and fc1 on the diff for abs/square in_transform).
+    def __init__(self, base_model, diff_model):
+        super(DiffAttentionScorer, self).__init__()
+        self.base_model = base_model
+        self.diff_model = diff_model
+
+    def get_terms(self):
+        # fc1(conv1(stack(t(x - y), x, y))) = c_diff * fc1(t(x - y)) + c_x * fc1(x) + c_y * fc1(y) + bias,
+        # with a linear diff folded into c_x and c_y.
+        diff_model = self.diff_model
+        if diff_model.aggregate:
+            weight = diff_model.conv1.weight.view(-1)
+            c_diff, c_x, c_y = weight[0], weight[1], weight[2]
+            bias = diff_model.conv1.bias[0] * diff_model.fc1.weight.sum(dim=1)
+        else:
+            c_diff, c_x, c_y = 1., 0., 0.
+            bias = 0.
+        if diff_model.in_transform in ['abs', 'square']:
+            return c_diff, c_x, c_y, bias
+        return 0., c_x + c_diff, c_y - c_diff, bias
+
+    def project(self, features):
+        # Per-image partial projection fc1(features), cached next to the features.
+        return self.diff_model.fc1(features)
+
+    def forward(self, images):
+        # Features and projections at embedding time.
+        features = self.base_model(images)
+        return features, self.project(features)
+
+    def score(self, x, x_projection, y, y_projection, norm=True):
+        # Distances of broadcast pairs of x and y (features on the last dimension) weighted by their
+        # Diff Attention, as pairwise_distance of diff_model(x, y, keep_dim=True) outputs.
+        diff_model = self.diff_model
+        c_diff, c_x, c_y, bias = self.get_terms()
+        hidden = c_x * x_projection + c_y * y_projection + bias
+        if diff_model.in_transform in ['abs', 'square']:
+            diff = x - y
+            diff = torch.abs(diff) if diff_model.in_transform == 'abs' else torch.square(diff)
+            hidden = hidden + c_diff * diff_model.fc1(diff)
+        diff_attention = diff_model.fc2(F.relu(hidden))
+        if diff_model.out_transform == 'sigmoid':
+            diff_attention = torch.sigmoid(diff_attention)
+        x_feature = x * diff_attention
+        y_feature = y * diff_attention
+        if norm:
+            x_feature = F.normalize(x_feature, p=2, dim=-1)
+            y_feature = F.normalize(y_feature, p=2, dim=-1)
+        shape = diff_attention.shape
+        distance = F.pairwise_distance(x_feature.reshape(-1, shape[-1]), y_feature.reshape(-1, shape[-1]))
+        return distance.view(shape[:-1])
+
+    def distance(self, x, x_projection, y, y_projection, norm=True):
+        # (m, n) distances between the m features x and the n features y.
+        return self.score(x.unsqueeze(1), x_projection.unsqueeze(1), y.unsqueeze(0), y_projection.unsqueeze(0),
+                          norm=norm)
+
+    def rerank(self, distance, x, x_projection, y, y_projection, top_k, norm=True):
+        # Order the top_k of each row of the (m, n) distance by Diff Attention distance, ahead of the
+        # rest of the row, which keeps its order.
+        top_k = min(top_k, distance.shape[1])
+        index = torch.topk(distance, top_k, dim=1, largest=False).indices
+        top_distance = self.score(x.unsqueeze(1), x_projection.unsqueeze(1), y[index], y_projection[index],
+                                  norm=norm)
+        offset = top_distance.amax(dim=1, keepdim=True) + 1
+        return (distance + offset).scatter(1, index, top_distance)
+
+
+if __name__ == '__main__':
+    import time
+    from model import diff_attention
+
+    x = torch.randn((64, 2048))
+    y = torch.randn((128, 2048))
+    for in_transform in ['no', 'abs']:
+        for aggregate in [True, False]:
+            diff_model = diff_attention.DiffAttentionModule(
+                num_feature=2048, in_transform=in_transform, diff_ratio=4, out_transform='sigmoid',
+                aggregate=aggregate).eval()
+            scorer = DiffAttentionScorer(nn.Identity(), diff_model).eval()
+            with torch.no_grad():
+                time_start = time.time()
+                new_x, new_y = diff_model(x.repeat_interleave(128, dim=0), y.repeat(64, 1), keep_dim=True)
+                expected = F.pairwise_distance(F.normalize(new_x, p=2, dim=1), F.normalize(new_y, p=2, dim=1))
+                pair_time = time.time() - time_start
+                time_start = time.time()
+                distance = scorer.distance(x, scorer.project(x), y, scorer.project(y))
+                scorer_time = time.time() - time_start
+            print(in_transform, aggregate, (distance.view(-1) - expected).abs().max().item(),
+                  '{:.3f}s / {:.3f}s'.format(pair_time, scorer_time))
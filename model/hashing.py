@@ -0,0 +1,30 @@
+import torch
+from torch import nn
+
+from model.bag_tricks import weights_init_kaiming
+
+
+class HashHead(nn.Module):
+    def __init__(self, num_feature, num_bit=128):
+        super(HashHead, self).__init__()
+        self.num_feature = num_feature
+        self.num_bit = num_bit
+        self.fc = nn.Linear(num_feature, num_bit)
+        # Zero-mean bits, so each bit splits the data about in half.
+        self.bn = nn.BatchNorm1d(num_bit)
+        self.apply(weights_init_kaiming)
+
+    def forward(self, features):
+        # Relaxed codes in (-1, 1) for training.
+        return torch.tanh(self.bn(self.fc(features)))
+
+    def encode(self, features):
+        # Binary codes (bool) of features, see metric.hamming.pack_codes.
+        return self.bn(self.fc(features)) > 0
+
+
+if __name__ == '__main__':
+    hash_head = HashHead(num_feature=16, num_bit=64)
+    hash_head.eval()
+    features = torch.randn((4, 16))
+    print(hash_head(features).shape, hash_head.encode(features).sum(dim=1))
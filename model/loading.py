@@ -0,0 +1,58 @@
+import pickle
+
+import torch
+from torch import nn
+
+from model import prune
+
+
+def load_checkpoint(path):
+    # Memory-map checkpoint tensors, pages are read only when copied to the model device.
+    # Legacy (non-zip) files, whole pickled models and torch < 2.1 load fully.
+    try:
+        state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, pickle.UnpicklingError):
+        state_dict = torch.load(path, map_location='cpu')
+    if isinstance(state_dict, nn.Module):
+        state_dict = state_dict.state_dict()
+    return state_dict
+
+
+def build_model(build, path, device=None):
+    # Model made by build (a function, e.g. lambda: agw.Baseline(pretrain_choice='self')) with the
+    # weights of the checkpoint at path. Parameters are first created on the meta device, so neither
+    # memory nor random initialization is spent on tensors the checkpoint replaces, then the checkpoint
+    # tensors are assigned as they are. Pruned checkpoints resize the model first (prune.fit_state_dict).
+    # build should not load pretrained weights itself, so a checkpoint path is required.
+    if path == '':
+        raise ValueError('build_model needs a checkpoint path, an empty path would leave random weights.')
+    state_dict = load_checkpoint(path)
+    try:
+        with torch.device('meta'):
+            model = build()
+            prune.fit_state_dict(model, state_dict)
+        model.load_state_dict(state_dict, assign=True)
+    except (AttributeError, TypeError):
+        # torch < 2.1: no device context or assign, build and copy.
+        model = build()
+        prune.fit_state_dict(model, state_dict)
+        model.load_state_dict(state_dict)
+    return model.to(device)
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    import time
+    from model import bag_tricks
+
+    path = os.path.join(tempfile.mkdtemp(), 'bag.pth')
+    torch.save(bag_tricks.Baseline(pretrain_choice='self').state_dict(), path)
+    build = lambda: bag_tricks.Baseline(pretrain_choice='self')
+    time_start = time.time()
+    model = build()
+    model.load_state_dict(torch.load(path))
+    print('build and copy: {:.2f}s'.format(time.time() - time_start))
+    time_start = time.time()
+    model = build_model(build, path)
+    print('meta and assign: {:.2f}s'.format(time.time() - time_start))
@@ -0,0 +1,142 @@
+import torch
+from torch import nn
+
+from model import agw, bag_tricks
+
+BOTTLENECKS = (bag_tricks.Bottleneck, agw.Bottleneck)
+
+
+def get_bottlenecks(model):
+    return [(name, module) for name, module in model.named_modules() if isinstance(module, BOTTLENECKS)]
+
+
+def new_conv(conv, in_index=None, out_index=None):
+    # Copy of conv keeping the in_index input and out_index output channels, None keeps all.
+    weight = conv.weight.data
+    if out_index is not None:
+        weight = weight[out_index]
+    if in_index is not None:
+        weight = weight[:, in_index]
+    new = nn.Conv2d(weight.shape[1], weight.shape[0], kernel_size=conv.kernel_size, stride=conv.stride,
+                    padding=conv.padding, bias=False).to(weight.device)
+    new.weight.data.copy_(weight)
+    return new
+
+
+def new_bn(bn, index):
+    new = nn.BatchNorm2d(len(index), eps=bn.eps, momentum=bn.momentum).to(bn.weight.device)
+    new.weight.data.copy_(bn.weight.data[index])
+    new.bias.data.copy_(bn.bias.data[index])
+    new.running_mean.copy_(bn.running_mean[index])
+    new.running_var.copy_(bn.running_var[index])
+    return new
+
+
+def compensate(bn, conv, next_bn, removed):
+    # A removed channel with a small gamma still outputs about relu(beta), a constant map.
+    # Its contribution through conv is constant too (away from the zero padded border),
+    # fold it into the running mean of next_bn so eval outputs barely move.
+    if len(removed) == 0:
+        return
+    constant = torch.relu(bn.bias.data[removed])
+    shift = (conv.weight.data[:, removed].sum(dim=(2, 3)) * constant).sum(dim=1)
+    next_bn.running_mean.sub_(shift)
+
+
+def prune_block(block, keep1, keep2):
+    # Remove the conv1/bn1 and conv2/bn2 output channels not in keep1/keep2.
+    # Block input and output widths do not change, so the residual and downsample paths stay valid.
+    kept1, kept2 = set(keep1), set(keep2)
+    keep1 = torch.as_tensor(sorted(kept1), dtype=torch.long, device=block.bn1.weight.device)
+    keep2 = torch.as_tensor(sorted(kept2), dtype=torch.long, device=block.bn2.weight.device)
+    removed1 = [c for c in range(block.bn1.num_features) if c not in kept1]
+    removed2 = [c for c in range(block.bn2.num_features) if c not in kept2]
+    compensate(block.bn1, block.conv2, block.bn2, removed1)
+    compensate(block.bn2, block.conv3, block.bn3, removed2)
+    block.conv1 = new_conv(block.conv1, out_index=keep1)
+    block.bn1 = new_bn(block.bn1, keep1)
+    block.conv2 = new_conv(block.conv2, in_index=keep1, out_index=keep2)
+    block.bn2 = new_bn(block.bn2, keep2)
+    block.conv3 = new_conv(block.conv3, in_index=keep2)
+
+
+def select_channels(model, ratio, min_channels=8):
+    # Rank bn1/bn2 channels of all bottlenecks by |gamma| with one global threshold (network slimming),
+    # so layers with many unimportant channels lose more. Each layer keeps at least min_channels.
+    gammas = []
+    for _, block in get_bottlenecks(model):
+        gammas.append(block.bn1.weight.data.abs().flatten())
+        gammas.append(block.bn2.weight.data.abs().flatten())
+    gammas = torch.cat(gammas)
+    num_prune = int(len(gammas) * ratio)
+    threshold = torch.sort(gammas)[0][num_prune] if num_prune < len(gammas) else float('inf')
+    keeps = {}
+    for name, block in get_bottlenecks(model):
+        keep = []
+        for bn in [block.bn1, block.bn2]:
+            gamma = bn.weight.data.abs()
+            index = torch.nonzero(gamma >= threshold).flatten()
+            if len(index) < min(min_channels, len(gamma)):
+                index = torch.argsort(gamma, descending=True)[:min(min_channels, len(gamma))]
+            keep.append(index.tolist())
+        keeps[name] = keep
+    return keeps
+
+
+def prune_model(model, ratio, min_channels=8):
+    # Prune ratio of the bottleneck inner channels in place, returns {block: (planes1, planes2)}.
+    keeps = select_channels(model, ratio, min_channels=min_channels)
+    blocks = dict(get_bottlenecks(model))
+    for name, (keep1, keep2) in keeps.items():
+        prune_block(blocks[name], keep1, keep2)
+    return {name: (len(keep1), len(keep2)) for name, (keep1, keep2) in keeps.items()}
+
+
+def fit_state_dict(model, state_dict):
+    # Resize the bottlenecks of a freshly built model to the widths saved in state_dict,
+    # so pruned checkpoints load into the regular Baseline classes. No-op for unpruned ones.
+    for name, block in get_bottlenecks(model):
+        prefix = name + '.' if name != '' else ''
+        if prefix + 'conv1.weight' not in state_dict:
+            continue
+        planes1 = state_dict[prefix + 'conv1.weight'].shape[0]
+        planes2 = state_dict[prefix + 'conv2.weight'].shape[0]
+        if planes1 != block.bn1.num_features or planes2 != block.bn2.num_features:
+            prune_block(block, range(planes1), range(planes2))
+    return model
+
+
+def get_flops(model, size, device=None):
+    # Multiply-accumulates of convolutions and linear layers for one image of size (height, width).
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        flops.append(output.numel() * module.in_channels // module.groups
+                     * module.kernel_size[0] * module.kernel_size[1])
+
+    def linear_hook(module, inputs, output):
+        flops.append(output.numel() * module.in_features)
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros((1, 3) + tuple(size), device=device))
+    model.train(training)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+if __name__ == '__main__':
+    model = bag_tricks.Baseline(pretrain_choice='self')
+    model.eval()
+    x = torch.randn((2, 3, 256, 128))
+    print('FLOPs before: {:.2f}G'.format(get_flops(model, (256, 128)) / 1e9))
+    prune_model(model, 0.3)
+    print('FLOPs after: {:.2f}G'.format(get_flops(model, (256, 128)) / 1e9))
+    print(model(x).shape)
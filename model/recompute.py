@@ -0,0 +1,95 @@
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+STAGES = ['layer1', 'layer2', 'layer3', 'layer4']
+
+
+def run_keep_statistics(modules, forward, x):
+    # forward(x) over modules that leaves their BatchNorm running statistics as they were.
+    states = [(norm, norm.running_mean.clone(), norm.running_var.clone(), norm.num_batches_tracked.clone())
+              for module in modules for norm in module.modules()
+              if isinstance(norm, nn.modules.batchnorm._BatchNorm) and norm.track_running_stats]
+    output = forward(x)
+    with torch.no_grad():
+        for norm, running_mean, running_var, num_batches_tracked in states:
+            norm.running_mean.copy_(running_mean)
+            norm.running_var.copy_(running_var)
+            norm.num_batches_tracked.copy_(num_batches_tracked)
+    return output
+
+
+def run_stage(module, x, recompute, forward=None):
+    # Run forward (module itself by default) over module, or a list of modules, as one segment. Recomputed
+    # segments keep only their input for backward and rerun forward during backward. The rerun keeps
+    # BatchNorm running statistics, so they are updated once per step as without recompute.
+    modules = list(module) if isinstance(module, (list, tuple)) else [module]
+    if forward is None:
+        forward = module
+    if recompute and modules[0].training and torch.is_grad_enabled():
+        calls = [0]
+
+        def run(x):
+            calls[0] += 1
+            return forward(x) if calls[0] == 1 else run_keep_statistics(modules, forward, x)
+        return checkpoint(run, x, use_reentrant=False)
+    return forward(x)
+
+
+def get_stage_modules(base, stage):
+    # Stage blocks, and the non-local blocks of ResNetNL placed in this stage.
+    modules = [getattr(base, stage)]
+    non_local = 'NL_' + stage[-1]
+    if hasattr(base, non_local):
+        modules.append(getattr(base, non_local))
+    return modules
+
+
+def measure_stage_memory(base, size, batch_size, device):
+    # Approximate activation bytes each stage of base (ResNet or ResNetNL) keeps for backward: outputs
+    # of its leaf modules in one forward pass of a single image, scaled to batch_size.
+    stage_memory = {}
+    handles = []
+    for stage in STAGES:
+        stage_memory[stage] = 0
+
+        def hook(module, inputs, output, stage=stage):
+            if torch.is_tensor(output):
+                stage_memory[stage] += output.numel() * output.element_size()
+        for stage_module in get_stage_modules(base, stage):
+            for module in stage_module.modules():
+                if len(list(module.children())) == 0:
+                    handles.append(module.register_forward_hook(hook))
+    training = base.training
+    base.eval()
+    with torch.no_grad():
+        base(torch.zeros((1, 3) + tuple(size), device=device))
+    base.train(training)
+    for handle in handles:
+        handle.remove()
+    return {stage: memory * batch_size for stage, memory in stage_memory.items()}
+
+
+def get_recompute_stages(stage_memory, budget_mb):
+    # Recompute the stages with the most activation memory first, until the kept activations fit budget_mb.
+    budget = budget_mb * 1024 ** 2
+    stages = []
+    total = sum(stage_memory.values())
+    for stage in sorted(stage_memory, key=stage_memory.get, reverse=True):
+        if total <= budget:
+            break
+        stages.append(stage)
+        total -= stage_memory[stage]
+    return stages
+
+
+def set_recompute(model, stages=None, budget_mb=0, size=(256, 128), batch_size=64, device=None):
+    # Turn on recomputation of the backbone (model.base) for stages, or for the stages chosen by budget_mb.
+    # Returns the recomputed stages.
+    if stages is None:
+        stages = []
+        if budget_mb > 0:
+            stage_memory = measure_stage_memory(model.base, size, batch_size, device)
+            stages = get_recompute_stages(stage_memory, budget_mb)
+    model.base.recompute_stages = set(stages)
+    return sorted(stages)
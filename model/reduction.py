@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+from torch import nn
+
+
+class Reduction(nn.Module):
+    def __init__(self, num_feature, dim, eps=1e-6):
+        super(Reduction, self).__init__()
+        self.num_feature = num_feature
+        self.dim = dim
+        self.eps = eps
+        # features -> (features - mean) @ projection.t()
+        self.register_buffer('mean', torch.zeros(num_feature))
+        self.projection = nn.Parameter(torch.eye(dim, num_feature))
+
+    def fit_pca(self, features, whiten=True):
+        # PCA of features (tensor), the dim leading components, scaled to unit variance if whiten.
+        with torch.no_grad():
+            features = features.to(torch.float64)
+            mean = features.mean(dim=0)
+            centered = features - mean
+            covariance = centered.t() @ centered / max(1, features.shape[0] - 1)
+            eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
+            order = torch.argsort(eigenvalues, descending=True)[:self.dim]
+            projection = eigenvectors[:, order].t()
+            if whiten:
+                projection = projection / (eigenvalues[order].clamp(min=0) + self.eps).sqrt().unsqueeze(1)
+            self.mean.copy_(mean.to(self.mean.dtype))
+            self.projection.data.copy_(projection.to(self.projection.dtype))
+
+    def fit_linear(self, features, labels, p=16, k=4, iterations=2000, lr=0.001, margin=0.3, seed=0):
+        # Learn the projection with a batch-hard triplet loss on p x k batches of features,
+        # starting from PCA without whitening. Returns the mean loss of the last 100 iterations.
+        self.fit_pca(features, whiten=False)
+        labels = np.asarray(labels)
+        indexes = {}
+        for index, label in enumerate(labels):
+            indexes.setdefault(label, []).append(index)
+        valid_labels = [label for label, index in indexes.items() if len(index) > 1]
+        generator = np.random.RandomState(seed)
+        optimizer = torch.optim.Adam([self.projection], lr=lr)
+        losses = []
+        for _ in range(iterations):
+            batch_labels = generator.choice(valid_labels, size=min(p, len(valid_labels)), replace=False)
+            batch = np.concatenate([generator.choice(indexes[label], size=k, replace=len(indexes[label]) < k)
+                                    for label in batch_labels])
+            batch = torch.as_tensor(batch, device=features.device)
+            target = torch.as_tensor(labels[batch.cpu().numpy()], device=features.device)
+            embeddings = nn.functional.normalize(self(features[batch]), p=2, dim=1)
+            distance = torch.cdist(embeddings, embeddings)
+            positive = target.unsqueeze(0) == target.unsqueeze(1)
+            positive_distance = (distance * positive).amax(dim=1)
+            negative_distance = (distance + positive * 1e4).amin(dim=1)
+            loss = torch.relu(positive_distance - negative_distance + margin).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        return float(np.mean(losses[-100:])) if len(losses) > 0 else 0.
+
+    def forward(self, features):
+        return (features - self.mean) @ self.projection.t()
+
+
+class ReducedModel(nn.Module):
+    # Feature model followed by its reduction, the single module to export for inference.
+    def __init__(self, base_model, reduction):
+        super(ReducedModel, self).__init__()
+        self.base_model = base_model
+        self.reduction = reduction
+
+    def forward(self, x):
+        return self.reduction(self.base_model(x))
+
+
+def load_reduction(path, device=None):
+    # Build a Reduction of the size saved in path.
+    state_dict = torch.load(path, map_location='cpu')
+    dim, num_feature = state_dict['projection'].shape
+    reduction = Reduction(num_feature, dim)
+    reduction.load_state_dict(state_dict)
+    return reduction.to(device)
+
+
+if __name__ == '__main__':
+    features = torch.randn((64, 8))
+    labels = np.repeat(np.arange(16), 4)
+    reduction = Reduction(num_feature=8, dim=4)
+    reduction.fit_pca(features)
+    print(reduction(features).var(dim=0))
+    print(reduction.fit_linear(features, labels, p=4, k=4, iterations=10))
@@ -0,0 +1,181 @@
+import torch
+from torch import nn
+
+from model.bag_tricks import weights_init_kaiming
+
+
+class ConvBN(nn.Sequential):
+    def __init__(self, in_channels, out_channels, kernel_size=1, stride=1, groups=1, relu=True):
+        layers = [nn.Conv2d(in_channels, out_channels, kernel_size, stride=stride, padding=kernel_size // 2,
+                            groups=groups, bias=False),
+                  nn.BatchNorm2d(out_channels)]
+        if relu:
+            layers.append(nn.ReLU(inplace=True))
+        super(ConvBN, self).__init__(*layers)
+
+
+def make_divisible(channels, divisor=8):
+    return max(divisor, int(channels + divisor / 2) // divisor * divisor)
+
+
+class InvertedResidual(nn.Module):
+    # MobileNetV2 block: 1x1 expansion, 3x3 depthwise, linear 1x1 projection.
+    def __init__(self, in_channels, out_channels, stride, expand_ratio):
+        super(InvertedResidual, self).__init__()
+        hidden_channels = in_channels * expand_ratio
+        self.residual = stride == 1 and in_channels == out_channels
+        layers = []
+        if expand_ratio != 1:
+            layers.append(ConvBN(in_channels, hidden_channels))
+        layers.append(ConvBN(hidden_channels, hidden_channels, kernel_size=3, stride=stride, groups=hidden_channels))
+        layers.append(ConvBN(hidden_channels, out_channels, relu=False))
+        self.conv = nn.Sequential(*layers)
+
+    def forward(self, x):
+        if self.residual:
+            return x + self.conv(x)
+        return self.conv(x)
+
+
+class MobileNet(nn.Module):
+    # MobileNetV2 backbone, the last stride is configurable as in bag_tricks.ResNet.
+    # (expand_ratio, channels, blocks, stride)
+    settings = [(1, 16, 1, 1), (6, 24, 2, 2), (6, 32, 3, 2), (6, 64, 4, 2),
+                (6, 96, 3, 1), (6, 160, 3, 2), (6, 320, 1, 1)]
+
+    def __init__(self, last_stride=1, width=1.0):
+        super(MobileNet, self).__init__()
+        in_channels = make_divisible(32 * width)
+        self.out_channels = make_divisible(1280 * max(1.0, width))
+        layers = [ConvBN(3, in_channels, kernel_size=3, stride=2)]
+        for i, (expand_ratio, channels, blocks, stride) in enumerate(self.settings):
+            out_channels = make_divisible(channels * width)
+            if i == len(self.settings) - 2:
+                stride = last_stride
+            for j in range(blocks):
+                layers.append(InvertedResidual(in_channels, out_channels, stride if j == 0 else 1, expand_ratio))
+                in_channels = out_channels
+        layers.append(ConvBN(in_channels, self.out_channels))
+        self.features = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.features(x)
+
+
+class LiteConv(nn.Module):
+    # OSNet lite 3x3: 1x1 pointwise then 3x3 depthwise.
+    def __init__(self, in_channels, out_channels):
+        super(LiteConv, self).__init__()
+        self.pointwise = nn.Conv2d(in_channels, out_channels, 1, bias=False)
+        self.depthwise = ConvBN(out_channels, out_channels, kernel_size=3, groups=out_channels)
+
+    def forward(self, x):
+        return self.depthwise(self.pointwise(x))
+
+
+class ChannelGate(nn.Module):
+    # Unified aggregation gate shared by all streams of an OSBlock.
+    def __init__(self, channels, reduction=16):
+        super(ChannelGate, self).__init__()
+        self.gap = nn.AdaptiveAvgPool2d(1)
+        self.fc1 = nn.Conv2d(channels, max(1, channels // reduction), 1)
+        self.relu = nn.ReLU(inplace=True)
+        self.fc2 = nn.Conv2d(max(1, channels // reduction), channels, 1)
+
+    def forward(self, x):
+        return x * torch.sigmoid(self.fc2(self.relu(self.fc1(self.gap(x)))))
+
+
+class OSBlock(nn.Module):
+    # Omni-scale block: streams of 1 to num_stream stacked LiteConvs, gated and summed.
+    def __init__(self, in_channels, out_channels, num_stream=4, bottleneck_reduction=4):
+        super(OSBlock, self).__init__()
+        mid_channels = out_channels // bottleneck_reduction
+        self.conv1 = ConvBN(in_channels, mid_channels)
+        self.streams = nn.ModuleList([
+            nn.Sequential(*[LiteConv(mid_channels, mid_channels) for _ in range(t)])
+            for t in range(1, num_stream + 1)])
+        self.gate = ChannelGate(mid_channels)
+        self.conv3 = ConvBN(mid_channels, out_channels, relu=False)
+        self.downsample = None
+        if in_channels != out_channels:
+            self.downsample = ConvBN(in_channels, out_channels, relu=False)
+        self.relu = nn.ReLU(inplace=True)
+
+    def forward(self, x):
+        identity = x if self.downsample is None else self.downsample(x)
+        x = self.conv1(x)
+        out = 0
+        for stream in self.streams:
+            out = out + self.gate(stream(x))
+        return self.relu(self.conv3(out) + identity)
+
+
+class OSNet(nn.Module):
+    # OSNet-style backbone, 3 stages of OSBlocks, the last stage keeps the resolution.
+    def __init__(self, width=1.0, blocks=(2, 2, 2)):
+        super(OSNet, self).__init__()
+        channels = [make_divisible(c * width) for c in [64, 256, 384, 512]]
+        self.out_channels = channels[3]
+        self.conv1 = ConvBN(3, channels[0], kernel_size=7, stride=2)
+        self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
+        self.layer1 = self._make_layer(channels[0], channels[1], blocks[0], transition=True)
+        self.layer2 = self._make_layer(channels[1], channels[2], blocks[1], transition=True)
+        self.layer3 = self._make_layer(channels[2], channels[3], blocks[2], transition=False)
+        self.conv5 = ConvBN(channels[3], channels[3])
+
+    def _make_layer(self, in_channels, out_channels, blocks, transition):
+        layers = [OSBlock(in_channels, out_channels)]
+        for _ in range(1, blocks):
+            layers.append(OSBlock(out_channels, out_channels))
+        if transition:
+            layers.append(ConvBN(out_channels, out_channels))
+            layers.append(nn.AvgPool2d(2, stride=2))
+        return nn.Sequential(*layers)
+
+    def forward(self, x):
+        x = self.maxpool(self.conv1(x))
+        x = self.layer1(x)
+        x = self.layer2(x)
+        x = self.layer3(x)
+        return self.conv5(x)
+
+
+class Student(nn.Module):
+    # Lightweight model with the forward of bag_tricks.Baseline: (global_feat, feat) in training, feat in eval.
+    # Backbone features are embedded to num_feature, the teacher feature size, so student features
+    # can be distilled from and compared with teacher features. There are no ImageNet weights.
+    def __init__(self, model_name='mobilenet', num_feature=2048, width=1.0, last_stride=1, neck_feat='after'):
+        super(Student, self).__init__()
+        if model_name == 'mobilenet':
+            self.base = MobileNet(last_stride=last_stride, width=width)
+        elif model_name == 'osnet':
+            self.base = OSNet(width=width)
+        else:
+            raise ValueError('Unknown student model: {}'.format(model_name))
+        self.num_feature = num_feature
+        self.neck_feat = neck_feat
+        self.gap = nn.AdaptiveAvgPool2d(1)
+        self.embedding = nn.Linear(self.base.out_channels, num_feature)
+        self.bottleneck = nn.BatchNorm1d(num_feature)
+        self.bottleneck.bias.requires_grad_(False)  # no shift
+        self.apply(weights_init_kaiming)
+
+    def forward(self, x):
+        global_feat = self.gap(self.base(x))
+        global_feat = self.embedding(global_feat.view(global_feat.shape[0], -1))
+        feat = self.bottleneck(global_feat)
+        if self.training:
+            return global_feat, feat
+        if self.neck_feat == 'after':
+            return feat
+        return global_feat
+
+
+if __name__ == '__main__':
+    for name in ['mobilenet', 'osnet']:
+        model = Student(model_name=name)
+        model.eval()
+        with torch.no_grad():
+            print(name, model(torch.zeros((2, 3, 256, 128))).shape,
+                  sum(p.numel() for p in model.parameters()))
@@ -0,0 +1,83 @@
+import torch
+from torch import nn
+
+
+def get_scales(text):
+    # '1.0, 1.125' -> [1.0, 1.125]
+    return [float(x) for x in text.split(',') if x.strip() != '']
+
+
+class TTA(nn.Module):
+    # Test-time augmentation of an eval feature model: every image is embedded at each scale,
+    # and also flipped horizontally if flip. Views of the same shape (a scale and its flip, or
+    # scales rounding to one size) run as one batched forward.
+    def __init__(self, base_model, scales=(1.0,), flip=True, merge='mean'):
+        super(TTA, self).__init__()
+        self.base_model = base_model
+        self.scales = list(scales)
+        self.flip = flip
+        # merge in {mean, concat}: average view features, or concatenate them in view order.
+        self.merge = merge
+
+    def get_num_view(self):
+        return len(self.scales) * (2 if self.flip else 1)
+
+    def get_num_feature(self, num_feature):
+        # Feature size of the merged features for base features of num_feature.
+        return num_feature * self.get_num_view() if self.merge == 'concat' else num_feature
+
+    def get_compute(self, size):
+        # Forward cost relative to one view at input size, as the ratio of pixels.
+        pixels = 0
+        for scale in self.scales:
+            height, width = self.get_size(size, scale)
+            pixels += height * width
+        return pixels * (2 if self.flip else 1) / (size[0] * size[1])
+
+    def get_size(self, size, scale):
+        height, width = size
+        return max(1, int(round(height * scale))), max(1, int(round(width * scale)))
+
+    def forward(self, images):
+        batch_size = images.shape[0]
+        size = tuple(images.shape[2:])
+        # Group views by shape, each view is (scale index, flipped).
+        groups = {}
+        for i, scale in enumerate(self.scales):
+            views = groups.setdefault(self.get_size(size, scale), [])
+            views.append((i, False))
+            if self.flip:
+                views.append((i, True))
+        features = {}
+        for view_size, views in groups.items():
+            if view_size == size:
+                resized = images
+            else:
+                resized = nn.functional.interpolate(images, size=view_size, mode='bilinear', align_corners=False)
+            batch = torch.cat([torch.flip(resized, dims=[3]) if flipped else resized for _, flipped in views], dim=0)
+            for view, view_features in zip(views, self.base_model(batch).split(batch_size, dim=0)):
+                features[view] = view_features
+        features = [features[view] for view in sorted(features.keys())]
+        if self.merge == 'concat':
+            return torch.cat(features, dim=1)
+        elif self.merge == 'mean':
+            return torch.stack(features, dim=0).mean(dim=0)
+        else:
+            raise ValueError('Unknown merge: {}'.format(self.merge))
+
+
+def get_tta(base_model, config):
+    # Wrap base_model as set in the [val] config section, or return it if tta is off.
+    if not config['val'].getboolean('tta'):
+        return base_model
+    return TTA(base_model, scales=get_scales(config['val']['tta_scales']), flip=config['val'].getboolean('tta_flip'),
+               merge=config['val']['tta_merge'])
+
+
+if __name__ == '__main__':
+    base_model = nn.Sequential(nn.Conv2d(3, 8, 3), nn.AdaptiveAvgPool2d(1), nn.Flatten()).eval()
+    images = torch.randn((4, 3, 256, 128))
+    for merge in ['mean', 'concat']:
+        model = TTA(base_model, scales=[0.875, 1.0, 1.125], flip=True, merge=merge)
+        with torch.no_grad():
+            print(merge, model(images).shape, model.get_num_view(), model.get_compute((256, 128)))
@@ -67,4 +67,50 @@ script="/home/dell3080ti_01/lx/ReID-Framework/script"
 
 # 5.1 GMM
 # file="${path}/`date +%H%M%S`_gmm.log"
-# ${python} ${script}/gmm.py -c config/default.ini -gpu 3 > ${file} 2>&1 &
\ No newline at end of file
+# ${python} ${script}/gmm.py -c config/default.ini -gpu 3 > ${file} 2>&1 &
+# 5.2 Cluster benchmark
+# file="${path}/`date +%H%M%S`_cluster_benchmark.log"
+# ${python} ${script}/../test/cluster_benchmark.py -c config/default.ini -gpu 3 > ${file} 2>&1 &
+# 5.3 Bucket benchmark
+# file="${path}/`date +%H%M%S`_bucket_benchmark.log"
+# ${python} ${script}/../test/bucket_benchmark.py -c config/default.ini -gpu 3 > ${file} 2>&1 &
+# 5.4 Decode benchmark
+# file="${path}/`date +%H%M%S`_decode_benchmark.log"
+# ${python} ${script}/../test/decode_benchmark.py -c config/default.ini > ${file} 2>&1 &
+# 5.5 Non-local benchmark
+# file="${path}/`date +%H%M%S`_non_local_benchmark.log"
+# ${python} ${script}/../test/non_local_benchmark.py -c config/default.ini -gpu 3 > ${file} 2>&1 &
+
+# 6 Distill
+
+# file="${path}/`date +%H%M%S`_distill.log"
+# ${python} ${script}/distill.py -c config/distill.ini -gpu 0 > ${file} 2>&1 &
+
+# 7 Prune
+
+# file="${path}/`date +%H%M%S`_prune.log"
+# ${python} ${script}/prune.py -c config/default.ini -gpu 0 > ${file} 2>&1 &
+
+# 8 Feature reduction
+
+# file="${path}/`date +%H%M%S`_reduce.log"
+# ${python} ${script}/reduce.py -c config/default.ini -gpu 0 > ${file} 2>&1 &
+
+# 9 Hash
+
+# 9.1 Train hash head
+# file="${path}/`date +%H%M%S`_supervised_hash.log"
+# ${python} ${script}/supervised_hash.py -c config/supervised_offline.ini -gpu 0 > ${file} 2>&1 &
+# 9.2 Hash benchmark
+# file="${path}/`date +%H%M%S`_hash_benchmark.log"
+# ${python} ${script}/../test/hash_benchmark.py -c config/default.ini -gpu 0 > ${file} 2>&1 &
+
+# 10 TTA
+
+# file="${path}/`date +%H%M%S`_tta_benchmark.log"
+# ${python} ${script}/../test/tta_benchmark.py -c config/default.ini -gpu 0 > ${file} 2>&1 &
+
+# 11 Diff Attention distillation
+
+# file="${path}/`date +%H%M%S`_supervised_da_distill.log"
+# ${python} ${script}/supervised_da_distill.py -c config/supervised_offline.ini -gpu 0 > ${file} 2>&1 &
@@ -0,0 +1,323 @@
+import copy
+import os
+import time
+import sys
+import numpy as np
+
+import torch
+from torch import nn
+from torch.utils.data import RandomSampler
+from torch.optim import Adam
+from torch.optim.lr_scheduler import LambdaLR
+import torch.multiprocessing
+torch.multiprocessing.set_sharing_strategy('file_system')
+
+sys.path.append("")
+from optimizer import lambda_calculator
+from model import bag_tricks, agw, classifier, student, loading
+from metric import cmc_map
+from loss import id_loss, triplet_loss, distill_loss
+from data import transform, dataset, sampler, loader, tensor_cache
+from util import config_parser, logger, tool, averager, feature_cache
+
+
+def get_latency(model, size, device, batch_size=1, repeat=20):
+    # Mean eval forward time in ms.
+    model.eval()
+    images = torch.zeros((batch_size, 3) + tuple(size), device=device)
+    with torch.no_grad():
+        model(images)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        time_start = time.time()
+        for _ in range(repeat):
+            model(images)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - time_start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Distill')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    num_class = config['model'].getint('num_class')
+    num_feature = config['model'].getint('num_feature')
+    bias = config['model'].getboolean('bias')
+    teacher_name = config['distill']['teacher']
+    teacher_path = config['distill']['teacher_path']
+    student_name = config['distill']['student']
+    student_width = config['distill'].getfloat('width')
+    # 2.1 Get teacher model.
+    teacher_class = agw.Baseline if teacher_name == 'agw' else bag_tricks.Baseline
+    teacher_model = loading.build_model(lambda: teacher_class(pretrain_choice='self'), teacher_path, device=device)
+    teacher_model.eval()
+    logger.info('Teacher Model: ' + str(tool.get_parameter_number(teacher_model)))
+    # 2.2 Get student model.
+    base_model = student.Student(model_name=student_name, num_feature=num_feature, width=student_width)
+    if use_gpu:
+        base_model = base_model.to(device)
+    logger.info('Student Model: ' + str(tool.get_parameter_number(base_model)))
+    # 2.3 Get classifier.
+    classifier_model = classifier.Classifier(num_feature, num_class, bias=bias)
+    if use_gpu:
+        classifier_model = classifier_model.to(device)
+    logger.info('Classifier Model: ' +
+                str(tool.get_parameter_number(classifier_model)))
+
+    # 3 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    random_erasing = config['dataset'].getboolean('random_erasing')
+    batch_size = config['dataset'].getint('batch_size')
+    p = config['dataset'].getint('p')
+    k = config['dataset'].getint('k')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    cache_path = config['distill']['cache_path']
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
+    # 3.1 Get teacher features of the train set, extracted once without augmentation and cached.
+    train_path = os.path.join(dataset_path, 'bounding_box_train')
+    eval_transform = transform.get_transform(size=size, is_train=False)
+    teacher_dataset = dataset.ImageDataset(
+        style=dataset_style, path=train_path, transform=eval_transform, name='Image Teacher')
+    teacher_features, _, _ = feature_cache.get_features(
+        cache_path, teacher_model, teacher_path, teacher_dataset, device, batch_size, num_workers, pin_memory)
+    # The teacher waits on cpu for the latency comparison at the end.
+    teacher_model = teacher_model.cpu()
+    # 3.2 Get train set.
+    train_transform = transform.get_transform(size=size, is_train=True, random_erasing=random_erasing)
+    train_dataset = dataset.ImageDataset(
+        style=dataset_style, path=train_path, transform=train_transform, name='Image Train', verbose=verbose)
+    train_dataset = dataset.DistillDataset(train_dataset, teacher_features)
+    if p * k == batch_size:
+        # Use triplet sampler.
+        train_sampler = sampler.TripletSampler(
+            labels=train_dataset.get_labels(), batch_size=batch_size, p=p, k=k, seed=seed)
+    else:
+        train_sampler = RandomSampler(train_dataset)
+    loader_manager = loader.LoaderManager(num_workers=num_workers, pin_memory=pin_memory)
+    train_loader = loader_manager.get_loader('train', train_dataset, batch_size, sampler=train_sampler)
+    # 3.3 Get query set.
+    query_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'query'),
+                                         transform=eval_transform, name='Image Query', verbose=verbose)
+    query_loader = loader_manager.get_loader('query', query_dataset, batch_size)
+    # 3.4 Get gallery set.
+    gallery_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'bounding_box_test'),
+                                           transform=eval_transform, name='Image Gallery', verbose=verbose)
+    gallery_loader = loader_manager.get_loader('gallery', gallery_dataset, batch_size)
+    # 3.5 Keep decoded eval images across validations.
+    if config['val'].getboolean('cache'):
+        tensor_cache.attach_caches(
+            [query_dataset, gallery_dataset], size, int(config['val'].getfloat('cache_gb') * 1024 ** 3),
+            dtype=config['val']['cache_dtype'], spill_path=config['val']['cache_spill_path'])
+
+    # 4 loss
+    id_loss_weight = config['loss'].getfloat('id_loss_weight')
+    smooth = config['loss'].getboolean('label_smooth')
+    triplet_loss_weight = config['loss'].getfloat('triplet_loss_weight')
+    margin = config['loss'].getfloat('margin')
+    soft_margin = config['loss'].getboolean('soft_margin')
+    feature_loss_weight = config['distill'].getfloat('feature_loss_weight')
+    relation_loss_weight = config['distill'].getfloat('relation_loss_weight')
+    # 4.1 Get distill loss.
+    distill_loss_function = distill_loss.DistillLoss(
+        feature_weight=feature_loss_weight, relation_weight=relation_loss_weight)
+    # 4.2 Get id loss.
+    if smooth:
+        id_loss_function = id_loss.CrossEntropyLabelSmooth(
+            num_class=num_class, use_gpu=use_gpu, device=device)
+    else:
+        id_loss_function = nn.CrossEntropyLoss()
+    # 4.3 Get triplet loss, the batch should be p identities of k images.
+    use_triplet = triplet_loss_weight > 0 and p * k == batch_size
+    if use_triplet:
+        triplet_loss_function = triplet_loss.TripletLoss(
+            margin=margin, batch_size=batch_size, p=p, k=k, soft_margin=soft_margin)
+        batch_template1, batch_template2 = tool.get_templates(batch_size, batch_size)
+
+    # 5 optimizer
+    init_lr = config['optimizer'].getfloat('init_lr')
+    milestone = config['optimizer']['milestone']
+    milestones = [] if milestone == '' else [
+        int(x) for x in milestone.split(',')]
+    weight_decay = config['optimizer'].getfloat('weight_decay')
+    warmup = config['optimizer'].getboolean('warmup')
+    model_parameters = [{'params': base_model.parameters()},
+                        {'params': classifier_model.parameters()}]
+    model_optimizer = Adam(model_parameters, lr=init_lr, weight_decay=weight_decay)
+    model_lambda_function = lambda_calculator.get_lambda_calculator(
+        milestones=milestones, warmup=warmup)
+    model_scheduler = LambdaLR(model_optimizer, model_lambda_function)
+
+    # 6 metric
+    # 6.1 Get CMC and mAP metric.
+    cmc_map_function = cmc_map.cmc_map
+    # 6.2 Get averagers.
+    feature_loss_averager = averager.Averager()
+    relation_loss_averager = averager.Averager()
+    id_loss_averager = averager.Averager()
+    triplet_loss_averager = averager.Averager()
+    all_loss_averager = averager.Averager()
+
+    # 7 train and eval
+    epochs = config['train'].getint('epochs')
+    val_per_epochs = config['train'].getint('val_per_epochs')
+    log_iteration = config['train'].getint('log_iteration')
+    save = config['train'].getboolean('save')
+    save_per_epochs = config['train'].getint('save_per_epochs')
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    val_norm = config['val'].getboolean('norm')
+    minp = config['val'].getboolean('minp')
+    for epoch in range(1, epochs + 1):
+        # 7.1 Start epoch.
+        base_model.train()
+        classifier_model.train()
+        feature_loss_averager.reset()
+        relation_loss_averager.reset()
+        id_loss_averager.reset()
+        triplet_loss_averager.reset()
+        all_loss_averager.reset()
+        iteration = 0
+        logger.info('Epoch[{}/{}] Epoch start.'.format(epoch, epochs))
+        epoch_start = time.time()
+        for images, teacher_features, labels, _, _ in loader_manager.iterate('train'):
+            # 7.2 Start iteration.
+            iteration += 1
+            model_optimizer.zero_grad()
+            # 7.3 Train.
+            # 7.3.1 Forward.
+            if use_gpu:
+                images = images.to(device)
+                teacher_features = teacher_features.to(device)
+                labels = labels.to(device)
+            features, final_features = base_model(images)
+            predicted_labels = classifier_model(final_features)
+            # 7.3.2 Calculate loss.
+            # distill loss, on the served (after neck) features
+            feature_loss, relation_loss = distill_loss_function(final_features, teacher_features)
+            # id loss
+            id_loss = id_loss_function(
+                predicted_labels, copy.deepcopy(labels)) * id_loss_weight
+            all_loss = feature_loss + relation_loss + id_loss
+            # triplet loss
+            if use_triplet:
+                triplet_loss = triplet_loss_function(
+                    features[batch_template1, :], features[batch_template2, :]) * triplet_loss_weight
+                all_loss = all_loss + triplet_loss
+                triplet_loss_averager.update(triplet_loss.item())
+            # 7.3.3 Optimize.
+            all_loss.backward()
+            model_optimizer.step()
+            # 7.3.4 Log losses.
+            feature_loss_averager.update(feature_loss.item())
+            relation_loss_averager.update(relation_loss.item())
+            id_loss_averager.update(id_loss.item())
+            all_loss_averager.update(all_loss.item())
+            # 7.4 End iteration.
+            if iteration % log_iteration == 0:
+                logger.info('Epoch[{}/{}] Iteration[{}] Loss: {:.3f}'
+                            .format(epoch, epochs, iteration, all_loss_averager.get_value()))
+        # 7.5 End epoch.
+        epoch_end = time.time()
+        logger.info('Epoch[{}/{}] Loss: {:.3f} Base Lr: {:.2e}'.format(
+            epoch, epochs, all_loss_averager.get_value(), model_scheduler.get_last_lr()[0]))
+        logger.info('Epoch[{}/{}] Feature_Loss: {:.3f} Relation_Loss: {:.3f} ID_Loss: {:.3f} Triplet_Loss: {:.3f}'
+                    .format(epoch, epochs, feature_loss_averager.get_value(), relation_loss_averager.get_value(),
+                            id_loss_averager.get_value(), triplet_loss_averager.get_value()))
+        logger.info('Train time taken: ' + time.strftime("%H:%M:%S",
+                                                         time.gmtime(epoch_end - epoch_start)))
+        model_scheduler.step()
+        # 7.6 Eval.
+        if epoch % val_per_epochs == 0:
+            logger.info('Start validation every {} epochs at epoch: {}'.format(
+                val_per_epochs, epoch))
+            if epoch < epochs:
+                loader_manager.prefetch('train')
+            base_model.eval()
+            val_start = time.time()
+            with torch.no_grad():
+                features = {}
+                for name, val_loader in [('query', query_loader), ('gallery', gallery_loader)]:
+                    logger.info('Load {} data.'.format(name))
+                    val_features = []
+                    val_pids = []
+                    val_camids = []
+                    for val_image, _, pids, camids in val_loader:
+                        if use_gpu:
+                            val_image = val_image.to(device)
+                        val_feature = base_model(val_image)
+                        if val_norm:
+                            val_feature = torch.nn.functional.normalize(val_feature, p=2, dim=1)
+                        val_features.append(val_feature)
+                        val_pids.extend(pids)
+                        val_camids.extend(camids)
+                    features[name] = (torch.cat(val_features, dim=0), val_pids, val_camids)
+                query_features, query_pids, query_camids = features['query']
+                gallery_features, gallery_pids, gallery_camids = features['gallery']
+                logger.info('Make up distance matrix.')
+                distance_matrix = torch.cdist(query_features, gallery_features).cpu().numpy()
+                if minp:
+                    logger.info('Compute CMC, mAP and mINP.')
+                    cmc, mAP, mINP = cmc_map_function(
+                        distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids, minp=minp)
+                    logger.info("CMC curve, Rank-{}: {:.1%}".format(1, cmc[0]))
+                    logger.info("mAP: {:.1%}".format(mAP))
+                    logger.info("mINP: {:.1%}".format(mINP))
+                else:
+                    logger.info('Compute CMC and mAP.')
+                    cmc, mAP = cmc_map_function(
+                        distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids, minp=minp)
+                    logger.info("CMC curve, Rank-{}: {:.1%}".format(1, cmc[0]))
+                    logger.info("mAP: {:.1%}".format(mAP))
+            val_end = time.time()
+            logger.info('Val time taken: ' + time.strftime("%H:%M:%S",
+                                                           time.gmtime(val_end - val_start)))
+        # 7.7 Save checkpoint.
+        if save:
+            if epoch % save_per_epochs == 0:
+                logger.info('Save checkpoint every {} epochs at epoch: {}'.format(
+                    save_per_epochs, epoch))
+                base_save_name = '[distill {}]'.format(student_name) + time.strftime(
+                    "%H%M%S", time.localtime()) + '[base]' + str(epoch) + '.pth'
+                torch.save(base_model.state_dict(),
+                           os.path.join(save_path, base_save_name))
+
+    # 8 serving cost
+    # Single-image CPU latency of teacher and student, the serving case on edge boxes.
+    cpu = torch.device('cpu')
+    teacher_latency = get_latency(teacher_model, size, cpu)
+    student_latency = get_latency(base_model.to(cpu), size, cpu)
+    logger.info('CPU latency, teacher: {:.1f}ms, student: {:.1f}ms, speedup: {:.1f}x'.format(
+        teacher_latency, student_latency, teacher_latency / student_latency))
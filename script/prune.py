@@ -0,0 +1,210 @@
+import copy
+import csv
+import os
+import time
+import sys
+
+import torch
+from torch import nn
+from torch.optim import Adam
+import torch.multiprocessing
+torch.multiprocessing.set_sharing_strategy('file_system')
+
+sys.path.append("")
+from model import bag_tricks, agw, classifier, prune, loading
+from metric import cmc_map
+from loss import id_loss, triplet_loss
+from data import transform, dataset, sampler, loader
+from util import config_parser, logger, tool, averager
+
+
+def get_latency(model, size, repeat=20):
+    # Mean single-image eval forward time on cpu in ms.
+    model = copy.deepcopy(model).cpu().eval()
+    images = torch.zeros((1, 3) + tuple(size))
+    with torch.no_grad():
+        model(images)
+        time_start = time.time()
+        for _ in range(repeat):
+            model(images)
+    return (time.time() - time_start) / repeat * 1000
+
+
+def evaluate(model, query_loader, gallery_loader, device, norm):
+    # Rank-1 and mAP of model on query and gallery.
+    model.eval()
+    features = []
+    with torch.no_grad():
+        for val_loader in [query_loader, gallery_loader]:
+            val_features = []
+            val_pids = []
+            val_camids = []
+            for images, _, pids, camids in val_loader:
+                val_feature = model(images.to(device))
+                if norm:
+                    val_feature = torch.nn.functional.normalize(val_feature, p=2, dim=1)
+                val_features.append(val_feature)
+                val_pids.extend(pids)
+                val_camids.extend(camids)
+            features.append((torch.cat(val_features, dim=0), val_pids, val_camids))
+    (query_features, query_pids, query_camids), (gallery_features, gallery_pids, gallery_camids) = features
+    distance_matrix = torch.cdist(query_features, gallery_features).cpu().numpy()
+    cmc, mAP = cmc_map.cmc_map(distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids)
+    return cmc[0], mAP
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Prune')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    model_path = config['model']['path']
+    num_class = config['model'].getint('num_class')
+    num_feature = config['model'].getint('num_feature')
+    bias = config['model'].getboolean('bias')
+    model_name = config['prune']['model']
+    # 2.1 Get trained feature model, pruned checkpoints can be pruned further.
+    model_class = agw.Baseline if model_name == 'agw' else bag_tricks.Baseline
+    base_model = loading.build_model(lambda: model_class(pretrain_choice='self'), model_path, device=device)
+    logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+    # 2.2 Get classifier, trained from scratch during fine-tuning.
+    classifier_model = classifier.Classifier(num_feature, num_class, bias=bias).to(device)
+
+    # 3 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    random_erasing = config['dataset'].getboolean('random_erasing')
+    batch_size = config['dataset'].getint('batch_size')
+    p = config['dataset'].getint('p')
+    k = config['dataset'].getint('k')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    val_norm = config['val'].getboolean('norm')
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
+    loader_manager = loader.LoaderManager(num_workers=num_workers, pin_memory=pin_memory)
+    # 3.1 Get train set.
+    train_transform = transform.get_transform(size=size, is_train=True, random_erasing=random_erasing)
+    train_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'bounding_box_train'),
+                                         transform=train_transform, name='Image Train', verbose=verbose)
+    train_sampler = sampler.TripletSampler(
+        labels=train_dataset.labels, batch_size=batch_size, p=p, k=k, seed=seed)
+    train_loader = loader_manager.get_loader('train', train_dataset, batch_size, sampler=train_sampler)
+    # 3.2 Get query and gallery sets.
+    eval_transform = transform.get_transform(size=size, is_train=False)
+    query_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'query'),
+                                         transform=eval_transform, name='Image Query', verbose=verbose)
+    query_loader = loader_manager.get_loader('query', query_dataset, batch_size)
+    gallery_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'bounding_box_test'),
+                                           transform=eval_transform, name='Image Gallery', verbose=verbose)
+    gallery_loader = loader_manager.get_loader('gallery', gallery_dataset, batch_size)
+
+    # 4 report
+    results = []
+
+    def report(stage):
+        rank1, mAP = evaluate(base_model, query_loader, gallery_loader, device, val_norm)
+        result = {'stage': stage, 'flops_g': prune.get_flops(base_model, size, device) / 1e9,
+                  'params_m': tool.get_parameter_number(base_model)['Total Params'] / 1e6,
+                  'cpu_latency_ms': get_latency(base_model, size), 'rank1': rank1, 'map': mAP}
+        results.append(result)
+        logger.info('{stage}: FLOPs {flops_g:.2f}G, params {params_m:.2f}M, cpu latency {cpu_latency_ms:.1f}ms, '
+                    'Rank-1 {rank1:.1%}, mAP {map:.1%}'.format(**result))
+    report('before')
+
+    # 5 prune
+    ratio = config['prune'].getfloat('ratio')
+    min_channels = config['prune'].getint('min_channels')
+    widths = prune.prune_model(base_model, ratio, min_channels=min_channels)
+    for name, (planes1, planes2) in widths.items():
+        logger.info('{}: {} / {} channels'.format(name, planes1, planes2))
+    report('pruned')
+
+    # 6 fine-tune
+    finetune_epochs = config['prune'].getint('finetune_epochs')
+    finetune_lr = config['prune'].getfloat('finetune_lr')
+    weight_decay = config['optimizer'].getfloat('weight_decay')
+    log_iteration = config['train'].getint('log_iteration')
+    id_loss_weight = config['loss'].getfloat('id_loss_weight')
+    triplet_loss_weight = config['loss'].getfloat('triplet_loss_weight')
+    margin = config['loss'].getfloat('margin')
+    soft_margin = config['loss'].getboolean('soft_margin')
+    if config['loss'].getboolean('label_smooth'):
+        id_loss_function = id_loss.CrossEntropyLabelSmooth(
+            num_class=num_class, use_gpu=use_gpu, device=device)
+    else:
+        id_loss_function = nn.CrossEntropyLoss()
+    triplet_loss_function = triplet_loss.TripletLoss(
+        margin=margin, batch_size=batch_size, p=p, k=k, soft_margin=soft_margin)
+    batch_template1, batch_template2 = tool.get_templates(batch_size, batch_size)
+    model_optimizer = Adam([{'params': base_model.parameters()}, {'params': classifier_model.parameters()}],
+                           lr=finetune_lr, weight_decay=weight_decay)
+    all_loss_averager = averager.Averager()
+    for epoch in range(1, finetune_epochs + 1):
+        base_model.train()
+        classifier_model.train()
+        all_loss_averager.reset()
+        train_sampler.set_epoch(epoch)
+        iteration = 0
+        for images, labels, _, _ in loader_manager.iterate('train'):
+            iteration += 1
+            model_optimizer.zero_grad()
+            images = images.to(device)
+            labels = labels.to(device)
+            features, final_features = base_model(images)
+            predicted_labels = classifier_model(final_features)
+            all_loss = id_loss_function(predicted_labels, copy.deepcopy(labels)) * id_loss_weight \
+                + triplet_loss_function(features[batch_template1, :], features[batch_template2, :]) \
+                * triplet_loss_weight
+            all_loss.backward()
+            model_optimizer.step()
+            all_loss_averager.update(all_loss.item())
+            if iteration % log_iteration == 0:
+                logger.info('Fine-tune Epoch[{}/{}] Iteration[{}] Loss: {:.3f}'
+                            .format(epoch, finetune_epochs, iteration, all_loss_averager.get_value()))
+        logger.info('Fine-tune Epoch[{}/{}] Loss: {:.3f}'.format(epoch, finetune_epochs, all_loss_averager.get_value()))
+    if finetune_epochs > 0:
+        report('fine-tuned')
+
+    # 7 save model and table
+    # The pruned model is a plain state dict, load it with loading.build_model.
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    save_time = time.strftime("%H%M%S", time.localtime())
+    base_save_name = '[prune {}]{}[base].pth'.format(model_name, save_time)
+    torch.save(base_model.state_dict(), os.path.join(save_path, base_save_name))
+    logger.info('Save model: ' + os.path.join(save_path, base_save_name))
+    table_save_name = '[prune {}]{}.csv'.format(model_name, save_time)
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['stage', 'flops_g', 'params_m', 'cpu_latency_ms', 'rank1', 'map'])
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
@@ -0,0 +1,147 @@
+import csv
+import os
+import time
+import sys
+
+import torch
+import torch.multiprocessing
+torch.multiprocessing.set_sharing_strategy('file_system')
+
+sys.path.append("")
+from model import bag_tricks, agw, reduction, loading
+from metric import cmc_map
+from data import transform, dataset
+from util import config_parser, logger, tool, feature_cache
+
+
+def fit_reduction(method, dim, features, labels, config):
+    # method in {pca, pca_whiten, linear}.
+    reduction_model = reduction.Reduction(features.shape[1], dim).to(features.device)
+    if method == 'linear':
+        loss = reduction_model.fit_linear(
+            features, labels, p=config['dataset'].getint('p'), k=config['dataset'].getint('k'),
+            iterations=config['reduction'].getint('iterations'), lr=config['reduction'].getfloat('lr'),
+            margin=config['loss'].getfloat('margin'), seed=config['basic'].getint('seed'))
+        logger.info('linear {}: triplet loss {:.3f}'.format(dim, loss))
+    elif method in ['pca', 'pca_whiten']:
+        reduction_model.fit_pca(features, whiten=method == 'pca_whiten')
+    else:
+        raise ValueError('Unknown reduction method: {}'.format(method))
+    return reduction_model
+
+
+def evaluate(query_features, gallery_features, query_pids, gallery_pids, query_camids, gallery_camids, norm):
+    if norm:
+        query_features = torch.nn.functional.normalize(query_features, p=2, dim=1)
+        gallery_features = torch.nn.functional.normalize(gallery_features, p=2, dim=1)
+    distance_matrix = torch.cdist(query_features, gallery_features).cpu().numpy()
+    cmc, mAP = cmc_map.cmc_map(distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids)
+    return cmc[0], mAP
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Feature Reduction')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    model_path = config['model']['path']
+    model_class = agw.Baseline if config['reduction']['model'] == 'agw' else bag_tricks.Baseline
+    base_model = loading.build_model(lambda: model_class(pretrain_choice='self'), model_path, device=device)
+    base_model.eval()
+    logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+
+    # 3 features
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    batch_size = config['dataset'].getint('batch_size')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    val_norm = config['val'].getboolean('norm')
+    cache_path = config['reduction']['cache_path']
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
+    eval_transform = transform.get_transform(size=size, is_train=False)
+    # Train features fit the reduction, query and gallery features score it. Raw features, as val.py reduces them.
+    features = {}
+    for name, folder in [('train', 'bounding_box_train'), ('query', 'query'), ('gallery', 'bounding_box_test')]:
+        image_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, folder),
+                                             transform=eval_transform, name='Image ' + name, verbose=verbose)
+        split_features, split_pids, split_camids = feature_cache.get_features(
+            cache_path, base_model, model_path, image_dataset, device, batch_size, num_workers, pin_memory)
+        labels = image_dataset.all_labels.copy()
+        features[name] = (torch.from_numpy(split_features).to(device), split_pids, split_camids, labels)
+    train_features, _, _, train_labels = features['train']
+    query_features, query_pids, query_camids, _ = features['query']
+    gallery_features, gallery_pids, gallery_camids, _ = features['gallery']
+
+    # 4 mAP / dimension curve
+    methods = [x.strip() for x in config['reduction']['methods'].split(',') if x.strip() != '']
+    dims = [int(x) for x in config['reduction']['dims'].split(',') if x.strip() != '']
+    results = []
+    rank1, mAP = evaluate(query_features, gallery_features, query_pids, gallery_pids, query_camids, gallery_camids,
+                          val_norm)
+    results.append({'method': 'none', 'dim': train_features.shape[1], 'rank1': rank1, 'map': mAP})
+    logger.info('none {}: Rank-1 {:.1%}, mAP {:.1%}'.format(train_features.shape[1], rank1, mAP))
+    for method in methods:
+        for dim in dims:
+            reduction_model = fit_reduction(method, dim, train_features, train_labels, config)
+            with torch.no_grad():
+                rank1, mAP = evaluate(reduction_model(query_features), reduction_model(gallery_features),
+                                      query_pids, gallery_pids, query_camids, gallery_camids, val_norm)
+            results.append({'method': method, 'dim': dim, 'rank1': rank1, 'map': mAP})
+            logger.info('{} {}: Rank-1 {:.1%}, mAP {:.1%}'.format(method, dim, rank1, mAP))
+
+    # 5 save reduction, export and table
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    save_time = time.strftime("%H%M%S", time.localtime())
+    # 5.1 Fit the chosen reduction, val.py and the daoff scripts load it from [model] reduction_path.
+    method = config['reduction']['method']
+    dim = config['reduction'].getint('dim')
+    reduction_model = fit_reduction(method, dim, train_features, train_labels, config)
+    reduction_save_name = '[reduction {}{}]{}.pth'.format(method, dim, save_time)
+    torch.save(reduction_model.state_dict(), os.path.join(save_path, reduction_save_name))
+    logger.info('Save reduction: ' + os.path.join(save_path, reduction_save_name))
+    # 5.2 Export model and reduction as one traced module.
+    if config['reduction'].getboolean('export'):
+        reduced_model = reduction.ReducedModel(base_model, reduction_model).eval()
+        with torch.no_grad():
+            traced_model = torch.jit.trace(reduced_model, torch.zeros((1, 3) + size, device=device))
+        export_save_name = '[reduction {}{}]{}[export].pt'.format(method, dim, save_time)
+        traced_model.save(os.path.join(save_path, export_save_name))
+        logger.info('Save export: ' + os.path.join(save_path, export_save_name))
+    # 5.3 Save curve.
+    table_save_name = '[reduction]{}.csv'.format(save_time)
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['method', 'dim', 'rank1', 'map'])
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
@@ -13,10 +13,10 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 
 sys.path.append("")
 from optimizer import lambda_calculator
-from model import bag_tricks, classifier, diff_attention, agw
+from model import bag_tricks, classifier, diff_attention, agw, reduction, loading
 from metric import cmc_map, re_ranking
 from loss import id_loss, triplet_loss, center_loss, circle_loss, reg_loss, weighted_triplet_loss
-from data import transform, dataset, sampler
+from data import transform, dataset, sampler, loader
 from util import config_parser, logger, tool, averager
 
 
@@ -53,12 +53,16 @@ if __name__ == '__main__':
     diff_ratio = config['da'].getint('diff_ratio')
     out_transform = config['da']['out_transform']
     aggregate = config['da'].getboolean('aggregate')
-    # 2.1 Get feature model.
-    base_model = agw.Baseline()
-    if use_gpu:
-        base_model = base_model.to(device)
+    # 2.1 Get feature model, built on the meta device and loaded from the memory-mapped checkpoint.
+    base_model = loading.build_model(lambda: agw.Baseline(pretrain_choice='self'), base_path, device=device)
     logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
-    base_model.load_state_dict(torch.load(base_path))
+    # Reduce features before Diff Attention, which then works on the reduced size.
+    reduction_path = config['model']['reduction_path']
+    reduction_model = None
+    if reduction_path != '':
+        reduction_model = reduction.load_reduction(reduction_path, device=device)
+        num_feature = reduction_model.dim
+        logger.info('Reduce features to {} dimensions.'.format(num_feature))
     # 2.2 Get Diff Attention Module.
     diff_model = diff_attention.DiffAttentionModule(
         num_feature=num_feature, in_transform=in_transform, diff_ratio=diff_ratio, out_transform=out_transform, aggregate=aggregate)
@@ -80,6 +84,9 @@ if __name__ == '__main__':
     num_workers = config['dataset'].getint('num_workers')
     pin_memory = config['dataset'].getboolean('pin_memory')
     dataset_norm = config['dataset'].getboolean('norm')
+    # Scan dataset folders in parallel, datasets below load from manifests.
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
     # 3.1 Get train set.
     train_path = os.path.join(dataset_path, 'bounding_box_train')
     train_transform = transform.get_transform(
@@ -87,31 +94,33 @@ if __name__ == '__main__':
     train_image_dataset = dataset.ImageDataset(
         style=dataset_style, path=train_path, transform=train_transform, name='Train', verbose=verbose)
     train_dataset = dataset.FeatureDataset(origin_dataset=train_image_dataset, model=base_model, device=device,
-                                           batch_size=batch_size, norm=dataset_norm, num_workers=num_workers, pin_memory=pin_memory)
+                                           batch_size=batch_size, norm=dataset_norm, num_workers=num_workers, pin_memory=pin_memory,
+                                           reduction=reduction_model)
     if p is not None and k is not None and p * k == batch_size:
         # Use triplet sampler.
         sampler = sampler.TripletSampler(
-            labels=train_dataset.labels, batch_size=batch_size, p=p, k=k)
-    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size,
-                              sampler=sampler, num_workers=num_workers, pin_memory=pin_memory)
+            labels=train_dataset.labels, batch_size=batch_size, p=p, k=k, seed=seed)
+    # Loaders keep their workers alive across epochs and validations.
+    loader_manager = loader.LoaderManager(num_workers=num_workers, pin_memory=pin_memory)
+    train_loader = loader_manager.get_loader('train', train_dataset, batch_size, sampler=sampler)
     # 3.2 Get query set.
     query_path = os.path.join(dataset_path, 'query')
     query_transform = transform.get_transform(size=size, is_train=False)
     query_image_dataset = dataset.ImageDataset(
         style=dataset_style, path=query_path, transform=query_transform, name='Query', verbose=verbose)
     query_dataset = dataset.FeatureDataset(origin_dataset=query_image_dataset, model=base_model, device=device,
-                                           batch_size=batch_size, norm=dataset_norm, num_workers=num_workers, pin_memory=pin_memory)
-    query_loader = DataLoader(dataset=query_dataset, batch_size=batch_size,
-                              num_workers=num_workers, pin_memory=pin_memory)
+                                           batch_size=batch_size, norm=dataset_norm, num_workers=num_workers, pin_memory=pin_memory,
+                                           reduction=reduction_model)
+    query_loader = loader_manager.get_loader('query', query_dataset, batch_size)
     # 3.3 Get gallery set.
     gallery_path = os.path.join(dataset_path, 'bounding_box_test')
     gallery_transform = transform.get_transform(size=size, is_train=False)
     gallery_image_dataset = dataset.ImageDataset(
         style=dataset_style, path=gallery_path, transform=gallery_transform, name='Gallery', verbose=verbose)
     gallery_dataset = dataset.FeatureDataset(origin_dataset=gallery_image_dataset, model=base_model, device=device,
-                                             batch_size=batch_size, norm=dataset_norm, num_workers=num_workers, pin_memory=pin_memory)
-    gallery_loader = DataLoader(dataset=gallery_dataset, batch_size=batch_size,
-                                num_workers=num_workers, pin_memory=pin_memory)
+                                             batch_size=batch_size, norm=dataset_norm, num_workers=num_workers, pin_memory=pin_memory,
+                                             reduction=reduction_model)
+    gallery_loader = loader_manager.get_loader('gallery', gallery_dataset, batch_size)
 
     # 4 loss
     id_loss_weight = config['loss'].getfloat('id_loss_weight')
@@ -182,7 +191,7 @@ if __name__ == '__main__':
         iteration = 0
         logger.info('Epoch[{}/{}] Epoch start.'.format(epoch, epochs))
         epoch_start = time.time()
-        for features, labels, _, _ in train_loader:
+        for features, labels, _, _ in loader_manager.iterate('train'):
             # 7.3 Start iteration.
             iteration += 1
             diff_optimizer.zero_grad()
@@ -232,6 +241,9 @@ if __name__ == '__main__':
         if epoch % val_per_epochs == 0:
             logger.info('Start validation every {} epochs at epoch: {}'.format(
                 val_per_epochs, epoch))
+            # Workers load the first batches of the next epoch during validation.
+            if epoch < epochs:
+                loader_manager.prefetch('train')
             diff_model.eval()
             val_start = time.time()
             with torch.no_grad():
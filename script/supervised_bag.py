@@ -14,11 +14,11 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 
 sys.path.append("")
 from optimizer import lambda_calculator
-from model import bag_tricks, classifier
+from model import bag_tricks, classifier, recompute
 from metric import cmc_map, re_ranking
 from loss import id_loss, triplet_loss, center_loss, circle_loss, reg_loss
-from data import transform, dataset, sampler
-from util import config_parser, logger, tool, averager
+from data import transform, dataset, sampler, loader, tensor_cache
+from util import config_parser, logger, tool, averager, checkpoint
 
 
 if __name__ == '__main__':
@@ -70,38 +70,66 @@ if __name__ == '__main__':
     width = config['dataset'].getint('width')
     size = (height, width)
     random_erasing = config['dataset'].getboolean('random_erasing')
+    batch_augment = config['dataset'].getboolean('batch_augment')
     batch_size = config['dataset'].getint('batch_size')
     p = config['dataset'].getint('p')
     k = config['dataset'].getint('k')
     num_workers = config['dataset'].getint('num_workers')
     pin_memory = config['dataset'].getboolean('pin_memory')
     dataset_norm = config['dataset'].getboolean('norm')
+    extra_train = [x.strip() for x in config['dataset']['extra_train'].split(',') if x.strip() != '']
+    domain_balance = config['dataset'].getboolean('domain_balance')
+    # Scan dataset folders in parallel, datasets below load from manifests.
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
     # 3.1 Get train set.
     train_path = os.path.join(dataset_path, 'bounding_box_train')
     train_transform = transform.get_transform(
-        size=size, is_train=True, random_erasing=random_erasing)
+        size=size, is_train=True, random_erasing=random_erasing, batch_augment=batch_augment)
+    # Batched augmentation on device replaces the per-image train transform.
+    train_augment = transform.BatchAugment(
+        random_erasing=random_erasing) if batch_augment else None
     train_dataset = dataset.ImageDataset(
         style=dataset_style, path=train_path, transform=train_transform, name='Image Train', verbose=verbose)
+    if len(extra_train) > 0:
+        # Merge extra train sets ('style:path' pairs) into one label space, one domain per dataset.
+        train_datasets = [train_dataset]
+        for extra in extra_train:
+            extra_style, extra_path = extra.split(':', 1)
+            train_datasets.append(dataset.ImageDataset(
+                style=extra_style, path=os.path.join(extra_path, 'bounding_box_train'), transform=train_transform,
+                name='Image Train ' + os.path.basename(os.path.normpath(extra_path)), verbose=verbose))
+        train_dataset = dataset.ConcatReIDDataset(train_datasets, name='Image Train', verbose=verbose)
+        logger.info('Train labels: {}, num_class: {}'.format(len(np.unique(train_dataset.all_labels)), num_class))
     if p is not None and k is not None and p * k == batch_size:
-        # Use triplet sampler.
-        sampler = sampler.TripletSampler(
-            labels=train_dataset.labels, batch_size=batch_size, p=p, k=k)
-    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size,
-                              sampler=sampler, num_workers=num_workers, pin_memory=pin_memory)
+        if domain_balance and len(extra_train) > 0:
+            # Use domain-balanced triplet sampler.
+            sampler = sampler.DomainSampler(
+                labels=train_dataset.labels, domains=train_dataset.domains, batch_size=batch_size, p=p, k=k, seed=seed)
+        else:
+            # Use triplet sampler.
+            sampler = sampler.TripletSampler(
+                labels=train_dataset.labels, batch_size=batch_size, p=p, k=k, seed=seed)
+    # Loaders keep their workers alive across epochs and validations.
+    loader_manager = loader.LoaderManager(num_workers=num_workers, pin_memory=pin_memory)
+    train_loader = loader_manager.get_loader('train', train_dataset, batch_size, sampler=sampler)
     # 3.2 Get query set.
     query_path = os.path.join(dataset_path, 'query')
     query_transform = transform.get_transform(size=size, is_train=False)
     query_dataset = dataset.ImageDataset(
         style=dataset_style, path=query_path, transform=query_transform, name='Image Query', verbose=verbose)
-    query_loader = DataLoader(dataset=query_dataset, batch_size=batch_size,
-                              num_workers=num_workers, pin_memory=pin_memory)
+    query_loader = loader_manager.get_loader('query', query_dataset, batch_size)
     # 3.3 Get gallery set.
     gallery_path = os.path.join(dataset_path, 'bounding_box_test')
     gallery_transform = transform.get_transform(size=size, is_train=False)
     gallery_dataset = dataset.ImageDataset(
         style=dataset_style, path=gallery_path, transform=gallery_transform, name='Image Gallery', verbose=verbose)
-    gallery_loader = DataLoader(dataset=gallery_dataset, batch_size=batch_size,
-                                num_workers=num_workers, pin_memory=pin_memory)
+    gallery_loader = loader_manager.get_loader('gallery', gallery_dataset, batch_size)
+    # 3.4 Keep decoded eval images across validations.
+    if config['val'].getboolean('cache'):
+        tensor_cache.attach_caches(
+            [query_dataset, gallery_dataset], size, int(config['val'].getfloat('cache_gb') * 1024 ** 3),
+            dtype=config['val']['cache_dtype'], spill_path=config['val']['cache_spill_path'])
 
     # 4 loss
     id_loss_weight = config['loss'].getfloat('id_loss_weight')
@@ -176,6 +204,11 @@ if __name__ == '__main__':
         save_path, time.strftime("%Y%m%d", time.localtime()))
     if not os.path.isdir(save_path):
         os.mkdir(save_path)
+    resume = config['train']['resume']
+    save_state = config['train'].getboolean('save_state')
+    state_per_iterations = config['train'].getint('state_per_iterations')
+    recompute_stages = [x.strip() for x in config['train']['recompute'].split(',') if x.strip() != '']
+    memory_budget_mb = config['train'].getint('memory_budget_mb')
     val_norm = config['val'].getboolean('norm')
     re_rank = config['val'].getboolean('re_rank')
     minp = config['val'].getboolean('minp')
@@ -183,7 +216,23 @@ if __name__ == '__main__':
     # Make up batch templates.
     batch_template1, batch_template2 = tool.get_templates(
         batch_size, batch_size)
-    for epoch in range(1, epochs + 1):
+    # Resume models, optimizers, schedulers, sampler and random states.
+    state_models = {'base': base_model, 'classifier': classifier_model, 'center': center_loss_function}
+    state_optimizers = {'model': model_optimizer, 'center': center_optimizer}
+    state_schedulers = {'model': model_scheduler, 'center': center_scheduler}
+    state_file = os.path.join(save_path, '[supervised bag][state].pth')
+    start_epoch, start_iteration = 1, 0
+    if resume != '':
+        start_epoch, start_iteration = checkpoint.load_state(
+            resume, state_models, state_optimizers, state_schedulers, sampler)
+        logger.info('Resume from {} at epoch {} iteration {}.'.format(resume, start_epoch, start_iteration))
+    # Recompute backbone stages in backward, given or chosen to fit the activation memory budget.
+    recompute_stages = recompute.set_recompute(base_model, recompute_stages or None, memory_budget_mb,
+                                               size, batch_size, device)
+    logger.info('Recompute stages: {}'.format(recompute_stages))
+    if use_gpu:
+        torch.cuda.reset_peak_memory_stats()
+    for epoch in range(start_epoch, epochs + 1):
         # 7.2 Start epoch.
         # Set model to be trained.
         base_model.train()
@@ -197,11 +246,12 @@ if __name__ == '__main__':
         # circle_loss_averager.reset()
         # reg_loss_averager.reset()
         all_loss_averager.reset()
-        # Initialize epoch.
-        iteration = 0
+        # Initialize epoch, a resumed epoch skips its trained batches.
+        iteration = start_iteration if epoch == start_epoch else 0
+        sampler.set_epoch(epoch)
         logger.info('Epoch[{}/{}] Epoch start.'.format(epoch, epochs))
         epoch_start = time.time()
-        for images, labels, _, _ in train_loader:
+        for images, labels, _, _ in loader_manager.iterate('train'):
             # 7.3 Start iteration.
             iteration += 1
             model_optimizer.zero_grad()
@@ -211,6 +261,8 @@ if __name__ == '__main__':
             if use_gpu:
                 images = images.to(device)
                 labels = labels.to(device)
+            if train_augment is not None:
+                images = train_augment(images)
             features, final_features = base_model(images)
             predicted_labels = classifier_model(final_features)
             features1 = features[batch_template1, :]
@@ -252,6 +304,14 @@ if __name__ == '__main__':
             if iteration % log_iteration == 0:
                 logger.info('Epoch[{}/{}] Iteration[{}] Loss: {:.3f} Acc: {:.3f}'
                             .format(epoch, epochs, iteration, all_loss_averager.get_value(), acc_averager.get_value()))
+                if use_gpu:
+                    logger.info('Epoch[{}/{}] Iteration[{}] Peak memory: {:.0f}MB'
+                                .format(epoch, epochs, iteration, torch.cuda.max_memory_allocated() / 1024 ** 2))
+                    torch.cuda.reset_peak_memory_stats()
+            # 7.5.2 Save state for resuming inside the epoch.
+            if save_state and state_per_iterations > 0 and iteration % state_per_iterations == 0:
+                checkpoint.save_state(state_file, epoch, iteration, state_models, state_optimizers,
+                                      state_schedulers, sampler)
         # 7.6 End epoch.
         epoch_end = time.time()
         # 7.6.1 Summary epoch.
@@ -275,6 +335,10 @@ if __name__ == '__main__':
         if epoch % val_per_epochs == 0:
             logger.info('Start validation every {} epochs at epoch: {}'.format(
                 val_per_epochs, epoch))
+            # Workers load the first batches of the next epoch during validation.
+            if epoch < epochs:
+                sampler.set_epoch(epoch + 1)
+                loader_manager.prefetch('train')
             base_model.eval()
             classifier_model.eval()
             val_start = time.time()
@@ -360,3 +424,7 @@ if __name__ == '__main__':
                     "%H%M%S", time.localtime()) + '[base]' + str(epoch) + '.pth'
                 torch.save(base_model.state_dict(),
                            os.path.join(save_path, base_save_name))
+        # 7.9 Save state for resuming at the next epoch.
+        if save_state:
+            checkpoint.save_state(state_file, epoch + 1, 0, state_models, state_optimizers,
+                                  state_schedulers, sampler)
@@ -17,7 +17,7 @@ from optimizer import lambda_calculator
 from model import bag_tricks, classifier, diff_attention
 from metric import cmc_map, re_ranking
 from loss import id_loss, triplet_loss, center_loss, circle_loss, reg_loss
-from data import transform, dataset, sampler
+from data import transform, dataset, sampler, loader, tensor_cache
 from util import config_parser, logger, tool, averager
 
 
@@ -82,38 +82,49 @@ if __name__ == '__main__':
     width = config['dataset'].getint('width')
     size = (height, width)
     random_erasing = config['dataset'].getboolean('random_erasing')
+    batch_augment = config['dataset'].getboolean('batch_augment')
     batch_size = config['dataset'].getint('batch_size')
     p = config['dataset'].getint('p')
     k = config['dataset'].getint('k')
     num_workers = config['dataset'].getint('num_workers')
     pin_memory = config['dataset'].getboolean('pin_memory')
     dataset_norm = config['dataset'].getboolean('norm')
+    # Scan dataset folders in parallel, datasets below load from manifests.
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
     # 3.1 Get train set.
     train_path = os.path.join(dataset_path, 'bounding_box_train')
     train_transform = transform.get_transform(
-        size=size, is_train=True, random_erasing=random_erasing)
+        size=size, is_train=True, random_erasing=random_erasing, batch_augment=batch_augment)
+    # Batched augmentation on device replaces the per-image train transform.
+    train_augment = transform.BatchAugment(
+        random_erasing=random_erasing) if batch_augment else None
     train_dataset = dataset.ImageDataset(
         style=dataset_style, path=train_path, transform=train_transform, name='Image Train', verbose=verbose)
     if p is not None and k is not None and p * k == batch_size:
         # Use triplet sampler.
         sampler = sampler.TripletSampler(
-            labels=train_dataset.labels, batch_size=batch_size, p=p, k=k)
-    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size,
-                              sampler=sampler, num_workers=num_workers, pin_memory=pin_memory)
+            labels=train_dataset.labels, batch_size=batch_size, p=p, k=k, seed=seed)
+    # Loaders keep their workers alive across epochs and validations.
+    loader_manager = loader.LoaderManager(num_workers=num_workers, pin_memory=pin_memory)
+    train_loader = loader_manager.get_loader('train', train_dataset, batch_size, sampler=sampler)
     # 3.2 Get query set.
     query_path = os.path.join(dataset_path, 'query')
     query_transform = transform.get_transform(size=size, is_train=False)
     query_dataset = dataset.ImageDataset(
         style=dataset_style, path=query_path, transform=query_transform, name='Image Query', verbose=verbose)
-    query_loader = DataLoader(dataset=query_dataset, batch_size=batch_size,
-                              num_workers=num_workers, pin_memory=pin_memory)
+    query_loader = loader_manager.get_loader('query', query_dataset, batch_size)
     # 3.3 Get gallery set.
     gallery_path = os.path.join(dataset_path, 'bounding_box_test')
     gallery_transform = transform.get_transform(size=size, is_train=False)
     gallery_dataset = dataset.ImageDataset(
         style=dataset_style, path=gallery_path, transform=gallery_transform, name='Image Gallery', verbose=verbose)
-    gallery_loader = DataLoader(dataset=gallery_dataset, batch_size=batch_size,
-                                num_workers=num_workers, pin_memory=pin_memory)
+    gallery_loader = loader_manager.get_loader('gallery', gallery_dataset, batch_size)
+    # 3.4 Keep decoded eval images across validations.
+    if config['val'].getboolean('cache'):
+        tensor_cache.attach_caches(
+            [query_dataset, gallery_dataset], size, int(config['val'].getfloat('cache_gb') * 1024 ** 3),
+            dtype=config['val']['cache_dtype'], spill_path=config['val']['cache_spill_path'])
 
     # 4 loss
     id_loss_weight = config['loss'].getfloat('id_loss_weight')
@@ -214,7 +225,7 @@ if __name__ == '__main__':
         iteration = 0
         logger.info('Epoch[{}/{}] Epoch start.'.format(epoch, epochs))
         epoch_start = time.time()
-        for images, labels, _, _ in train_loader:
+        for images, labels, _, _ in loader_manager.iterate('train'):
             # 7.3 Start iteration.
             iteration += 1
             model_optimizer.zero_grad()
@@ -224,6 +235,8 @@ if __name__ == '__main__':
             if use_gpu:
                 images = images.to(device)
                 labels = labels.to(device)
+            if train_augment is not None:
+                images = train_augment(images)
             features, final_features = base_model(images)
             predicted_labels = classifier_model(final_features)
             features1 = features[batch_template1, :]
@@ -290,6 +303,9 @@ if __name__ == '__main__':
         if epoch % val_per_epochs == 0:
             logger.info('Start validation every {} epochs at epoch: {}'.format(
                 val_per_epochs, epoch))
+            # Workers load the first batches of the next epoch during validation.
+            if epoch < epochs:
+                loader_manager.prefetch('train')
             base_model.eval()
             classifier_model.eval()
             diff_model.eval()
@@ -0,0 +1,263 @@
+import csv
+import os
+import time
+import sys
+
+import torch
+from torch.optim import Adam
+from torch.optim.lr_scheduler import LambdaLR
+import torch.multiprocessing
+torch.multiprocessing.set_sharing_strategy('file_system')
+
+sys.path.append("")
+from optimizer import lambda_calculator
+from model import bag_tricks, agw, diff_attention, diff_scorer, da_embedding, reduction, loading
+from metric import cmc_map
+from loss import rank_distill_loss
+from data import transform, dataset, sampler, loader
+from util import config_parser, logger, tool, averager
+
+
+def get_features(feature_loader, device):
+    features = []
+    pids = []
+    camids = []
+    for batch_features, _, batch_pids, batch_camids in feature_loader:
+        features.append(batch_features.to(device))
+        pids.extend(batch_pids)
+        camids.extend(batch_camids)
+    return torch.cat(features, dim=0), pids, camids
+
+
+def evaluate(mode, scorer, embedding_model, query, gallery, device, norm, top_k, batch_size):
+    # Rank-1, mAP and query latency in ms of mode in {pairwise, embedding, embedding+rerank}.
+    # Gallery projections and embeddings are index time, queries are embedded and scored in the timing.
+    (query_features, query_pids, query_camids), (gallery_features, gallery_pids, gallery_camids) = query, gallery
+    embedding_model.eval()
+    with torch.no_grad():
+        gallery_projections = scorer.project(gallery_features)
+        gallery_embeddings = embedding_model(gallery_features)
+        if norm:
+            gallery_embeddings = torch.nn.functional.normalize(gallery_embeddings, p=2, dim=1)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        time_start = time.time()
+        distance_matrix = []
+        for start in range(0, query_features.shape[0], batch_size):
+            query_feature = query_features[start:start + batch_size]
+            if mode == 'pairwise':
+                query_projection = scorer.project(query_feature)
+                distance = torch.cat([scorer.distance(query_feature, query_projection,
+                                                      gallery_features[index:index + batch_size],
+                                                      gallery_projections[index:index + batch_size], norm=norm)
+                                      for index in range(0, gallery_features.shape[0], batch_size)], dim=1)
+            else:
+                query_embedding = embedding_model(query_feature)
+                if norm:
+                    query_embedding = torch.nn.functional.normalize(query_embedding, p=2, dim=1)
+                distance = torch.cdist(query_embedding, gallery_embeddings)
+                if mode == 'embedding+rerank':
+                    distance = scorer.rerank(distance, query_feature, scorer.project(query_feature),
+                                             gallery_features, gallery_projections, top_k, norm=norm)
+            distance_matrix.append(distance)
+        distance_matrix = torch.cat(distance_matrix, dim=0)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        latency = (time.time() - time_start) / query_features.shape[0] * 1000
+    cmc, mAP = cmc_map.cmc_map(distance_matrix.cpu().numpy(), query_pids, gallery_pids, query_camids, gallery_camids)
+    return cmc[0], mAP, latency
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('supervised Diff Attention distillation')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    base_path = config['model']['path']
+    num_feature = config['model'].getint('num_feature')
+    in_transform = config['da']['in_transform']
+    diff_ratio = config['da'].getint('diff_ratio')
+    out_transform = config['da']['out_transform']
+    aggregate = config['da'].getboolean('aggregate')
+    diff_model_path = config['da']['diff_model_path']
+    model_name = config['da_distill']['model']
+    dim = config['da_distill'].getint('dim')
+    # 2.1 Get feature model of the daoff run.
+    model_class = agw.Baseline if model_name == 'agw' else bag_tricks.Baseline
+    base_model = loading.build_model(lambda: model_class(pretrain_choice='self'), base_path, device=device)
+    logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+    reduction_path = config['model']['reduction_path']
+    reduction_model = None
+    if reduction_path != '':
+        reduction_model = reduction.load_reduction(reduction_path, device=device)
+        num_feature = reduction_model.dim
+        logger.info('Reduce features to {} dimensions.'.format(num_feature))
+    # 2.2 Get trained Diff Attention Module, the teacher, as a scorer.
+    diff_model = diff_attention.DiffAttentionModule(
+        num_feature=num_feature, in_transform=in_transform, diff_ratio=diff_ratio, out_transform=out_transform,
+        aggregate=aggregate)
+    diff_model.load_state_dict(torch.load(diff_model_path, map_location='cpu'))
+    diff_model = diff_model.to(device)
+    diff_model.eval()
+    scorer = diff_scorer.DiffAttentionScorer(base_model, diff_model)
+    logger.info('Diff Attention Module: ' + str(tool.get_parameter_number(diff_model)))
+    # 2.3 Get per-image embedding, the student.
+    embedding_model = da_embedding.DAEmbedding(num_feature=num_feature, dim=dim).to(device)
+    logger.info('Embedding: ' + str(tool.get_parameter_number(embedding_model)))
+
+    # 3 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    random_erasing = config['dataset'].getboolean('random_erasing')
+    batch_size = config['dataset'].getint('batch_size')
+    p = config['dataset'].getint('p')
+    k = config['dataset'].getint('k')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    dataset_norm = config['dataset'].getboolean('norm')
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
+    loader_manager = loader.LoaderManager(num_workers=num_workers, pin_memory=pin_memory)
+    feature_datasets = {}
+    for name, folder, is_train in [('train', 'bounding_box_train', True), ('query', 'query', False),
+                                   ('gallery', 'bounding_box_test', False)]:
+        image_transform = transform.get_transform(size=size, is_train=is_train, random_erasing=random_erasing)
+        image_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, folder),
+                                             transform=image_transform, name=name.capitalize(), verbose=verbose)
+        feature_datasets[name] = dataset.FeatureDataset(
+            origin_dataset=image_dataset, model=base_model, device=device, batch_size=batch_size, norm=dataset_norm,
+            num_workers=num_workers, pin_memory=pin_memory, reduction=reduction_model)
+    # 3.1 Get train set.
+    train_sampler = sampler.TripletSampler(
+        labels=feature_datasets['train'].labels, batch_size=batch_size, p=p, k=k, seed=seed)
+    train_loader = loader_manager.get_loader('train', feature_datasets['train'], batch_size, sampler=train_sampler)
+    # 3.2 Get query and gallery features, fixed as the feature model is.
+    query = get_features(loader_manager.get_loader('query', feature_datasets['query'], batch_size), device)
+    gallery = get_features(loader_manager.get_loader('gallery', feature_datasets['gallery'], batch_size), device)
+
+    # 4 loss
+    distance_loss_weight = config['da_distill'].getfloat('distance_loss_weight')
+    rank_loss_weight = config['da_distill'].getfloat('rank_loss_weight')
+    temperature = config['da_distill'].getfloat('temperature')
+    loss_function = rank_distill_loss.RankDistillLoss(
+        distance_weight=distance_loss_weight, rank_weight=rank_loss_weight, temperature=temperature)
+
+    # 5 optimizer
+    lr = config['da_distill'].getfloat('lr')
+    milestone = config['optimizer']['milestone']
+    milestones = [] if milestone == '' else [int(x) for x in milestone.split(',')]
+    weight_decay = config['optimizer'].getfloat('weight_decay')
+    warmup = config['optimizer'].getboolean('warmup')
+    embedding_optimizer = Adam(embedding_model.parameters(), lr=lr, weight_decay=weight_decay)
+    embedding_scheduler = LambdaLR(embedding_optimizer, lambda_calculator.get_lambda_calculator(
+        milestones=milestones, warmup=warmup))
+
+    # 6 metric
+    distance_loss_averager = averager.Averager()
+    rank_loss_averager = averager.Averager()
+    all_loss_averager = averager.Averager()
+
+    # 7 train and eval
+    epochs = config['train'].getint('epochs')
+    val_per_epochs = config['train'].getint('val_per_epochs')
+    log_iteration = config['train'].getint('log_iteration')
+    save = config['train'].getboolean('save')
+    save_per_epochs = config['train'].getint('save_per_epochs')
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    val_norm = config['val'].getboolean('norm')
+    top_k = config['da_distill'].getint('top_k')
+    for epoch in range(1, epochs + 1):
+        # 7.1 Train.
+        embedding_model.train()
+        distance_loss_averager.reset()
+        rank_loss_averager.reset()
+        all_loss_averager.reset()
+        train_sampler.set_epoch(epoch)
+        iteration = 0
+        epoch_start = time.time()
+        for features, _, _, _ in loader_manager.iterate('train'):
+            iteration += 1
+            embedding_optimizer.zero_grad()
+            features = features.to(device)
+            # Teacher distances of all batch pairs, from the projections of each feature.
+            with torch.no_grad():
+                projections = scorer.project(features)
+                teacher_distance = scorer.distance(features, projections, features, projections, norm=val_norm)
+            embeddings = embedding_model(features)
+            if val_norm:
+                embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+            student_distance = torch.cdist(embeddings, embeddings)
+            distance_loss, rank_loss = loss_function(student_distance, teacher_distance)
+            all_loss = distance_loss + rank_loss
+            all_loss.backward()
+            embedding_optimizer.step()
+            distance_loss_averager.update(distance_loss.item())
+            rank_loss_averager.update(rank_loss.item())
+            all_loss_averager.update(all_loss.item())
+            if iteration % log_iteration == 0:
+                logger.info('Epoch[{}/{}] Iteration[{}] Loss: {:.3f}'
+                            .format(epoch, epochs, iteration, all_loss_averager.get_value()))
+        epoch_end = time.time()
+        logger.info('Epoch[{}/{}] Loss: {:.3f} Base Lr: {:.2e}'.format(
+            epoch, epochs, all_loss_averager.get_value(), embedding_scheduler.get_last_lr()[0]))
+        logger.info('Epoch[{}/{}] Distance_Loss: {:.3f} Rank_Loss: {:.3f}'.format(
+            epoch, epochs, distance_loss_averager.get_value(), rank_loss_averager.get_value()))
+        logger.info('Train time taken: ' + time.strftime("%H:%M:%S", time.gmtime(epoch_end - epoch_start)))
+        embedding_scheduler.step()
+        # 7.2 Eval the embedding alone.
+        if epoch % val_per_epochs == 0:
+            rank1, mAP, latency = evaluate('embedding', scorer, embedding_model, query, gallery, device, val_norm,
+                                           top_k, batch_size)
+            logger.info('Epoch[{}/{}] Embedding Rank-1: {:.1%}, mAP: {:.1%}'.format(epoch, epochs, rank1, mAP))
+        # 7.3 Save checkpoint.
+        if save and epoch % save_per_epochs == 0:
+            embedding_save_name = '[supervised {} da distill]'.format(model_name) + time.strftime(
+                "%H%M%S", time.localtime()) + '[embedding]' + str(epoch) + '.pth'
+            torch.save(embedding_model.state_dict(), os.path.join(save_path, embedding_save_name))
+            logger.info('Save model: ' + os.path.join(save_path, embedding_save_name))
+
+    # 8 compare with pairwise Diff Attention
+    results = []
+    modes = ['pairwise', 'embedding'] + (['embedding+rerank'] if top_k > 0 else [])
+    for mode in modes:
+        rank1, mAP, latency = evaluate(mode, scorer, embedding_model, query, gallery, device, val_norm, top_k,
+                                       batch_size)
+        result = {'mode': mode, 'top_k': top_k if mode == 'embedding+rerank' else 0, 'rank1': rank1, 'map': mAP,
+                  'query_latency_ms': latency}
+        results.append(result)
+        logger.info('{mode}: Rank-1 {rank1:.1%}, mAP {map:.1%}, {query_latency_ms:.3f}ms per query'.format(**result))
+    table_save_name = '[supervised {} da distill]{}.csv'.format(model_name, time.strftime("%H%M%S", time.localtime()))
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['mode', 'top_k', 'rank1', 'map', 'query_latency_ms'])
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
@@ -0,0 +1,253 @@
+import copy
+import os
+import time
+import sys
+import numpy as np
+
+import torch
+from torch import nn
+from torch.optim import Adam
+from torch.optim.lr_scheduler import LambdaLR
+import torch.multiprocessing
+torch.multiprocessing.set_sharing_strategy('file_system')
+
+sys.path.append("")
+from optimizer import lambda_calculator
+from model import bag_tricks, agw, classifier, hashing, loading
+from metric import cmc_map, hamming
+from loss import id_loss, triplet_loss, quantization_loss
+from data import transform, dataset, sampler, loader
+from util import config_parser, logger, tool, averager
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('supervised Hash')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    base_path = config['model']['path']
+    num_class = config['model'].getint('num_class')
+    num_feature = config['model'].getint('num_feature')
+    bias = config['model'].getboolean('bias')
+    num_bit = config['hash'].getint('num_bit')
+    # 2.1 Get trained feature model, kept frozen.
+    model_class = agw.Baseline if config['hash']['model'] == 'agw' else bag_tricks.Baseline
+    base_model = loading.build_model(lambda: model_class(pretrain_choice='self'), base_path, device=device)
+    logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+    # 2.2 Get hash head.
+    hash_model = hashing.HashHead(num_feature=num_feature, num_bit=num_bit)
+    if use_gpu:
+        hash_model = hash_model.to(device)
+    logger.info('Hash Head: ' + str(tool.get_parameter_number(hash_model)))
+    # 2.3 Get classifier on codes.
+    classifier_model = classifier.Classifier(num_bit, num_class, bias=bias)
+    if use_gpu:
+        classifier_model = classifier_model.to(device)
+
+    # 3 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    batch_size = config['dataset'].getint('batch_size')
+    p = config['dataset'].getint('p')
+    k = config['dataset'].getint('k')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    dataset_norm = config['dataset'].getboolean('norm')
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
+    # Features are extracted once without augmentation, the head trains on them.
+    eval_transform = transform.get_transform(size=size, is_train=False)
+    feature_datasets = {}
+    for name, folder in [('train', 'bounding_box_train'), ('query', 'query'), ('gallery', 'bounding_box_test')]:
+        image_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, folder),
+                                             transform=eval_transform, name='Image ' + name, verbose=verbose)
+        feature_datasets[name] = dataset.FeatureDataset(
+            origin_dataset=image_dataset, model=base_model, device=device, batch_size=batch_size, norm=dataset_norm,
+            num_workers=num_workers, pin_memory=pin_memory)
+    # 3.1 Get train set.
+    train_sampler = sampler.TripletSampler(
+        labels=feature_datasets['train'].get_labels(), batch_size=batch_size, p=p, k=k, seed=seed)
+    loader_manager = loader.LoaderManager(num_workers=0, pin_memory=False)
+    train_loader = loader_manager.get_loader('train', feature_datasets['train'], batch_size, sampler=train_sampler)
+    # 3.2 Get query and gallery sets.
+    query_loader = loader_manager.get_loader('query', feature_datasets['query'], batch_size)
+    gallery_loader = loader_manager.get_loader('gallery', feature_datasets['gallery'], batch_size)
+
+    # 4 loss
+    id_loss_weight = config['loss'].getfloat('id_loss_weight')
+    smooth = config['loss'].getboolean('label_smooth')
+    triplet_loss_weight = config['loss'].getfloat('triplet_loss_weight')
+    margin = config['loss'].getfloat('margin')
+    soft_margin = config['loss'].getboolean('soft_margin')
+    quantization_loss_weight = config['hash'].getfloat('quantization_loss_weight')
+    # 4.1 Get id loss.
+    if smooth:
+        id_loss_function = id_loss.CrossEntropyLabelSmooth(
+            num_class=num_class, use_gpu=use_gpu, device=device)
+    else:
+        id_loss_function = nn.CrossEntropyLoss()
+    # 4.2 Get triplet loss.
+    triplet_loss_function = triplet_loss.TripletLoss(margin=margin, batch_size=batch_size, p=p, k=k,
+                                                     soft_margin=soft_margin)
+    # 4.3 Get quantization loss.
+    quantization_loss_function = quantization_loss.QuantizationLoss()
+
+    # 5 optimizer
+    init_lr = config['optimizer'].getfloat('init_lr')
+    milestone = config['optimizer']['milestone']
+    milestones = [] if milestone == '' else [
+        int(x) for x in milestone.split(',')]
+    weight_decay = config['optimizer'].getfloat('weight_decay')
+    warmup = config['optimizer'].getboolean('warmup')
+    hash_optimizer = Adam([{'params': hash_model.parameters()}, {'params': classifier_model.parameters()}],
+                          lr=init_lr, weight_decay=weight_decay)
+    hash_lambda_function = lambda_calculator.get_lambda_calculator(
+        milestones=milestones, warmup=warmup)
+    hash_scheduler = LambdaLR(hash_optimizer, hash_lambda_function)
+
+    # 6 metric
+    # 6.1 Get CMC and mAP metric.
+    cmc_map_function = cmc_map.cmc_map
+    # 6.2 Get averagers.
+    id_loss_averager = averager.Averager()
+    triplet_loss_averager = averager.Averager()
+    quantization_loss_averager = averager.Averager()
+    all_loss_averager = averager.Averager()
+
+    # 7 train and eval
+    epochs = config['train'].getint('epochs')
+    val_per_epochs = config['train'].getint('val_per_epochs')
+    log_iteration = config['train'].getint('log_iteration')
+    save = config['train'].getboolean('save')
+    save_per_epochs = config['train'].getint('save_per_epochs')
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    minp = config['val'].getboolean('minp')
+    # 7.1 Initialize env.
+    batch_template1, batch_template2 = tool.get_templates(
+        batch_size, batch_size)
+    for epoch in range(1, epochs + 1):
+        # 7.2 Start epoch.
+        hash_model.train()
+        classifier_model.train()
+        id_loss_averager.reset()
+        triplet_loss_averager.reset()
+        quantization_loss_averager.reset()
+        all_loss_averager.reset()
+        iteration = 0
+        train_sampler.set_epoch(epoch)
+        logger.info('Epoch[{}/{}] Epoch start.'.format(epoch, epochs))
+        epoch_start = time.time()
+        for features, labels, _, _ in loader_manager.iterate('train'):
+            # 7.3 Start iteration.
+            iteration += 1
+            hash_optimizer.zero_grad()
+            # 7.4 Train.
+            # 7.4.1 Forward.
+            if use_gpu:
+                features = features.to(device)
+                labels = labels.to(device)
+            codes = hash_model(features)
+            predicted_labels = classifier_model(codes)
+            # 7.4.2 Calculate loss.
+            id_loss = id_loss_function(
+                predicted_labels, copy.deepcopy(labels)) * id_loss_weight
+            triplet_loss = triplet_loss_function(
+                codes[batch_template1, :], codes[batch_template2, :]) * triplet_loss_weight
+            quantization_loss = quantization_loss_function(codes) * quantization_loss_weight
+            all_loss = id_loss + triplet_loss + quantization_loss
+            # 7.4.3 Optimize.
+            all_loss.backward()
+            hash_optimizer.step()
+            # 7.4.4 Log losses.
+            id_loss_averager.update(id_loss.item())
+            triplet_loss_averager.update(triplet_loss.item())
+            quantization_loss_averager.update(quantization_loss.item())
+            all_loss_averager.update(all_loss.item())
+            # 7.5 End iteration.
+            if iteration % log_iteration == 0:
+                logger.info('Epoch[{}/{}] Iteration[{}] Loss: {:.3f}'
+                            .format(epoch, epochs, iteration, all_loss_averager.get_value()))
+        # 7.6 End epoch.
+        epoch_end = time.time()
+        logger.info('Epoch[{}/{}] Loss: {:.3f} Base Lr: {:.2e}'.format(
+            epoch, epochs, all_loss_averager.get_value(), hash_scheduler.get_last_lr()[0]))
+        logger.info('Epoch[{}/{}] ID_Loss: {:.3f} Triplet_Loss: {:.3f} Quantization_Loss: {:.3f}'.format(
+            epoch, epochs, id_loss_averager.get_value(), triplet_loss_averager.get_value(),
+            quantization_loss_averager.get_value()))
+        logger.info('Train time taken: ' + time.strftime("%H:%M:%S",
+                                                         time.gmtime(epoch_end - epoch_start)))
+        hash_scheduler.step()
+        # 7.7 Eval with Hamming distances of the binary codes.
+        if epoch % val_per_epochs == 0:
+            logger.info('Start validation every {} epochs at epoch: {}'.format(
+                val_per_epochs, epoch))
+            hash_model.eval()
+            val_start = time.time()
+            codes = {}
+            with torch.no_grad():
+                for name, val_loader in [('query', query_loader), ('gallery', gallery_loader)]:
+                    val_codes = []
+                    val_pids = []
+                    val_camids = []
+                    for val_feature, _, pids, camids in val_loader:
+                        val_codes.append(hash_model.encode(val_feature.to(device)).cpu().numpy())
+                        val_pids.extend(pids)
+                        val_camids.extend(camids)
+                    codes[name] = (hamming.pack_codes(np.concatenate(val_codes, axis=0)), val_pids, val_camids)
+            query_codes, query_pids, query_camids = codes['query']
+            gallery_codes, gallery_pids, gallery_camids = codes['gallery']
+            distance_matrix = hamming.hamming_distance(query_codes, gallery_codes).astype(np.float32)
+            if minp:
+                logger.info('Compute CMC, mAP and mINP.')
+                cmc, mAP, mINP = cmc_map_function(
+                    distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids, minp=minp)
+                logger.info("CMC curve, Rank-{}: {:.1%}".format(1, cmc[0]))
+                logger.info("mAP: {:.1%}".format(mAP))
+                logger.info("mINP: {:.1%}".format(mINP))
+            else:
+                logger.info('Compute CMC and mAP.')
+                cmc, mAP = cmc_map_function(
+                    distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids, minp=minp)
+                logger.info("CMC curve, Rank-{}: {:.1%}".format(1, cmc[0]))
+                logger.info("mAP: {:.1%}".format(mAP))
+            val_end = time.time()
+            logger.info('Val time taken: ' + time.strftime("%H:%M:%S",
+                                                           time.gmtime(val_end - val_start)))
+        # 7.8 Save checkpoint.
+        if save:
+            if epoch % save_per_epochs == 0:
+                logger.info('Save checkpoint every {} epochs at epoch: {}'.format(
+                    save_per_epochs, epoch))
+                hash_save_name = '[supervised hash]' + time.strftime(
+                    "%H%M%S", time.localtime()) + '[hash{}]'.format(num_bit) + str(epoch) + '.pth'
+                torch.save(hash_model.state_dict(),
+                           os.path.join(save_path, hash_save_name))
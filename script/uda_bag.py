@@ -13,11 +13,11 @@ from sklearn.cluster import KMeans, MiniBatchKMeans, DBSCAN, SpectralClustering
 
 sys.path.append("")
 from optimizer import lambda_calculator
-from model import bag_tricks, classifier
+from model import bag_tricks, classifier, camera_norm
 from metric import cmc_map, re_ranking
 from loss import id_loss, triplet_loss, center_loss, circle_loss, reg_loss
-from data import transform, dataset, sampler
-from util import config_parser, logger, tool, averager
+from data import transform, dataset, sampler, loader, tensor_cache
+from util import config_parser, logger, tool, averager, feature_bank, cluster
 
 if __name__ == '__main__':
     # 0 introduction
@@ -70,16 +70,25 @@ if __name__ == '__main__':
     width = config['dataset'].getint('width')
     size = (height, width)
     random_erasing = config['dataset'].getboolean('random_erasing')
+    batch_augment = config['dataset'].getboolean('batch_augment')
     batch_size = config['dataset'].getint('batch_size')
     p = config['dataset'].getint('p')
     k = config['dataset'].getint('k')
     num_workers = config['dataset'].getint('num_workers')
     pin_memory = config['dataset'].getboolean('pin_memory')
     dataset_norm = config['dataset'].getboolean('norm')
+    # Scan dataset folders in parallel, datasets below load from manifests.
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['bounding_box_train', 'query', 'bounding_box_test']])
+    # Loaders keep their workers alive across steps, epochs and validations.
+    loader_manager = loader.LoaderManager(num_workers=num_workers, pin_memory=pin_memory)
     # 3.1 Get train set.
     train_path = os.path.join(dataset_path, 'bounding_box_train')
     train_transform = transform.get_transform(
-        size=size, is_train=True, random_erasing=random_erasing)
+        size=size, is_train=True, random_erasing=random_erasing, batch_augment=batch_augment)
+    # Batched augmentation on device replaces the per-image train transform.
+    train_augment = transform.BatchAugment(
+        random_erasing=random_erasing) if batch_augment else None
     train_dataset = dataset.ImageDataset(
         style=dataset_style, path=train_path, transform=train_transform, name='Image Train', verbose=verbose)
     # 3.2 Get query set.
@@ -87,15 +96,18 @@ if __name__ == '__main__':
     query_transform = transform.get_transform(size=size, is_train=False)
     query_dataset = dataset.ImageDataset(
         style=dataset_style, path=query_path, transform=query_transform, name='Image Query', verbose=verbose)
-    query_loader = DataLoader(dataset=query_dataset, batch_size=batch_size,
-                              num_workers=num_workers, pin_memory=pin_memory)
+    query_loader = loader_manager.get_loader('query', query_dataset, batch_size)
     # 3.3 Get gallery set.
     gallery_path = os.path.join(dataset_path, 'bounding_box_test')
     gallery_transform = transform.get_transform(size=size, is_train=False)
     gallery_dataset = dataset.ImageDataset(
         style=dataset_style, path=gallery_path, transform=gallery_transform, name='Image Gallery', verbose=verbose)
-    gallery_loader = DataLoader(dataset=gallery_dataset, batch_size=batch_size,
-                                num_workers=num_workers, pin_memory=pin_memory)
+    gallery_loader = loader_manager.get_loader('gallery', gallery_dataset, batch_size)
+    # 3.4 Keep decoded eval images across validations.
+    if config['val'].getboolean('cache'):
+        tensor_cache.attach_caches(
+            [query_dataset, gallery_dataset], size, int(config['val'].getfloat('cache_gb') * 1024 ** 3),
+            dtype=config['val']['cache_dtype'], spill_path=config['val']['cache_spill_path'])
 
     # 4 loss
     id_loss_weight = config['loss'].getfloat('id_loss_weight')
@@ -176,8 +188,30 @@ if __name__ == '__main__':
     re_rank = config['val'].getboolean('re_rank')
     merge_percent = config['unsupervised'].getfloat('merge_percent')
     steps = config['unsupervised'].getint('steps')
+    min_cluster_size = config['unsupervised'].getint('min_cluster_size')
     logger.info('Merge percent: ' + str(merge_percent))
     logger.info('Steps: ' + str(steps))
+    # Feature bank updated by the training loop, read by clustering.
+    train_feature_bank = None
+    bank_eval_features = config['unsupervised'].getboolean('bank_eval_features')
+    if config['unsupervised'].getboolean('feature_bank'):
+        train_feature_bank = feature_bank.FeatureBank(
+            num_sample=len(train_dataset), num_feature=num_feature,
+            momentum=config['unsupervised'].getfloat('bank_momentum'),
+            refresh_steps=config['unsupervised'].getint('bank_refresh_steps'),
+            min_coverage=config['unsupervised'].getfloat('bank_min_coverage'), device=device)
+        logger.info('Use feature bank with momentum: ' + str(train_feature_bank.momentum))
+        # Inactive samples are extracted again with the eval transform before clustering from the bank.
+        refresh_dataset = dataset.ImageDataset(
+            style=dataset_style, path=train_path, transform=query_transform, name='Image Refresh', verbose=False)
+        refresh_sampler = sampler.IndexSampler()
+    # Camera normalization fitted on train features, applied before clustering and retrieval.
+    camera_model = None
+    if config['unsupervised'].getboolean('camera_norm'):
+        camera_model = camera_norm.CameraNorm(
+            num_feature=num_feature, mode=config['unsupervised']['camera_norm_mode'])
+        camera_model = camera_model.to(device)
+        logger.info('Use camera normalization with mode: ' + camera_model.mode)
     for step in range(1, steps + 1):
         logger.info('Step[{}/{}] Step start.'.format(step, steps))
         # 7.1 Make up labels.
@@ -187,22 +221,46 @@ if __name__ == '__main__':
             train_dataset.set_labels([x for x in range(1, clusters + 1)])
         else:
             logger.info('Make up labels via clustering.')
-            # Detect image features.
-            cluster_loader = DataLoader(
-                dataset=train_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory)
-            base_model.eval()
-            train_features = []
-            batch = 0
-            for images, _, _, _ in cluster_loader:
-                batch += 1
-                if batch % 20 == 0:
-                    print('Batch:{}...'.format(batch))
-                if use_gpu:
-                    images = images.to(device)
-                features = base_model(images)
-                features = features.cpu().detach()
-                train_features.append(features)
-            train_features = np.concatenate(train_features, axis=0)
+            if train_feature_bank is not None and not train_feature_bank.need_refresh(step):
+                # Read image features from feature bank.
+                logger.info('Read features from feature bank, coverage: {:.1%}'.format(
+                    train_feature_bank.get_coverage()))
+                # Samples labeled 0 are never trained on, extract them again before clustering.
+                inactive_indexes = train_feature_bank.get_inactive_indexes()
+                if len(inactive_indexes) > 0:
+                    logger.info('Refresh {} inactive samples.'.format(len(inactive_indexes)))
+                    refresh_sampler.set_indexes(inactive_indexes)
+                    loader_manager.get_loader('refresh', refresh_dataset, batch_size, sampler=refresh_sampler)
+                    train_feature_bank.set_rows(inactive_indexes, feature_bank.extract_features(
+                        base_model, loader_manager.iterate('refresh'), device))
+                train_features = train_feature_bank.get_features()
+            else:
+                # Detect image features.
+                cluster_loader = loader_manager.get_loader('cluster', train_dataset, batch_size)
+                base_model.eval()
+                train_features = []
+                batch = 0
+                with torch.no_grad():
+                    for images, _, _, _ in loader_manager.iterate('cluster'):
+                        batch += 1
+                        if batch % 20 == 0:
+                            print('Batch:{}...'.format(batch))
+                        if use_gpu:
+                            images = images.to(device)
+                        if train_augment is not None:
+                            images = train_augment(images)
+                        features = base_model(images)
+                        features = features.cpu().detach()
+                        train_features.append(features)
+                train_features = np.concatenate(train_features, axis=0)
+                if train_feature_bank is not None:
+                    train_feature_bank.reset(train_features)
+            if camera_model is not None:
+                # Remove camera bias of features.
+                train_tensor = torch.as_tensor(train_features).to(device)
+                camera_model.fit(train_tensor, train_dataset.camids)
+                train_features = camera_model(
+                    train_tensor, train_dataset.camids).cpu().numpy()
             # print(train_features.shape)
             # Calculate number of clusters.
             # clusters = round(clusters - len(train_dataset) * merge_percent)
@@ -227,17 +285,25 @@ if __name__ == '__main__':
             # spectral = SpectralClustering(
             #     n_clusters=clusters, random_state=seed, assign_labels='discretize').fit(train_features)
             # new_labels = spectral.labels_
-            # Set new labels to train dataset.
-            new_labels = new_labels + 1
-            new_labels = list(new_labels)
-            train_dataset.set_labels(new_labels)
+            # Set new labels to train dataset, outliers and small clusters are labeled 0.
+            new_labels, label_stats = cluster.get_pseudo_labels(
+                new_labels, min_size=min_cluster_size)
+            logger.info('Clusters: {num_cluster} Dropped: {num_drop}/{num_sample} '
+                        '(outliers: {num_outlier}, small clusters: {num_small})'.format(**label_stats))
+            train_dataset.set_labels(list(new_labels))
+            if train_feature_bank is not None:
+                train_feature_bank.set_active(new_labels > 0)
         # 7.2 Initialize env.
         if p is not None and k is not None and p * k == batch_size:
-            # Use triplet sampler.
-            train_sampler = sampler.TripletSampler(
-                labels=train_dataset.labels, batch_size=batch_size, p=p, k=k)
-        train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size,
-                                  sampler=train_sampler, num_workers=num_workers, pin_memory=pin_memory)
+            # Use triplet sampler, samples labeled 0 are skipped.
+            if step == 1:
+                train_sampler = sampler.TripletSampler(
+                    labels=train_dataset.labels, batch_size=batch_size, p=p, k=k, seed=seed)
+            else:
+                train_sampler.set_labels(train_dataset.labels)
+            logger.info('Samples per epoch: {}'.format(len(train_sampler)))
+        # The sampler is updated in place, so the loader and its workers are reused.
+        train_loader = loader_manager.get_loader('train', train_dataset, batch_size, sampler=train_sampler)
         batch_template1, batch_template2 = tool.get_templates(
             batch_size, batch_size)
         for epoch in range(1, epochs + 1):
@@ -257,7 +323,7 @@ if __name__ == '__main__':
             iteration = 0
             logger.info('Epoch[{}/{}] Epoch start.'.format(epoch, epochs))
             epoch_start = time.time()
-            for images, labels, _, _ in train_loader:
+            for images, labels, _, _ in loader_manager.iterate('train'):
                 # 7.4 Start iteration.
                 iteration += 1
                 model_optimizer.zero_grad()
@@ -267,7 +333,14 @@ if __name__ == '__main__':
                 if use_gpu:
                     images = images.to(device)
                     labels = labels.to(device)
+                if train_augment is not None:
+                    images = train_augment(images)
                 features, final_features = base_model(images)
+                if train_feature_bank is not None:
+                    # Features of the training forward for free, or of an extra eval forward if bank_eval_features.
+                    bank_features = feature_bank.get_eval_features(base_model, images) if bank_eval_features \
+                        else final_features
+                    train_feature_bank.update(train_sampler.get_batch_indexes(iteration), bank_features)
                 # predicted_labels = classifier_model(final_features)
                 features1 = features[batch_template1, :]
                 features2 = features[batch_template2, :]
@@ -333,6 +406,11 @@ if __name__ == '__main__':
             if epoch % val_per_epochs == 0:
                 logger.info('Start validation every {} epochs at epoch: {}'.format(
                     val_per_epochs, epoch))
+                # Workers load the first batches of the next pass during validation.
+                if epoch < epochs:
+                    loader_manager.prefetch('train')
+                elif step < steps and (train_feature_bank is None or train_feature_bank.need_refresh(step + 1)):
+                    loader_manager.prefetch('cluster')
                 base_model.eval()
                 val_start = time.time()
                 with torch.no_grad():
@@ -345,6 +423,8 @@ if __name__ == '__main__':
                         if use_gpu:
                             query_image = query_image.to(device)
                         query_feature = base_model(query_image)
+                        if camera_model is not None:
+                            query_feature = camera_model(query_feature, camids)
                         # if val_norm:
                         #     query_feature = torch.nn.functional.normalize(query_feature, p=2, dim=1)
                         query_features.append(query_feature)
@@ -359,6 +439,8 @@ if __name__ == '__main__':
                         if use_gpu:
                             gallery_image = gallery_image.to(device)
                         gallery_feature = base_model(gallery_image)
+                        if camera_model is not None:
+                            gallery_feature = camera_model(gallery_feature, camids)
                         # if val_norm:
                         #     gallery_feature = torch.nn.functional.normalize(gallery_feature, p=2, dim=1)
                         gallery_features.append(gallery_feature)
@@ -410,3 +492,7 @@ if __name__ == '__main__':
                         "%H%M%S", time.localtime()) + '[base]' + str(true_epoch) + '.pth'
                     torch.save(base_model.state_dict(),
                                os.path.join(save_path, base_save_name))
+                    if camera_model is not None:
+                        camera_save_name = base_save_name.replace('[base]', '[camera]')
+                        torch.save(camera_model.state_dict(),
+                                   os.path.join(save_path, camera_save_name))
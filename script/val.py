@@ -15,10 +15,10 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 
 sys.path.append("")
 from optimizer import lambda_calculator
-from model import resnet50, classifier, diff_attention, agw, bag_tricks
+from model import resnet50, classifier, diff_attention, agw, bag_tricks, camera_norm, reduction, loading, tta
 from metric import cmc_map, re_ranking
 from loss import id_loss, triplet_loss, center_loss, circle_loss, reg_loss
-from data import transform, dataset, sampler
+from data import transform, dataset, sampler, decoder
 from util import config_parser, logger, tool, averager
 
 if __name__ == '__main__':
@@ -48,6 +48,7 @@ if __name__ == '__main__':
 
     # 2 model
     model_path = config['model']['path']
+    reduction_path = config['model']['reduction_path']
     num_class = config['model'].getint('num_class')
     num_feature = config['model'].getint('num_feature')
     bias = config['model'].getboolean('bias')
@@ -56,12 +57,21 @@ if __name__ == '__main__':
     out_transform = config['da']['out_transform']
     aggregate = config['da'].getboolean('aggregate')
     diff_model_path = config['da']['diff_model_path']
-    # 2.1 Get feature model.
-    base_model = agw.Baseline()
-    if use_gpu:
-        base_model = base_model.to(device)
-    base_model.load_state_dict(torch.load(model_path))
+    # 2.1 Get feature model, built on the meta device and loaded from the memory-mapped checkpoint.
+    base_model = loading.build_model(lambda: agw.Baseline(pretrain_choice='self'), model_path, device=device)
     logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+    # Reduce features with the reduction fitted on raw model features, before TTA merges views and
+    # camera normalization is fitted.
+    if reduction_path != '':
+        reduction_model = reduction.load_reduction(reduction_path, device=device)
+        base_model = reduction.ReducedModel(base_model, reduction_model)
+        num_feature = reduction_model.dim
+        logger.info('Reduce features to {} dimensions.'.format(num_feature))
+    # Test-time augmentation, set in [val]. Concatenated views widen the features.
+    base_model = tta.get_tta(base_model, config)
+    if isinstance(base_model, tta.TTA):
+        num_feature = base_model.get_num_feature(num_feature)
+        logger.info('TTA: {} views, {} merge'.format(base_model.get_num_view(), base_model.merge))
     # # 2.2 Get Diff Attention Module.
     # diff_model = diff_attention.DiffAttentionModule(
     #     num_feature=num_feature, in_transform=in_transform, diff_ratio=diff_ratio, out_transform=out_transform, aggregate=aggregate)
@@ -85,6 +95,9 @@ if __name__ == '__main__':
     num_workers = config['dataset'].getint('num_workers')
     pin_memory = config['dataset'].getboolean('pin_memory')
     dataset_norm = config['dataset'].getboolean('norm')
+    # Scan dataset folders in parallel, datasets below load from manifests.
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['query', 'bounding_box_test']])
     # 3.1 Get query set.
     query_path = os.path.join(dataset_path, 'query')
     query_transform = transform.get_transform(size=size, is_train=False)
@@ -99,6 +112,11 @@ if __name__ == '__main__':
         style=dataset_style, path=gallery_path, transform=gallery_transform, name='Image Gallery', verbose=verbose)
     gallery_loader = DataLoader(dataset=gallery_dataset, batch_size=batch_size,
                                 num_workers=num_workers, pin_memory=pin_memory)
+    # 3.3 Decode JPEGs at a reduced scale when they are much larger than the input size.
+    image_decoder = decoder.Decoder(backend=config['dataset']['decoder'], size=size)
+    logger.info('Image decoder: ' + image_decoder.backend)
+    query_dataset.set_decoder(image_decoder)
+    gallery_dataset.set_decoder(image_decoder)
 
     # 4 metric
     # 4.1 Get CMC and mAP metric.
@@ -108,6 +126,9 @@ if __name__ == '__main__':
     val_norm = config['val'].getboolean('norm')
     re_rank = config['val'].getboolean('re_rank')
     minp = config['val'].getboolean('minp')
+    use_camera_norm = config['val'].getboolean('camera_norm')
+    camera_norm_mode = config['val']['camera_norm_mode']
+    camera_norm_path = config['val']['camera_norm_path']
     base_model.eval()
     # diff_model.eval()
     val_start = time.time()
@@ -140,6 +161,29 @@ if __name__ == '__main__':
             gallery_features.append(gallery_feature)
             gallery_pids.extend(pids)
             gallery_camids.extend(camids)
+        if use_camera_norm:
+            # Camera normalization, loaded from checkpoint or fitted on gallery features.
+            logger.info('Camera normalization.')
+            camera_model = camera_norm.CameraNorm(
+                num_feature=num_feature, mode=camera_norm_mode).to(device)
+            query_camid_tensor = torch.as_tensor([int(x) for x in query_camids])
+            gallery_camid_tensor = torch.as_tensor([int(x) for x in gallery_camids])
+            if camera_norm_path != '':
+                camera_model.load_state_dict(torch.load(camera_norm_path))
+            else:
+                camera_model.fit(torch.cat(gallery_features, dim=0), gallery_camid_tensor)
+            offset = 0
+            for i in range(len(query_features)):
+                n = query_features[i].shape[0]
+                query_features[i] = camera_model(
+                    query_features[i], query_camid_tensor[offset:offset + n])
+                offset += n
+            offset = 0
+            for i in range(len(gallery_features)):
+                n = gallery_features[i].shape[0]
+                gallery_features[i] = camera_model(
+                    gallery_features[i], gallery_camid_tensor[offset:offset + n])
+                offset += n
         if not re_rank:
             # Calculate distance matrix.
             logger.info('Make up distance matrix.')
@@ -15,10 +15,10 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 
 sys.path.append("")
 from optimizer import lambda_calculator
-from model import resnet50, classifier, diff_attention, agw, bag_tricks
+from model import resnet50, classifier, diff_attention, diff_scorer, agw, bag_tricks, camera_norm, reduction, loading
 from metric import cmc_map, re_ranking
 from loss import id_loss, triplet_loss, center_loss, circle_loss, reg_loss
-from data import transform, dataset, sampler
+from data import transform, dataset, sampler, decoder
 from util import config_parser, logger, tool, averager
 
 if __name__ == '__main__':
@@ -48,6 +48,7 @@ if __name__ == '__main__':
 
     # 2 model
     model_path = config['model']['path']
+    reduction_path = config['model']['reduction_path']
     num_class = config['model'].getint('num_class')
     num_feature = config['model'].getint('num_feature')
     bias = config['model'].getboolean('bias')
@@ -56,12 +57,15 @@ if __name__ == '__main__':
     out_transform = config['da']['out_transform']
     aggregate = config['da'].getboolean('aggregate')
     diff_model_path = config['da']['diff_model_path']
-    # 2.1 Get feature model.
-    base_model = agw.Baseline()
-    if use_gpu:
-        base_model = base_model.to(device)
-    base_model.load_state_dict(torch.load(model_path))
+    # 2.1 Get feature model, built on the meta device and loaded from the memory-mapped checkpoint.
+    base_model = loading.build_model(lambda: agw.Baseline(pretrain_choice='self'), model_path, device=device)
     logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+    # Reduce features before Diff Attention, which then works on the reduced size as in the daoff scripts.
+    if reduction_path != '':
+        reduction_model = reduction.load_reduction(reduction_path, device=device)
+        base_model = reduction.ReducedModel(base_model, reduction_model)
+        num_feature = reduction_model.dim
+        logger.info('Reduce features to {} dimensions.'.format(num_feature))
     # 2.2 Get Diff Attention Module.
     diff_model = diff_attention.DiffAttentionModule(
         num_feature=num_feature, in_transform=in_transform, diff_ratio=diff_ratio, out_transform=out_transform, aggregate=aggregate)
@@ -70,6 +74,8 @@ if __name__ == '__main__':
     diff_model.load_state_dict(torch.load(diff_model_path))
     logger.info('Diff Attention Module: ' +
                 str(tool.get_parameter_number(diff_model)))
+    # 2.3 Get scorer, caching the per-image conv1/fc1 terms of Diff Attention at embedding time.
+    scorer = diff_scorer.DiffAttentionScorer(base_model, diff_model)
 
     # 3 data
     dataset_style = config['dataset']['style']
@@ -85,6 +91,9 @@ if __name__ == '__main__':
     num_workers = config['dataset'].getint('num_workers')
     pin_memory = config['dataset'].getboolean('pin_memory')
     dataset_norm = config['dataset'].getboolean('norm')
+    # Scan dataset folders in parallel, datasets below load from manifests.
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['query', 'bounding_box_test']])
     # 3.1 Get query set.
     query_path = os.path.join(dataset_path, 'query')
     query_transform = transform.get_transform(size=size, is_train=False)
@@ -99,6 +108,11 @@ if __name__ == '__main__':
         style=dataset_style, path=gallery_path, transform=gallery_transform, name='Image Gallery', verbose=verbose)
     gallery_loader = DataLoader(dataset=gallery_dataset, batch_size=batch_size,
                                 num_workers=num_workers, pin_memory=pin_memory)
+    # 3.3 Decode JPEGs at a reduced scale when they are much larger than the input size.
+    image_decoder = decoder.Decoder(backend=config['dataset']['decoder'], size=size)
+    logger.info('Image decoder: ' + image_decoder.backend)
+    query_dataset.set_decoder(image_decoder)
+    gallery_dataset.set_decoder(image_decoder)
 
     # 4 metric
     # 4.1 Get CMC and mAP metric.
@@ -108,6 +122,9 @@ if __name__ == '__main__':
     val_norm = config['val'].getboolean('norm')
     re_rank = config['val'].getboolean('re_rank')
     minp = config['val'].getboolean('minp')
+    use_camera_norm = config['val'].getboolean('camera_norm')
+    camera_norm_mode = config['val']['camera_norm_mode']
+    camera_norm_path = config['val']['camera_norm_path']
     base_model.eval()
     diff_model.eval()
     val_start = time.time()
@@ -115,53 +132,70 @@ if __name__ == '__main__':
         # Get query feature.
         logger.info('Load query data.')
         query_features = []
+        query_projections = []
         query_pids = []
         query_camids = []
         for query_batch, (query_image, _, pids, camids) in enumerate(query_loader):
             if use_gpu:
                 query_image = query_image.to(device)
-            query_feature = base_model(query_image)
+            query_feature, query_projection = scorer(query_image)
             # if val_norm:
             #     query_feature = torch.nn.functional.normalize(query_feature, p=2, dim=1)
             query_features.append(query_feature)
+            query_projections.append(query_projection)
             query_pids.extend(pids)
             query_camids.extend(camids)
         # Get gallery feature.
         logger.info('Load gallery data.')
         gallery_features = []
+        gallery_projections = []
         gallery_pids = []
         gallery_camids = []
         for gallery_batch, (gallery_image, _, pids, camids) in enumerate(gallery_loader):
             if use_gpu:
                 gallery_image = gallery_image.to(device)
-            gallery_feature = base_model(gallery_image)
+            gallery_feature, gallery_projection = scorer(gallery_image)
             # if val_norm:
             #     gallery_feature = torch.nn.functional.normalize(gallery_feature, p=2, dim=1)
             gallery_features.append(gallery_feature)
+            gallery_projections.append(gallery_projection)
             gallery_pids.extend(pids)
             gallery_camids.extend(camids)
+        if use_camera_norm:
+            # Camera normalization, loaded from checkpoint or fitted on gallery features.
+            logger.info('Camera normalization.')
+            camera_model = camera_norm.CameraNorm(
+                num_feature=num_feature, mode=camera_norm_mode).to(device)
+            query_camid_tensor = torch.as_tensor([int(x) for x in query_camids])
+            gallery_camid_tensor = torch.as_tensor([int(x) for x in gallery_camids])
+            if camera_norm_path != '':
+                camera_model.load_state_dict(torch.load(camera_norm_path))
+            else:
+                camera_model.fit(torch.cat(gallery_features, dim=0), gallery_camid_tensor)
+            offset = 0
+            for i in range(len(query_features)):
+                n = query_features[i].shape[0]
+                query_features[i] = camera_model(
+                    query_features[i], query_camid_tensor[offset:offset + n])
+                offset += n
+            offset = 0
+            for i in range(len(gallery_features)):
+                n = gallery_features[i].shape[0]
+                gallery_features[i] = camera_model(
+                    gallery_features[i], gallery_camid_tensor[offset:offset + n])
+                offset += n
+            # Project the normalized features again.
+            query_projections = [scorer.project(x) for x in query_features]
+            gallery_projections = [scorer.project(x) for x in gallery_features]
         if not re_rank:
             # Calculate distance matrix.
             logger.info('Make up distance matrix.')
             distance_matrix = []
-            for query_feature in query_features:
+            for query_feature, query_projection in zip(query_features, query_projections):
                 distance = []
-                for gallery_feature in gallery_features:
-                    m, n = query_feature.shape[0], gallery_feature.shape[0]
-                    val_template1, val_template2 = tool.get_templates(
-                        m, n, mode='val')
-                    new_query_feature = query_feature[val_template1, :]
-                    new_gallery_feature = gallery_feature[val_template2, :]
-                    new_query_feature, new_gallery_feature = diff_model(
-                        new_query_feature, new_gallery_feature, keep_dim=True)
-                    if val_norm:
-                        new_query_feature = torch.nn.functional.normalize(
-                            new_query_feature, p=2, dim=1)
-                        new_gallery_feature = torch.nn.functional.normalize(
-                            new_gallery_feature, p=2, dim=1)
-                    matrix = torch.nn.functional.pairwise_distance(
-                        new_query_feature, new_gallery_feature)
-                    matrix = matrix.reshape((m, n))
+                for gallery_feature, gallery_projection in zip(gallery_features, gallery_projections):
+                    matrix = scorer.distance(
+                        query_feature, query_projection, gallery_feature, gallery_projection, norm=val_norm)
                     distance.append(matrix)
                 distance = torch.cat(distance, dim=1)
                 distance_matrix.append(distance)
@@ -175,27 +209,12 @@ if __name__ == '__main__':
             #     query_feature, gallery_feature)
             logger.info('Make up distance matrix.')
             features = query_features + gallery_features
-            features1 = copy.deepcopy(features)
-            features2 = copy.deepcopy(features)
+            projections = query_projections + gallery_projections
             distance_matrix = []
-            for feature1 in features1:
+            for feature1, projection1 in zip(features, projections):
                 distance = []
-                for feature2 in features2:
-                    m, n = feature1.shape[0], feature2.shape[0]
-                    val_template1, val_template2 = tool.get_templates(
-                        m, n, mode='val')
-                    new_feature1 = feature1[val_template1, :]
-                    new_feature2 = feature2[val_template2, :]
-                    new_feature1, new_feature2 = diff_model(
-                        new_feature1, new_feature2, keep_dim=True)
-                    if val_norm:
-                        new_feature1 = torch.nn.functional.normalize(
-                            new_feature1, p=2, dim=1)
-                        new_feature2 = torch.nn.functional.normalize(
-                            new_feature2, p=2, dim=1)
-                    matrix = torch.nn.functional.pairwise_distance(
-                        new_feature1, new_feature2)
-                    matrix = matrix.reshape((m, n))
+                for feature2, projection2 in zip(features, projections):
+                    matrix = scorer.distance(feature1, projection1, feature2, projection2, norm=val_norm)
                     matrix = matrix.detach().cpu().numpy()
                     distance.append(matrix)
                 distance = np.concatenate(distance, axis=1)
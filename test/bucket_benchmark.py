@@ -0,0 +1,148 @@
+import csv
+import os
+import time
+import sys
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.append("")
+from model import bag_tricks, agw
+from metric import cmc_map
+from data import transform, dataset, bucket
+from util import config_parser, logger, tool
+
+
+def extract(model, loader, device, norm):
+    # Features, pids, camids, images and pixels of one pass.
+    features = []
+    pids = []
+    camids = []
+    num_image = 0
+    num_pixel = 0
+    with torch.no_grad():
+        for images, _, batch_pids, batch_camids in loader:
+            images = images.to(device)
+            batch_features = model(images)
+            if norm:
+                batch_features = torch.nn.functional.normalize(batch_features, p=2, dim=1)
+            features.append(batch_features.cpu())
+            pids.append(np.asarray(batch_pids))
+            camids.append(np.asarray(batch_camids))
+            num_image += images.shape[0]
+            num_pixel += images.shape[0] * images.shape[2] * images.shape[3]
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return torch.cat(features, dim=0), np.concatenate(pids), np.concatenate(camids), num_image, num_pixel
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Bucket Benchmark')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    model_path = config['model']['path']
+    if config['bucket']['model'] == 'agw':
+        base_model = agw.Baseline()
+    else:
+        base_model = bag_tricks.Baseline()
+    if use_gpu:
+        base_model = base_model.to(device)
+    base_model.load_state_dict(torch.load(model_path))
+    base_model.eval()
+    logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+
+    # 3 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    batch_size = config['dataset'].getint('batch_size')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    val_norm = config['val'].getboolean('norm')
+    step = config['bucket'].getint('step')
+    min_height = config['bucket'].getint('min_height')
+    max_height = config['bucket'].getint('max_height')
+    max_width = config['bucket'].getint('max_width')
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['query', 'bounding_box_test']])
+    eval_transform = transform.get_transform(size=size, is_train=False)
+    # 3.1 Get query and gallery sets.
+    query_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'query'),
+                                         transform=eval_transform, name='Image Query', verbose=verbose)
+    gallery_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'bounding_box_test'),
+                                           transform=eval_transform, name='Image Gallery', verbose=verbose)
+    # 3.2 Get loaders of fixed resizing and of native-size buckets.
+    loaders = {'fixed': [], 'bucket': []}
+    for image_dataset in [query_dataset, gallery_dataset]:
+        loaders['fixed'].append(DataLoader(image_dataset, batch_size=batch_size,
+                                           num_workers=num_workers, pin_memory=pin_memory))
+        image_sizes = bucket.get_image_sizes(image_dataset, num_workers=max(1, num_workers))
+        bucket_sizes = bucket.get_bucket_sizes(image_sizes, step=step, min_height=min_height,
+                                               max_height=max_height, max_width=max_width)
+        bucket_dataset = bucket.BucketDataset(image_dataset, bucket_sizes)
+        batch_sampler = bucket.BucketBatchSampler(bucket_dataset.get_sizes(), batch_size)
+        logger.info('{}: native median size {}, {} buckets'.format(
+            image_dataset.name, np.median(image_sizes, axis=0).tolist(), len(batch_sampler.buckets)))
+        loaders['bucket'].append(DataLoader(bucket_dataset, batch_sampler=batch_sampler,
+                                            num_workers=num_workers, pin_memory=pin_memory))
+
+    # 4 benchmark
+    results = []
+    for mode in ['fixed', 'bucket']:
+        # 4.1 Extract features with time.
+        logger.info('Start extraction: {}'.format(mode))
+        time_start = time.time()
+        query_features, query_pids, query_camids, query_images, query_pixels = extract(
+            base_model, loaders[mode][0], device, val_norm)
+        gallery_features, gallery_pids, gallery_camids, gallery_images, gallery_pixels = extract(
+            base_model, loaders[mode][1], device, val_norm)
+        time_end = time.time()
+        # 4.2 Score retrieval.
+        distance_matrix = torch.cdist(query_features, gallery_features).numpy()
+        cmc, mAP = cmc_map.cmc_map(distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids)
+        num_image = query_images + gallery_images
+        result = {'mode': mode, 'time': time_end - time_start, 'images_per_second': num_image / (time_end - time_start),
+                  'mean_pixels': (query_pixels + gallery_pixels) / num_image, 'rank1': cmc[0], 'map': mAP}
+        results.append(result)
+        logger.info('{mode}: time {time:.1f}s, {images_per_second:.0f} images/s, mean pixels {mean_pixels:.0f}, '
+                    'Rank-1 {rank1:.1%}, mAP {map:.1%}'.format(**result))
+
+    # 5 save table
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    table_save_name = '[bucket benchmark]{}.csv'.format(time.strftime("%H%M%S", time.localtime()))
+    fields = ['mode', 'time', 'images_per_second', 'mean_pixels', 'rank1', 'map']
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
@@ -0,0 +1,125 @@
+import csv
+import multiprocessing
+import os
+import resource
+import time
+import sys
+
+import torch
+
+sys.path.append("")
+from model import bag_tricks, agw, loading
+from metric import cluster_score
+from data import transform, dataset
+from util import config_parser, logger, tool, cluster, feature_cache
+
+
+def run_cluster(features, method, kwargs, queue):
+    # Cluster in a fresh process, so its peak resident memory (numpy, torch and sklearn allocations alike)
+    # is the clustering's own. ru_maxrss is in KB on Linux.
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    time_start = time.time()
+    pred_labels = cluster.get_cluster_labels(features, method, **kwargs)
+    time_end = time.time()
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((pred_labels, time_end - time_start, (rss_peak - rss_start) / 1024))
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Cluster Benchmark')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    batch_size = config['dataset'].getint('batch_size')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    dataset_norm = config['dataset'].getboolean('norm')
+    # 2.1 Get train set with deterministic transform.
+    train_path = os.path.join(dataset_path, 'bounding_box_train')
+    train_transform = transform.get_transform(size=size, is_train=False)
+    train_dataset = dataset.ImageDataset(
+        style=dataset_style, path=train_path, transform=train_transform, name='Image Train', verbose=verbose)
+
+    # 3 feature
+    model_path = config['model']['path']
+    num_class = config['model'].getint('num_class')
+    model_name = config['cluster']['model']
+    cache_path = config['cluster']['cache_path']
+    cache_file = os.path.join(cache_path, feature_cache.get_cache_name(model_path, train_dataset, norm=dataset_norm))
+    base_model = None
+    if not os.path.isfile(cache_file):
+        # 3.1 Get feature model only when features are not cached.
+        model_class = agw.Baseline if model_name == 'agw' else bag_tricks.Baseline
+        base_model = loading.build_model(lambda: model_class(pretrain_choice='self'), model_path, device=device)
+        logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+    # 3.2 Get train features.
+    train_features, train_pids, _ = feature_cache.get_features(
+        cache_path, base_model, model_path, train_dataset, device, batch_size, num_workers, pin_memory,
+        norm=dataset_norm)
+    logger.info('Train features: {}'.format(train_features.shape))
+
+    # 4 benchmark
+    methods = [x.strip() for x in config['cluster']['methods'].split(',') if x.strip() != '']
+    eps = config['cluster'].getfloat('eps')
+    min_samples = config['cluster'].getint('min_samples')
+    k1 = config['cluster'].getint('k1')
+    k2 = config['cluster'].getint('k2')
+    kwargs = {'num_cluster': num_class, 'seed': seed, 'eps': eps, 'min_samples': min_samples, 'k1': k1, 'k2': k2}
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for method in methods:
+        # 4.1 Cluster with time and peak memory, in a process of its own and without tracing.
+        logger.info('Start clustering: {}'.format(method))
+        queue = context.Queue()
+        process = context.Process(target=run_cluster, args=(train_features, method, kwargs, queue))
+        process.start()
+        pred_labels, cluster_time, peak_memory_mb = queue.get()
+        process.join()
+        # 4.2 Score cluster.
+        result = {'method': method, 'time': cluster_time, 'peak_memory_mb': peak_memory_mb}
+        result.update(cluster_score.cluster_score(train_pids, pred_labels))
+        results.append(result)
+        logger.info('{method}: time {time:.1f}s, peak memory {peak_memory_mb:.0f}MB, ARI {ari:.4f}, '
+                    'NMI {nmi:.4f}, purity {purity:.4f}, clusters {num_cluster}, outliers {num_outlier}'
+                    .format(**result))
+
+    # 5 save table
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    table_save_name = '[cluster benchmark]{}.csv'.format(time.strftime("%H%M%S", time.localtime()))
+    fields = ['method', 'time', 'peak_memory_mb', 'ari', 'nmi', 'purity', 'num_cluster', 'num_outlier']
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data import dataset
+
+
+if __name__ == '__main__':
+    # Two domains under relative roots, as the configs give them, read through one ConcatReIDDataset.
+    os.chdir(tempfile.mkdtemp())
+    paths = [os.path.join('dataset', 'market', 'bounding_box_train'),
+             os.path.join('dataset', 'duke', 'bounding_box_train')]
+    for path, color in zip(paths, ['red', 'blue']):
+        os.makedirs(path)
+        for pid in [1, 2]:
+            Image.new('RGB', (8, 16), color).save(os.path.join(path, '{:04d}_c1s1_000001_00.jpg'.format(pid)))
+    datasets = [dataset.ImageDataset(style='market', path=path, transform=None, name=path, manifest=False)
+                for path in paths]
+    concat_dataset = dataset.ConcatReIDDataset(datasets)
+    assert len(concat_dataset) == 4
+    for index, color in [(0, (254, 0, 0)), (len(concat_dataset) - 1, (0, 0, 254))]:
+        image, label, pid, camid = concat_dataset[index]
+        assert max(abs(x - y) for x, y in zip(image.getpixel((4, 8)), color)) < 8, image.getpixel((4, 8))
+    assert len(set(concat_dataset.all_labels.tolist())) == 4
+    print('ConcatReIDDataset test passed.')
@@ -0,0 +1,81 @@
+import csv
+import os
+import time
+import sys
+import numpy as np
+
+from torchvision.transforms import transforms
+
+sys.path.append("")
+from data import dataset, decoder
+from util import config_parser, logger, tool
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Decode Benchmark')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    max_images = config['decode'].getint('max_images')
+    gallery_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'bounding_box_test'),
+                                           transform=None, name='Image Gallery')
+    files = [os.path.join(gallery_dataset.path, file) for file in gallery_dataset.all_images]
+    if 0 < max_images < len(files):
+        files = [files[i] for i in np.random.choice(len(files), size=max_images, replace=False)]
+    resize = transforms.Resize(size)
+
+    # 3 benchmark
+    backends = [x.strip() for x in config['decode']['backends'].split(',') if x.strip() != '']
+    available = decoder.get_available_backends()
+    results = []
+    for backend in backends:
+        if backend not in available:
+            logger.info('Skip {}: not installed.'.format(backend))
+            continue
+        # 3.1 Decode, convert and resize as ImageDataset does, single process.
+        image_decoder = decoder.Decoder(backend=backend, size=size)
+        num_pixel = 0
+        time_start = time.time()
+        for file in files:
+            image = image_decoder(file)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            num_pixel += image.size[0] * image.size[1]
+            resize(image)
+        time_end = time.time()
+        result = {'backend': backend, 'images': len(files), 'time': time_end - time_start,
+                  'images_per_second': len(files) / (time_end - time_start),
+                  'mean_decoded_pixels': num_pixel / max(1, len(files))}
+        results.append(result)
+        logger.info('{backend}: {images_per_second:.0f} images/s, mean decoded pixels {mean_decoded_pixels:.0f}'
+                    .format(**result))
+
+    # 4 save table
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    table_save_name = '[decode benchmark]{}.csv'.format(time.strftime("%H%M%S", time.localtime()))
+    fields = ['backend', 'images', 'time', 'images_per_second', 'mean_decoded_pixels']
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
@@ -0,0 +1,144 @@
+import csv
+import os
+import time
+import sys
+import numpy as np
+
+import torch
+
+sys.path.append("")
+from model import bag_tricks, agw, hashing, loading
+from metric import hamming
+from data import transform, dataset
+from util import config_parser, logger, tool, feature_cache
+
+
+def get_recall(indexes, exact_indexes):
+    # Share of the exact top-k neighbors found in indexes.
+    found = [len(np.intersect1d(index, exact_index)) for index, exact_index in zip(indexes, exact_indexes)]
+    return np.sum(found) / exact_indexes.size
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Hash Benchmark')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    model_path = config['model']['path']
+    num_feature = config['model'].getint('num_feature')
+    num_bit = config['hash'].getint('num_bit')
+    model_class = agw.Baseline if config['hash']['model'] == 'agw' else bag_tricks.Baseline
+    base_model = loading.build_model(lambda: model_class(pretrain_choice='self'), model_path, device=device)
+    hash_model = hashing.HashHead(num_feature=num_feature, num_bit=num_bit)
+    hash_model.load_state_dict(torch.load(config['hash']['hash_path'], map_location='cpu'))
+    hash_model = hash_model.to(device)
+    hash_model.eval()
+
+    # 3 features and codes
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    batch_size = config['dataset'].getint('batch_size')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    val_norm = config['val'].getboolean('norm')
+    eval_transform = transform.get_transform(size=size, is_train=False)
+    features = {}
+    codes = {}
+    for name, folder in [('query', 'query'), ('gallery', 'bounding_box_test')]:
+        image_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, folder),
+                                             transform=eval_transform, name='Image ' + name)
+        # Codes from features as the head was trained on them (FeatureDataset norm).
+        split_features, _, _ = feature_cache.get_features(
+            config['hash']['cache_path'], base_model, model_path, image_dataset, device, batch_size, num_workers,
+            pin_memory, norm=config['dataset'].getboolean('norm'))
+        with torch.no_grad():
+            codes[name] = hamming.pack_codes(hash_model.encode(torch.from_numpy(split_features).to(device)).cpu())
+        if val_norm:
+            split_features = split_features / np.linalg.norm(split_features, axis=1, keepdims=True)
+        features[name] = np.ascontiguousarray(split_features, dtype=np.float32)
+    query_features = features['query']
+    query_codes = codes['query']
+    # Tile the gallery for a larger search size. QPS is timed on the tiled gallery, recall is
+    # scored on the real one, where exact copies cannot fill the top-k.
+    gallery_repeat = config['hash'].getint('gallery_repeat')
+    galleries = {'real': (features['gallery'], codes['gallery']),
+                 'tiled': (np.tile(features['gallery'], (gallery_repeat, 1)),
+                           np.tile(codes['gallery'], (gallery_repeat, 1)))}
+    logger.info('Gallery: {} images, {} bits ({} bytes) per code, {} floats per feature'.format(
+        galleries['tiled'][0].shape[0], num_bit, codes['gallery'].shape[1] * 8, features['gallery'].shape[1]))
+
+    # 4 benchmark
+    top_k = config['hash'].getint('top_k')
+    num_candidates = [int(x) for x in config['hash']['num_candidates'].split(',') if x.strip() != '']
+    query_batch_size = config['hash'].getint('query_batch_size')
+
+    def run(mode, gallery, num_candidate):
+        # Top-k indexes of all queries and the search time.
+        gallery_features, gallery_codes = galleries[gallery]
+        time_start = time.time()
+        if mode == 'exact':
+            indexes = []
+            gallery_square = (gallery_features * gallery_features).sum(axis=1)
+            for start in range(0, query_features.shape[0], query_batch_size):
+                distance = gallery_square - 2 * query_features[start:start + query_batch_size] @ gallery_features.T
+                index = np.argpartition(distance, top_k - 1, axis=1)[:, :top_k]
+                order = np.argsort(np.take_along_axis(distance, index, axis=1), axis=1)
+                indexes.append(np.take_along_axis(index, order, axis=1))
+            indexes = np.concatenate(indexes, axis=0)
+        elif mode == 'hamming':
+            indexes = np.concatenate([hamming.hamming_search(query_codes[start:start + query_batch_size],
+                                                             gallery_codes, top_k)
+                                      for start in range(0, query_codes.shape[0], query_batch_size)], axis=0)
+        else:
+            indexes, _ = hamming.search(query_codes, gallery_codes, query_features, gallery_features,
+                                        num_candidate=num_candidate, top_k=top_k, batch_size=query_batch_size)
+        return indexes, time.time() - time_start
+
+    results = []
+    exact_indexes, _ = run('exact', 'real', 0)
+    modes = [('exact', 0), ('hamming', top_k)] + [('hamming+rerank', x) for x in num_candidates]
+    for mode, num_candidate in modes:
+        indexes, _ = run(mode, 'real', num_candidate)
+        _, search_time = run(mode, 'tiled', num_candidate)
+        result = {'mode': mode, 'num_candidate': num_candidate, 'recall': get_recall(indexes, exact_indexes),
+                  'qps': query_features.shape[0] / search_time}
+        results.append(result)
+        logger.info('{mode} ({num_candidate} candidates): recall@{top_k} {recall:.1%}, {qps:.0f} QPS'.format(
+            top_k=top_k, **result))
+
+    # 5 save table
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    table_save_name = '[hash benchmark]{}.csv'.format(time.strftime("%H%M%S", time.localtime()))
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['mode', 'num_candidate', 'recall', 'qps'])
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
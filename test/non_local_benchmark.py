@@ -0,0 +1,98 @@
+import csv
+import os
+import time
+import sys
+
+import torch
+
+sys.path.append("")
+from model import agw
+from util import config_parser, logger, tool
+
+
+def run(module, x, repeat, device):
+    # Mean forward + backward time and peak memory of module on x.
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    time_start = time.time()
+    for _ in range(repeat):
+        y = module(x)
+        y.sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    time_end = time.time()
+    peak_memory = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == 'cuda' else 0.
+    return y.detach(), (time_end - time_start) / repeat, peak_memory
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('Non-local Benchmark')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 shapes
+    # Non-local inputs of ResNetNL with last_stride=1: (channels, height / stride, width / stride).
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    batch_size = config['non_local'].getint('batch_size')
+    repeat = config['non_local'].getint('repeat')
+    inter_channels = [int(x) for x in config['non_local']['inter_channels'].split(',') if x.strip() != '']
+    shapes = [(256, height // 4, width // 4), (512, height // 8, width // 8), (1024, height // 16, width // 16)]
+
+    # 3 benchmark
+    results = []
+    for channels, h, w in shapes:
+        for inter_channel in inter_channels:
+            # 3.1 Same weights in both forms.
+            module = agw.Non_local(channels, inter_channels=inter_channel, efficient=False).to(device)
+            module.W[1].weight.data.fill_(1.)
+            x = torch.randn((batch_size, channels, h, w), device=device, requires_grad=True)
+            outputs = {}
+            for efficient in [False, True]:
+                module.efficient = efficient
+                outputs[efficient], latency, peak_memory = run(module, x, repeat, device)
+                results.append({'channels': channels, 'height': h, 'width': w, 'inter_channels': inter_channel,
+                                'efficient': efficient, 'latency_ms': latency * 1000, 'peak_memory_mb': peak_memory})
+                logger.info('({}, {}, {}) inter {} efficient {}: {:.2f}ms, peak memory {:.0f}MB'.format(
+                    channels, h, w, inter_channel, efficient, latency * 1000, peak_memory))
+            # 3.2 Check both forms give the same output.
+            difference = (outputs[True] - outputs[False]).abs().max().item()
+            logger.info('Max absolute difference: {:.2e}'.format(difference))
+            for result in results[-2:]:
+                result['max_difference'] = difference
+
+    # 4 save table
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    table_save_name = '[non-local benchmark]{}.csv'.format(time.strftime("%H%M%S", time.localtime()))
+    fields = ['channels', 'height', 'width', 'inter_channels', 'efficient', 'latency_ms', 'peak_memory_mb',
+              'max_difference']
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
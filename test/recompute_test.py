@@ -0,0 +1,66 @@
+import copy
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model import agw, bag_tricks, recompute
+
+
+def get_models():
+    # (model, copy of model with every backbone stage recomputed) pairs, with and without non-local blocks.
+    torch.manual_seed(0)
+    models = []
+    model = bag_tricks.Baseline(model_name='resnet18', pretrain_choice='self')
+    recompute_model = copy.deepcopy(model)
+    recompute.set_recompute(recompute_model, stages=recompute.STAGES)
+    models.append((model, recompute_model))
+    model = agw.ResNetNL(last_stride=1, block=agw.Bottleneck, layers=[1, 2, 2, 1], non_layers=[0, 2, 1, 0],
+                         non_local_channels=8)
+    recompute_model = copy.deepcopy(model)
+    recompute_model.recompute_stages = set(recompute.STAGES)
+    models.append((model, recompute_model))
+    return models
+
+
+def train_step(model, images):
+    model.train()
+    model.zero_grad()
+    outputs = model(images)
+    if not isinstance(outputs, tuple):
+        outputs = (outputs,)
+    sum(output.sum() for output in outputs).backward()
+
+
+def test_batchnorm_statistics():
+    # One train step with and without recompute leaves equal BatchNorm buffers.
+    images = torch.randn((4, 3, 64, 32))
+    for model, recompute_model in get_models():
+        train_step(model, images)
+        train_step(recompute_model, images)
+        buffers = dict(recompute_model.named_buffers())
+        for name, buffer in model.named_buffers():
+            assert torch.allclose(buffer.float(), buffers[name].float(), atol=1e-5), name
+            if name.endswith('num_batches_tracked'):
+                assert buffer.item() == 1, name
+
+
+def test_gradients():
+    # One train step with and without recompute gives equal gradients.
+    images = torch.randn((4, 3, 64, 32))
+    for model, recompute_model in get_models():
+        train_step(model, images)
+        train_step(recompute_model, images)
+        parameters = dict(recompute_model.named_parameters())
+        for name, parameter in model.named_parameters():
+            if parameter.grad is None:
+                assert parameters[name].grad is None, name
+                continue
+            assert torch.allclose(parameter.grad, parameters[name].grad, rtol=1e-4, atol=1e-5), name
+
+
+if __name__ == '__main__':
+    test_batchnorm_statistics()
+    test_gradients()
+    print('Recompute tests passed.')
@@ -1,25 +1,27 @@
-import copy
 import os
-from re import template
 import time
 import sys
 import numpy as np
-from sklearn.manifold import TSNE
 import matplotlib.pyplot as plt
 
 import torch
-from torch import nn
-from torch.utils.data import DataLoader
-from torch.optim import Adam, SGD
-from torch.optim.lr_scheduler import LambdaLR
 
 sys.path.append("")
-from optimizer import lambda_calculator
-from model import resnet50, bag_tricks, classifier, diff_attention
-from metric import cmc_map, re_ranking
-from loss import id_loss, triplet_loss, center_loss, circle_loss, reg_loss
-from data import transform, dataset, sampler
-from util import config_parser, logger, tool, averager
+from model import bag_tricks, loading
+from data import transform, dataset
+from util import config_parser, logger, tool, feature_cache, projection
+
+
+def parse_pairs(value):
+    # 'name1:path1, name2:path2' -> {'name1': 'path1', 'name2': 'path2'}
+    pairs = {}
+    for item in value.split(','):
+        if item.strip() == '':
+            continue
+        name, path = item.split(':', 1)
+        pairs[name.strip()] = path.strip()
+    return pairs
+
 
 if __name__ == '__main__':
     # 0 introduction
@@ -46,184 +48,93 @@ if __name__ == '__main__':
     seed = config['basic'].getint('seed')
     tool.setup_random_seed(seed)
 
-    # 2 model
-    market_model_path = '../result/20211108/[supervised bag]220725[base]120.pth'
-    duke_model_path = '../result/20211129/[supervised bag]234045[base]120.pth'
-    # 2.1 Get market model.
-    market_model = bag_tricks.Baseline()
-    if use_gpu:
-        market_model = market_model.to(device)
-    market_model.load_state_dict(torch.load(market_model_path))
-    logger.info('Market Model: ' +
-                str(tool.get_parameter_number(market_model)))
-    # 2.2 Get duke model.
-    duke_model = bag_tricks.Baseline()
-    if use_gpu:
-        duke_model = duke_model.to(device)
-    duke_model.load_state_dict(torch.load(duke_model_path))
-    logger.info('Duke Model: ' + str(tool.get_parameter_number(duke_model)))
-    # 2.3 Get initial model.
-    initial_model = bag_tricks.Baseline()
-    if use_gpu:
-        initial_model = initial_model.to(device)
-    logger.info('Initial Model: ' +
-                str(tool.get_parameter_number(initial_model)))
-
-    # 3 data
+    # 2 config of visualization
+    # Each mode is 'dataset-model', e.g. market-duke embeds market images with duke model.
+    dataset_paths = parse_pairs(config['visual']['datasets'])
+    model_paths = parse_pairs(config['visual']['models'])
+    modes = [x.strip() for x in config['visual']['modes'].split(',') if x.strip() != '']
+    method = config['visual']['method']
+    pca_dim = config['visual'].getint('pca_dim')
+    max_samples = config['visual'].getint('max_samples')
+    cache_path = config['visual']['cache_path']
     dataset_style = config['dataset']['style']
-    market_path = '../dataset/Market-1501'
-    duke_path = '../dataset/DukeMTMC-reID'
     verbose = config['dataset'].getboolean('verbose')
     height = config['dataset'].getint('height')
     width = config['dataset'].getint('width')
     size = (height, width)
-    random_erasing = config['dataset'].getboolean('random_erasing')
-    batch_size = 128
-    p = 8
-    k = 16
+    batch_size = config['dataset'].getint('batch_size')
     num_workers = config['dataset'].getint('num_workers')
     pin_memory = config['dataset'].getboolean('pin_memory')
     dataset_norm = config['dataset'].getboolean('norm')
-    # 3.1 Get market set.
-    market_path = os.path.join(market_path, 'bounding_box_train')
-    market_transform = transform.get_transform(
-        size=size, is_train=True, random_erasing=random_erasing)
-    market_dataset = dataset.ImageDataset(
-        style=dataset_style, path=market_path, transform=market_transform, name='Image Train', verbose=verbose)
-    if p is not None and k is not None and p * k == batch_size:
-        # Use triplet sampler.
-        market_sampler = sampler.TripletSampler(
-            labels=market_dataset.labels, batch_size=batch_size, p=p, k=k)
-    market_loader = DataLoader(dataset=market_dataset, batch_size=batch_size,
-                               sampler=market_sampler, num_workers=num_workers, pin_memory=pin_memory)
-    # 3.2 Get duke set.
-    duke_path = os.path.join(duke_path, 'bounding_box_train')
-    duke_transform = transform.get_transform(
-        size=size, is_train=True, random_erasing=random_erasing)
-    duke_dataset = dataset.ImageDataset(
-        style=dataset_style, path=duke_path, transform=duke_transform, name='Image Train', verbose=verbose)
-    if p is not None and k is not None and p * k == batch_size:
-        # Use triplet sampler.
-        duke_sampler = sampler.TripletSampler(
-            labels=duke_dataset.labels, batch_size=batch_size, p=p, k=k)
-    duke_loader = DataLoader(dataset=duke_dataset, batch_size=batch_size,
-                             sampler=duke_sampler, num_workers=num_workers, pin_memory=pin_memory)
-    # 3.3 Get batchs.
-    batchs = 1
-    market_batchs = []
-    batch = 0
-    for images, labels, _, _ in market_loader:
-        batch += 1
-        if batch > batchs:
-            break
-        if use_gpu:
-            images = images.to(device)
-            labels = labels.to(device)
-        market_batchs.append((images, labels))
-    duke_batchs = []
-    batch = 0
-    for images, labels, _, _ in duke_loader:
-        batch += 1
-        if batch > batchs:
-            break
-        if use_gpu:
-            images = images.to(device)
-            labels = labels.to(device)
-        duke_batchs.append((images, labels))
 
-    # 4 t-SNE
-    save = config['train'].getboolean('save')
-    save_per_epochs = config['train'].getint('save_per_epochs')
+    # 3 features
+    # Features come from the shared cache; a model is only built on a cache miss.
+    feature_list = []
+    label_list = []
+    mode_list = []
+    models = {}
+    for mode_index, mode in enumerate(modes):
+        dataset_name, model_name = mode.split('-')
+        # 3.1 Get dataset.
+        train_path = os.path.join(dataset_paths[dataset_name], 'bounding_box_train')
+        train_transform = transform.get_transform(size=size, is_train=False)
+        train_dataset = dataset.ImageDataset(
+            style=dataset_style, path=train_path, transform=train_transform, name=dataset_name, verbose=verbose)
+        # 3.2 Get model on cache miss.
+        model_path = model_paths[model_name]
+        cache_file = os.path.join(cache_path, feature_cache.get_cache_name(
+            model_path, train_dataset, norm=dataset_norm))
+        if not os.path.isfile(cache_file) and model_name not in models:
+            if model_path != '':
+                base_model = loading.build_model(lambda: bag_tricks.Baseline(pretrain_choice='self'), model_path,
+                                                 device=device)
+            else:
+                base_model = bag_tricks.Baseline()
+                if use_gpu:
+                    base_model = base_model.to(device)
+            logger.info('{} Model: {}'.format(model_name, tool.get_parameter_number(base_model)))
+            models[model_name] = base_model
+        # 3.3 Get features.
+        features, pids, _ = feature_cache.get_features(
+            cache_path, models.get(model_name), model_path, train_dataset, device, batch_size, num_workers,
+            pin_memory, norm=dataset_norm)
+        if 0 < max_samples < features.shape[0]:
+            index = np.random.choice(features.shape[0], size=max_samples, replace=False)
+            features, pids = features[index], pids[index]
+        feature_list.append(features)
+        label_list.append(pids)
+        mode_list.append(np.full(features.shape[0], mode_index))
+    features = np.concatenate(feature_list, axis=0)
+    labels = np.concatenate(label_list, axis=0)
+    mode_ids = np.concatenate(mode_list, axis=0)
+    logger.info('Features: {}'.format(features.shape))
+
+    # 4 projection
+    logger.info('Start {} projection.'.format(method))
+    projection_start = time.time()
+    embedding = projection.get_embedding(features, method=method, pca_dim=pca_dim, seed=seed)
+    projection_end = time.time()
+    logger.info('Projection time taken: ' +
+                time.strftime("%H:%M:%S", time.gmtime(projection_end - projection_start)))
+
+    # 5 save
     save_path = config['train']['save_path']
     save_path = os.path.join(
         save_path, time.strftime("%Y%m%d", time.localtime()))
     if not os.path.isdir(save_path):
-        os.mkdir(save_path)
-    market_model.eval()
-    duke_model.eval()
-    initial_model.eval()
-    # 4.1 Initialise.
-    feature_list = []
-    label_list = []
-    mode = []
-    mode.append('market-initial')
-    mode.append('market-market')
-    mode.append('market-duke')
-    # mode.append('duke-initial')
-    # mode.append('duke-market')
-    # mode.append('duke-duke')
-    # 4.2 Get features and labels from batchs.
-    with torch.no_grad():
-        # market + initial model
-        if 'market-initial' in mode:
-            for images, labels in market_batchs:
-                features = initial_model(images)
-                feature_list.append(features)
-                label_list.append(labels)
-        # market + market model
-        if 'market-market' in mode:
-            for images, labels in market_batchs:
-                labels = labels + 2000
-                features = market_model(images)
-                feature_list.append(features)
-                label_list.append(labels)
-        # market + duke model
-        if 'market-duke' in mode:
-            for images, labels in market_batchs:
-                labels = labels + 4000
-                features = duke_model(images)
-                feature_list.append(features)
-                label_list.append(labels)
-        # duke + initial model
-        if 'duke-initial' in mode:
-            for images, labels in duke_batchs:
-                labels = labels + 10000
-                features = initial_model(images)
-                feature_list.append(features)
-                label_list.append(labels)
-        # duke + market model
-        if 'duke-market' in mode:
-            for images, labels in duke_batchs:
-                labels = labels + 12000
-                features = market_model(images)
-                feature_list.append(features)
-                label_list.append(labels)
-        # duke + duke model
-        if 'duke-duke' in mode:
-            for images, labels in duke_batchs:
-                labels = labels + 14000
-                features = duke_model(images)
-                feature_list.append(features)
-                label_list.append(labels)
-    # 4.3 t-SNE.
-    features = torch.cat(feature_list, dim=0)
-    features = features.detach().cpu().numpy()
-    labels = torch.cat(label_list, dim=0)
-    labels = labels.detach().cpu().numpy()
-    print(len(labels))
-    _, labels = np.unique(labels, return_inverse=True)
-    labels += 1
-    print(labels)
-    logger.info('Start t-SNE.')
-    tsne_start = time.time()
-    embedding = TSNE(n_components=2, init='pca',
-                     random_state=seed).fit_transform(features)
-    tsne_end = time.time()
-    tsne_time = abs(tsne_start - tsne_end)
-    logger.info('t-SNE time taken: ' +
-                time.strftime("%H:%M:%S", time.gmtime(tsne_time)))
-    # 4.4 Plot figure.
+        os.makedirs(save_path)
+    save_name = '[{}]{}[{}]'.format(method, time.strftime("%H%M%S", time.localtime()), ' '.join(modes))
+    # 5.1 Save 2-D coordinates.
+    np.savez(os.path.join(save_path, save_name + '.npz'),
+             embedding=embedding, labels=labels, modes=mode_ids, mode_names=np.asarray(modes))
+    # 5.2 Plot figure.
     fig = plt.figure(figsize=(15, 8))
-    plt.title(' '.join(mode))
+    plt.title(' '.join(modes))
     ax = plt.gca()
-    scatter = ax.scatter(
-        embedding[:, 0], embedding[:, 1], c=labels, cmap='tab20')
-    legend = ax.legend(*scatter.legend_elements(num=None), title="ID")
-    ax.add_artist(legend)
-    for i in range(embedding.shape[0]):
-        if i % (k // 4) == 0:
-            ax.text(embedding[i, 0], embedding[i, 1], labels[i])
-    fig_save_name = '[t-SNE]{}[{}].jpg'.format(
-        time.strftime("%H%M%S", time.localtime()), ' '.join(mode))
-    plt.savefig(os.path.join(save_path, fig_save_name))
-    plt.show()
+    marker_size = max(0.5, min(20., 20000. / embedding.shape[0]))
+    for mode_index, mode in enumerate(modes):
+        mask = mode_ids == mode_index
+        ax.scatter(embedding[mask, 0], embedding[mask, 1], s=marker_size, label=mode)
+    ax.legend(title='Mode', markerscale=max(1., 10. / marker_size))
+    plt.savefig(os.path.join(save_path, save_name + '.jpg'))
+    logger.info('Save figure and coordinates: ' + os.path.join(save_path, save_name))
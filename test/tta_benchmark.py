@@ -0,0 +1,129 @@
+import csv
+import os
+import time
+import sys
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.append("")
+from model import bag_tricks, agw, loading, tta
+from metric import cmc_map
+from data import transform, dataset
+from util import config_parser, logger, tool
+
+
+def extract(model, loader, device, norm):
+    # Features, pids and camids of one pass.
+    features = []
+    pids = []
+    camids = []
+    with torch.no_grad():
+        for images, _, batch_pids, batch_camids in loader:
+            batch_features = model(images.to(device))
+            if norm:
+                batch_features = torch.nn.functional.normalize(batch_features, p=2, dim=1)
+            features.append(batch_features.cpu())
+            pids.append(np.asarray(batch_pids))
+            camids.append(np.asarray(batch_camids))
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return torch.cat(features, dim=0), np.concatenate(pids), np.concatenate(camids)
+
+
+if __name__ == '__main__':
+    # 0 introduction
+    print('Person Re-Identification')
+    print('TTA Benchmark')
+
+    # 1 config and tools
+    # 1.1 Get config.
+    config = config_parser.get_config(sys.argv)
+    config_parser.print_config(config)
+    # 1.2 Get logger.
+    logger = logger.get_logger()
+    logger.info('Finishing program initialization.')
+    # 1.3 Set device.
+    if config['basic']['device'] == 'CUDA':
+        os.environ['CUDA_VISIBLE_DEVICES'] = config['basic']['gpu_id']
+    if config['basic']['device'] == 'CUDA' and torch.cuda.is_available():
+        use_gpu, device = True, torch.device('cuda:0')
+        logger.info('Set GPU: ' + config['basic']['gpu_id'])
+    else:
+        use_gpu, device = False, torch.device('cpu')
+        logger.info('Set cpu as device.')
+    # 1.4 Set random seed.
+    seed = config['basic'].getint('seed')
+    tool.setup_random_seed(seed)
+
+    # 2 model
+    model_path = config['model']['path']
+    base_model = loading.build_model(lambda: agw.Baseline(pretrain_choice='self'), model_path, device=device)
+    base_model.eval()
+    logger.info('Base Model: ' + str(tool.get_parameter_number(base_model)))
+
+    # 3 data
+    dataset_style = config['dataset']['style']
+    dataset_path = config['dataset']['path']
+    verbose = config['dataset'].getboolean('verbose')
+    height = config['dataset'].getint('height')
+    width = config['dataset'].getint('width')
+    size = (height, width)
+    batch_size = config['dataset'].getint('batch_size')
+    num_workers = config['dataset'].getint('num_workers')
+    pin_memory = config['dataset'].getboolean('pin_memory')
+    val_norm = config['val'].getboolean('norm')
+    dataset.prepare_manifests(dataset_style, [os.path.join(dataset_path, folder)
+                                              for folder in ['query', 'bounding_box_test']])
+    eval_transform = transform.get_transform(size=size, is_train=False)
+    query_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'query'),
+                                         transform=eval_transform, name='Image Query', verbose=verbose)
+    gallery_dataset = dataset.ImageDataset(style=dataset_style, path=os.path.join(dataset_path, 'bounding_box_test'),
+                                           transform=eval_transform, name='Image Gallery', verbose=verbose)
+    query_loader = DataLoader(query_dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory)
+    gallery_loader = DataLoader(gallery_dataset, batch_size=batch_size, num_workers=num_workers,
+                                pin_memory=pin_memory)
+
+    # 4 benchmark
+    # Single view first, then the flip and the [val] tta_scales alone and together, with every merge.
+    tta_scales = tta.get_scales(config['val']['tta_scales'])
+    settings = []
+    for scales in [[1.0]] + ([tta_scales] if tta_scales != [1.0] else []):
+        for flip in [False, True]:
+            for merge in ['mean', 'concat']:
+                if merge == 'concat' and len(scales) * (2 if flip else 1) == 1:
+                    continue
+                settings.append((scales, flip, merge))
+    results = []
+    for scales, flip, merge in settings:
+        model = tta.TTA(base_model, scales=scales, flip=flip, merge=merge).eval()
+        time_start = time.time()
+        query_features, query_pids, query_camids = extract(model, query_loader, device, val_norm)
+        gallery_features, gallery_pids, gallery_camids = extract(model, gallery_loader, device, val_norm)
+        time_end = time.time()
+        distance_matrix = torch.cdist(query_features, gallery_features).numpy()
+        cmc, mAP = cmc_map.cmc_map(distance_matrix, query_pids, gallery_pids, query_camids, gallery_camids)
+        result = {'scales': ' '.join(str(x) for x in scales), 'flip': flip, 'merge': merge,
+                  'num_feature': query_features.shape[1], 'compute': model.get_compute(size),
+                  'time': time_end - time_start, 'rank1': cmc[0], 'map': mAP}
+        # Gains and time against the single view, the first setting.
+        result['time_ratio'] = result['time'] / (results[0]['time'] if len(results) > 0 else result['time'])
+        result['map_gain'] = mAP - (results[0]['map'] if len(results) > 0 else mAP)
+        results.append(result)
+        logger.info('scales {scales}, flip {flip}, {merge}: {compute:.2f}x compute, {time_ratio:.2f}x time, '
+                    'Rank-1 {rank1:.1%}, mAP {map:.1%} ({map_gain:+.1%})'.format(**result))
+
+    # 5 save table
+    save_path = config['train']['save_path']
+    save_path = os.path.join(
+        save_path, time.strftime("%Y%m%d", time.localtime()))
+    if not os.path.isdir(save_path):
+        os.makedirs(save_path)
+    table_save_name = '[tta benchmark]{}.csv'.format(time.strftime("%H%M%S", time.localtime()))
+    fields = ['scales', 'flip', 'merge', 'num_feature', 'compute', 'time', 'time_ratio', 'rank1', 'map', 'map_gain']
+    with open(os.path.join(save_path, table_save_name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info('Save table: ' + os.path.join(save_path, table_save_name))
@@ -0,0 +1,52 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_state(path, epoch, iteration, models, optimizers, schedulers, sampler=None):
+    # Everything needed to resume training at batch iteration + 1 of epoch.
+    # models, optimizers and schedulers are dicts of name -> object.
+    state = {
+        'epoch': epoch,
+        'iteration': iteration,
+        'models': {name: model.state_dict() for name, model in models.items()},
+        'optimizers': {name: optimizer.state_dict() for name, optimizer in optimizers.items()},
+        'schedulers': {name: scheduler.state_dict() for name, scheduler in schedulers.items()},
+        'sampler': None if sampler is None else sampler.state_dict(epoch, iteration),
+        'rng': get_rng_state(),
+    }
+    # Write then rename, a job killed while saving keeps the previous state.
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_state(path, models, optimizers, schedulers, sampler=None):
+    # Return (epoch, iteration) to resume from.
+    state = torch.load(path, map_location='cpu')
+    for name, model in models.items():
+        model.load_state_dict(state['models'][name])
+    for name, optimizer in optimizers.items():
+        optimizer.load_state_dict(state['optimizers'][name])
+    for name, scheduler in schedulers.items():
+        scheduler.load_state_dict(state['schedulers'][name])
+    if sampler is not None and state['sampler'] is not None:
+        sampler.load_state_dict(state['sampler'])
+    set_rng_state(state['rng'])
+    return state['epoch'], state['iteration']
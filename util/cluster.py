@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+from sklearn.cluster import KMeans, MiniBatchKMeans, DBSCAN, SpectralClustering
+from sklearn.mixture import GaussianMixture
+
+from metric import re_ranking
+
+
+def get_cluster_labels(features, method, num_cluster, seed=0, eps=0.6, min_samples=4, k1=20, k2=6):
+    # Cluster features (numpy) and return labels, -1 for outliers.
+    if method == 'kmeans':
+        labels = KMeans(n_clusters=num_cluster, random_state=seed).fit_predict(features)
+    elif method == 'minibatch_kmeans':
+        labels = MiniBatchKMeans(n_clusters=num_cluster, random_state=seed,
+                                 init='random').fit_predict(features)
+    elif method == 'dbscan':
+        labels = DBSCAN(eps=eps, min_samples=min_samples).fit_predict(features)
+    elif method == 'dbscan_jaccard':
+        distance_matrix = re_ranking.compute_jaccard_distance(
+            torch.as_tensor(features, dtype=torch.float32), k1=k1, k2=k2)
+        distance_matrix = distance_matrix.astype(np.float32)
+        np.fill_diagonal(distance_matrix, 0)
+        labels = DBSCAN(eps=eps, min_samples=min_samples,
+                        metric='precomputed').fit_predict(distance_matrix)
+    elif method == 'gmm':
+        labels = GaussianMixture(n_components=num_cluster, covariance_type='diag',
+                                 random_state=seed).fit_predict(features)
+    elif method == 'spectral':
+        labels = SpectralClustering(n_clusters=num_cluster, random_state=seed,
+                                    assign_labels='discretize').fit(features).labels_
+    else:
+        raise ValueError('Unknown cluster method: {}'.format(method))
+    return np.asarray(labels)
+
+
+def get_pseudo_labels(cluster_labels, min_size=2):
+    # Map cluster labels to pseudo labels from 1. Outliers (-1) and clusters smaller
+    # than min_size are labeled 0, so that TripletSampler skips them.
+    cluster_labels = np.asarray(cluster_labels)
+    unique_labels, inverse, counts = np.unique(cluster_labels, return_inverse=True, return_counts=True)
+    keep = (unique_labels >= 0) & (counts >= min_size)
+    new_ids = np.zeros(len(unique_labels), dtype=np.int64)
+    new_ids[keep] = np.arange(1, np.sum(keep) + 1)
+    labels = new_ids[inverse]
+    stats = {
+        'num_cluster': int(np.sum(keep)),
+        'num_outlier': int(np.sum(cluster_labels < 0)),
+        'num_small': int(np.sum(counts[(unique_labels >= 0) & ~keep])),
+        'num_drop': int(np.sum(labels == 0)),
+        'num_sample': len(labels),
+    }
+    return labels, stats
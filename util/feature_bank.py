@@ -0,0 +1,110 @@
+import numpy as np
+import torch
+
+
+class FeatureBank(object):
+    def __init__(self, num_sample, num_feature, momentum=0.5, refresh_steps=0, min_coverage=0.9, norm=False,
+                 device=None):
+        # bank parameters
+        self.num_sample = num_sample
+        self.num_feature = num_feature
+        self.momentum = momentum
+        self.refresh_steps = refresh_steps
+        self.min_coverage = min_coverage
+        self.norm = norm
+        self.device = device
+        # bank variables
+        self.features = torch.zeros((self.num_sample, self.num_feature), device=self.device)
+        self.updated = torch.zeros(self.num_sample, dtype=torch.bool, device=self.device)
+        self.active = torch.ones(self.num_sample, dtype=torch.bool, device=self.device)
+        self.initialized = False
+
+    def reset(self, features):
+        # Fill the bank with features from a full extraction pass.
+        features = torch.as_tensor(np.asarray(features), dtype=torch.float32)
+        assert features.shape == self.features.shape, 'Features shape should be equal to bank shape.'
+        if self.norm:
+            features = torch.nn.functional.normalize(features, p=2, dim=1)
+        self.features.copy_(features)
+        self.updated.zero_()
+        self.initialized = True
+
+    def update(self, indexes, features):
+        # Momentum update with features already computed in the training loop.
+        if not self.initialized:
+            return
+        with torch.no_grad():
+            indexes = torch.as_tensor(indexes, dtype=torch.long, device=self.features.device)
+            features = features.detach().to(self.features.device, dtype=torch.float32)
+            if self.norm:
+                features = torch.nn.functional.normalize(features, p=2, dim=1)
+            new_features = self.momentum * self.features[indexes] + (1. - self.momentum) * features
+            if self.norm:
+                new_features = torch.nn.functional.normalize(new_features, p=2, dim=1)
+            self.features[indexes] = new_features
+            self.updated[indexes] = True
+
+    def set_rows(self, indexes, features):
+        # Replace rows with freshly extracted features.
+        with torch.no_grad():
+            indexes = torch.as_tensor(indexes, dtype=torch.long, device=self.features.device)
+            features = torch.as_tensor(np.asarray(features), dtype=torch.float32).to(self.features.device)
+            if self.norm:
+                features = torch.nn.functional.normalize(features, p=2, dim=1)
+            self.features[indexes] = features
+            self.updated[indexes] = True
+
+    def set_active(self, mask):
+        # Only samples the sampler can visit count for coverage.
+        self.active = torch.as_tensor(np.asarray(mask), dtype=torch.bool, device=self.features.device)
+
+    def get_inactive_indexes(self):
+        # Samples the sampler never visits, their rows are only current after set_rows.
+        return torch.nonzero(~self.active).view(-1).cpu().numpy()
+
+    def get_coverage(self):
+        if not torch.any(self.active):
+            return 0.
+        return self.updated[self.active].float().mean().item()
+
+    def need_refresh(self, step):
+        # Refresh policy: full extraction at the first step, every refresh_steps steps,
+        # or when too few samples have been updated since the features were last read.
+        if not self.initialized:
+            return True
+        if self.refresh_steps > 0 and (step - 1) % self.refresh_steps == 0:
+            return True
+        return self.get_coverage() < self.min_coverage
+
+    def get_features(self):
+        # Features handed to clustering start a new coverage window.
+        features = self.features.detach().cpu().numpy().copy()
+        self.updated.zero_()
+        return features
+
+
+def get_eval_features(model, images):
+    # Features of an extra eval forward, as full refreshes extract them, whatever mode model is in.
+    # Not free: one more forward per batch.
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        features = model(images)
+    model.train(training)
+    return features
+
+
+def extract_features(model, loader, device):
+    # Eval features of the batches of loader, for set_rows.
+    features = []
+    for images, _, _, _ in loader:
+        features.append(get_eval_features(model, images.to(device)).cpu())
+    return torch.cat(features, dim=0).numpy()
+
+if __name__ == '__main__':
+    bank = FeatureBank(num_sample=4, num_feature=3, momentum=0.5, min_coverage=0.5)
+    print(bank.need_refresh(1))
+    bank.reset(np.ones((4, 3)))
+    bank.update([0, 2], torch.zeros((2, 3)))
+    print(bank.get_coverage(), bank.need_refresh(2))
+    print(bank.get_features())
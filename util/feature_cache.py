@@ -0,0 +1,58 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+
+def get_cache_name(model_path, dataset, norm=False):
+    # Key cache files by model checkpoint and dataset folder, so stale features are never reused.
+    key = []
+    if model_path is not None and os.path.isfile(model_path):
+        key.append(os.path.abspath(model_path))
+        key.append(str(os.path.getmtime(model_path)))
+    else:
+        key.append('initial')
+    key.append(os.path.abspath(dataset.path))
+    key.append(str(os.path.getmtime(dataset.path)))
+    key.append(str(dataset.length))
+    key.append(str(norm))
+    digest = hashlib.md5('|'.join(key).encode('utf-8')).hexdigest()[:16]
+    return '[feature]{}[{}].npz'.format(os.path.basename(os.path.normpath(dataset.path)), digest)
+
+
+def extract_features(model, dataset, device, batch_size, num_workers, pin_memory, norm=False):
+    dataloader = DataLoader(dataset, batch_size=batch_size,
+                            num_workers=num_workers, pin_memory=pin_memory)
+    all_features = []
+    all_pids = []
+    all_camids = []
+    model.eval()
+    with torch.no_grad():
+        for images, _, pids, camids in dataloader:
+            images = images.to(device)
+            features = model(images)
+            if norm:
+                features = torch.nn.functional.normalize(features, p=2, dim=1)
+            all_features.append(features.detach().cpu().numpy())
+            all_pids.append(np.asarray(pids))
+            all_camids.append(np.asarray(camids))
+    return np.concatenate(all_features, axis=0), np.concatenate(all_pids), np.concatenate(all_camids)
+
+
+def get_features(cache_path, model, model_path, dataset, device, batch_size, num_workers, pin_memory, norm=False):
+    # Load features from cache, or extract them with model and write the cache.
+    cache_file = os.path.join(cache_path, get_cache_name(model_path, dataset, norm=norm))
+    if os.path.isfile(cache_file):
+        print('Load cached feature: {}'.format(cache_file))
+        cache = np.load(cache_file)
+        return cache['features'], cache['pids'], cache['camids']
+    assert model is not None, 'Model should not be None if features are not cached.'
+    features, pids, camids = extract_features(model, dataset, device, batch_size, num_workers, pin_memory,
+                                              norm=norm)
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    np.savez(cache_file, features=features, pids=pids, camids=camids)
+    print('Save cached feature: {}'.format(cache_file))
+    return features, pids, camids
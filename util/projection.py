@@ -0,0 +1,26 @@
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+
+
+def get_embedding(features, method='tsne', pca_dim=50, seed=0, perplexity=30, n_neighbors=15):
+    # Project features (numpy) to 2-D. PCA first, so the neighbor search of the layout
+    # runs on pca_dim dimensions instead of the raw feature size.
+    if 0 < pca_dim < features.shape[1]:
+        features = PCA(n_components=pca_dim, svd_solver='randomized',
+                       random_state=seed).fit_transform(features)
+    if method == 'tsne':
+        # Barnes-Hut t-SNE, O(N log N).
+        embedding = TSNE(n_components=2, init='pca', method='barnes_hut', perplexity=perplexity,
+                         random_state=seed).fit_transform(features)
+    elif method == 'umap':
+        # kNN-graph layout, needs umap-learn.
+        try:
+            import umap
+        except ImportError:
+            raise ImportError('umap-learn is needed for umap projection: pip install umap-learn')
+        embedding = umap.UMAP(n_components=2, n_neighbors=n_neighbors,
+                              random_state=seed).fit_transform(features)
+    else:
+        raise ValueError('Unknown projection method: {}'.format(method))
+    return np.asarray(embedding, dtype=np.float32)